@@ -0,0 +1,43 @@
+"""user id indexes
+
+Revision ID: 5e2b9c4d7a13
+Revises: 3c9d5e8a6f10
+Create Date: 2026-10-18 17:40:12.583914
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e2b9c4d7a13'
+down_revision: Union[str, None] = '3c9d5e8a6f10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CONCURRENTLY does not block writes but can't run inside a transaction.
+    # Failed build leaves an invalid index behind, it is dropped first so migration can be retried.
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_post_user_id_published_at_id')
+        op.create_index(
+            'ix_post_user_id_published_at_id', 'post',
+            ['user_id', sa.text('published_at DESC'), sa.text('id DESC')],
+            unique=False, postgresql_concurrently=True
+        )
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_post_like_user_id')
+        op.create_index('ix_post_like_user_id', 'post_like', ['user_id'], unique=False, postgresql_concurrently=True)
+        # Duplicates of primary key indexes
+        op.drop_index('ix_post_id', table_name='post', postgresql_concurrently=True)
+        op.drop_index('ix_user_id', table_name='user', postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_user_id', 'user', ['id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_post_id', 'post', ['id'], unique=False, postgresql_concurrently=True)
+        op.drop_index('ix_post_like_user_id', table_name='post_like', postgresql_concurrently=True)
+        op.drop_index('ix_post_user_id_published_at_id', table_name='post', postgresql_concurrently=True)
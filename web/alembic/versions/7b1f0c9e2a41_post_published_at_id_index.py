@@ -0,0 +1,34 @@
+"""post published_at id index
+
+Revision ID: 7b1f0c9e2a41
+Revises: de3442f52cbb
+Create Date: 2026-10-18 10:12:31.418305
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7b1f0c9e2a41'
+down_revision: Union[str, None] = 'de3442f52cbb'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # CONCURRENTLY does not block writes but can't run inside a transaction.
+    # Failed build leaves an invalid index behind, it is dropped first so migration can be retried.
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_post_published_at_id')
+        op.create_index(
+            'ix_post_published_at_id', 'post', [sa.text('published_at DESC'), sa.text('id DESC')],
+            unique=False, postgresql_concurrently=True
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_post_published_at_id', table_name='post', postgresql_concurrently=True)
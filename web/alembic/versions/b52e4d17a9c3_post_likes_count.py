@@ -0,0 +1,32 @@
+"""post likes count
+
+Revision ID: b52e4d17a9c3
+Revises: 7b1f0c9e2a41
+Create Date: 2026-10-18 11:04:52.733190
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b52e4d17a9c3'
+down_revision: Union[str, None] = '7b1f0c9e2a41'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('post', sa.Column('likes_count', sa.Integer(), server_default='0', nullable=False))
+    # Backfill counters from existing likes
+    op.execute(
+        'UPDATE post SET likes_count = counts.likes_count '
+        'FROM (SELECT post_id, count(*) AS likes_count FROM post_like GROUP BY post_id) AS counts '
+        'WHERE post.id = counts.post_id'
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('post', 'likes_count')
@@ -0,0 +1,42 @@
+"""post trending score
+
+Revision ID: c4e8a2f6d913
+Revises: 8f4a1d6c2b57
+Create Date: 2026-10-18 20:14:37.902615
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4e8a2f6d913'
+down_revision: Union[str, None] = '8f4a1d6c2b57'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('post', sa.Column('trending_score', sa.Float(), server_default='0', nullable=False))
+    # Backfill liked posts with default 24 hours half-life, `recalculate_trending_scores` command applies another one
+    op.execute(
+        'UPDATE post SET trending_score = log(2, likes_count) + extract(epoch FROM published_at) / 86400 '
+        'WHERE likes_count > 0'
+    )
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_post_trending_score')
+        op.create_index(
+            'ix_post_trending_score', 'post', [sa.text('trending_score DESC'), sa.text('id DESC')],
+            unique=False, postgresql_where=sa.text('trending_score > 0'), postgresql_concurrently=True
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'ix_post_trending_score', table_name='post',
+            postgresql_where=sa.text('trending_score > 0'), postgresql_concurrently=True
+        )
+    op.drop_column('post', 'trending_score')
@@ -0,0 +1,47 @@
+"""post search indexes
+
+Revision ID: e1a7c3f4b9d2
+Revises: b52e4d17a9c3
+Create Date: 2026-10-18 13:27:05.561942
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e1a7c3f4b9d2'
+down_revision: Union[str, None] = 'b52e4d17a9c3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # Expression index instead of a stored generated column, adding one would rewrite the whole table
+    # under ACCESS EXCLUSIVE lock. Queries use the same expression, see `models.get_search_vector`.
+    # CONCURRENTLY does not block writes during the long GIN builds but can't run inside a transaction.
+    # Failed build leaves an invalid index behind, it is dropped first so migration can be retried.
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_post_search_vector')
+        op.create_index(
+            'ix_post_search_vector', 'post',
+            [sa.text(
+                "(setweight(to_tsvector('english'::regconfig, title), 'A') || "
+                "setweight(to_tsvector('english'::regconfig, content), 'B'))"
+            )],
+            unique=False, postgresql_using='gin', postgresql_concurrently=True
+        )
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ix_post_title_trgm')
+        op.create_index(
+            'ix_post_title_trgm', 'post', ['title'], unique=False,
+            postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'}, postgresql_concurrently=True
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_post_title_trgm', table_name='post', postgresql_using='gin', postgresql_concurrently=True)
+        op.drop_index('ix_post_search_vector', table_name='post', postgresql_using='gin', postgresql_concurrently=True)
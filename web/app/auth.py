@@ -1,12 +1,16 @@
 from fastapi import status, Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
+from hashlib import sha256
+import time
 
 from .selectors import get_user
-from .db import get_db
+from .db import get_write_db
+from .cache import TTLCache
 from .config import settings
+from .metrics import track_cache
 from . import models
 
 
@@ -19,6 +23,12 @@ credentials_exception = HTTPException(
     headers={'WWW-Authenticate': 'Bearer'},
 )
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='login')
+# Detached user rows keyed by user id
+user_cache = TTLCache(maxsize=settings.USER_CACHE_SIZE, ttl=settings.USER_CACHE_TTL_SECONDS)
+# User ids of already validated tokens keyed by token hash, entries expire together with tokens
+token_cache = TTLCache(maxsize=settings.TOKEN_CACHE_SIZE)
+track_cache('user', user_cache.stats)
+track_cache('token', token_cache.stats)
 
 
 def create_access_token(user_id: str | int) ->str:
@@ -27,14 +37,38 @@ def create_access_token(user_id: str | int) ->str:
     return jwt.encode(data, key=SECRET_KEY, algorithm=ALGORITHM)
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> models.User:
+def decode_access_token(token: str) -> str | None:
+    """Return user id from token subject, None if token is invalid"""
+    token_hash = sha256(token.encode()).hexdigest()
+    user_id = token_cache.get(token_hash)
+    if user_id is not None:
+        return user_id
     try:
         payload = jwt.decode(token, key=SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
-        raise credentials_exception
-    user_id: str = payload.get('sub')
-    if user_id is not None:
-        user = get_user(id=user_id, db=db)
-        if user is not None:
-            return user
+        return None
+    user_id, expires_at = payload.get('sub'), payload.get('exp')
+    if user_id is not None and expires_at is not None:
+        token_cache.set(token_hash, user_id, ttl=expires_at - time.time())
+    return user_id
+
+
+def invalidate_cached_user(user_id: int) -> None:
+    """Must be called after user row is modified"""
+    user_cache.delete(user_id)
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_write_db)) -> models.User:
+    user_id = decode_access_token(token)
+    if user_id is not None and user_id.isdigit():
+        user_id = int(user_id)
+        user = user_cache.get(user_id)
+        if user is None:
+            user = await get_user(id=user_id, db=db)
+            if user is None:
+                raise credentials_exception
+            db.expunge(user)
+            user_cache.set(user_id, user)
+        # Attach copy of cached row to current session without hitting DB
+        return await db.merge(user, load=False)
     raise credentials_exception
@@ -0,0 +1,325 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Hashable
+from urllib.parse import urlparse
+
+import orjson
+
+from .config import settings
+from .metrics import track_cache
+
+
+class TTLCache:
+    """
+    Bounded in-process LRU cache with per-entry expiration.
+    Least recently used entries are evicted once `maxsize` is reached.
+    """
+
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict[Hashable, tuple[Any, float | None]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at is None or expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        """Store value, `ttl` overrides cache-wide default for this entry"""
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: Hashable) -> bool:
+        return self._data.pop(key, None) is not None
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class CacheBackend(ABC):
+    """Storage of response cache, values are opaque bytes"""
+
+    @abstractmethod
+    async def get(self, key: str) -> bytes | None:
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: int) -> None:
+        pass
+
+    @abstractmethod
+    async def get_counter(self, key: str) -> int:
+        pass
+
+    @abstractmethod
+    async def incr(self, key: str) -> int:
+        """Increment counter which is never evicted, return new value"""
+
+    async def get_with_counter(self, counter_key: str, key: str) -> tuple[int, bytes | None]:
+        """Counter and value read together, network backends do it in one round trip"""
+        return await self.get_counter(counter_key), await self.get(key)
+
+    @abstractmethod
+    async def stats(self) -> dict[str, int | None]:
+        """Size and evictions, None where backend can't tell"""
+
+    def clear(self) -> None:
+        pass
+
+
+class MemoryCacheBackend(CacheBackend):
+    """In-process LRU with TTL, every worker process keeps its own copy"""
+
+    def __init__(self, maxsize: int):
+        self.cache = TTLCache(maxsize=maxsize)
+        self.counters: dict[str, int] = {}
+
+    async def get(self, key: str) -> bytes | None:
+        return self.cache.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: int) -> None:
+        self.cache.set(key, value, ttl=ttl)
+
+    async def get_counter(self, key: str) -> int:
+        return self.counters.get(key, 0)
+
+    async def incr(self, key: str) -> int:
+        self.counters[key] = self.counters.get(key, 0) + 1
+        return self.counters[key]
+
+    async def stats(self) -> dict[str, int | None]:
+        return self.cache.stats()
+
+    def clear(self) -> None:
+        self.cache.clear()
+        self.counters.clear()
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Minimal client of Redis protocol (RESP2), works with Redis and compatible servers.
+    Single connection is opened lazily per event loop and shared by its requests, commands
+    of one call are pipelined. Every exchange is bounded by `timeout`, connection is dropped
+    whenever a reply may be left unread on it (timeout, cancellation, I/O error), otherwise
+    it would be read as reply to the next command.
+    """
+
+    def __init__(self, url: str, timeout: float = 0.5):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._lock: asyncio.Lock | None = None
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+
+    @staticmethod
+    def _encode(*args: str | bytes | int) -> bytes:
+        parts = [arg if isinstance(arg, bytes) else str(arg).encode() for arg in args]
+        return b'*%d\r\n' % len(parts) + b''.join(b'$%d\r\n%s\r\n' % (len(part), part) for part in parts)
+
+    async def _read_reply(self) -> Any:
+        """Read one whole reply, error replies are returned so pipelined replies after them are still read"""
+        line = (await self._reader.readuntil(b'\r\n'))[:-2]
+        prefix, payload = line[:1], line[1:]
+        if prefix == b'+':
+            return payload.decode()
+        if prefix == b'-':
+            return RedisError(payload.decode())
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length == -1:
+                return None
+            return (await self._reader.readexactly(length + 2))[:-2]
+        if prefix == b'*':
+            length = int(payload)
+            return None if length == -1 else [await self._read_reply() for _ in range(length)]
+        raise RedisError(f'Unexpected reply: {line!r}')
+
+    async def _exchange(self, commands: list[tuple[str | bytes | int, ...]]) -> list[Any]:
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            setup = [('AUTH', self.password)] if self.password else []
+            if self.db:
+                setup.append(('SELECT', self.db))
+            commands = [*setup, *commands]
+        else:
+            setup = []
+        self._writer.write(b''.join(self._encode(*command) for command in commands))
+        await self._writer.drain()
+        replies = [await self._read_reply() for _ in commands]
+        for reply in replies[:len(setup)]:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies[len(setup):]
+
+    def _disconnect(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def execute_many(self, *commands: tuple[str | bytes | int, ...]) -> list[Any]:
+        """Send commands in one round trip, return their replies in order"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._lock, self._reader, self._writer = loop, asyncio.Lock(), None, None
+        async with self._lock:
+            try:
+                replies = await asyncio.wait_for(self._exchange(list(commands)), self.timeout)
+            except BaseException:
+                self._disconnect()  # Reconnect on next command
+                raise
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    async def execute(self, *args: str | bytes | int) -> Any:
+        return (await self.execute_many(args))[0]
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.execute('GET', key)
+
+    async def set(self, key: str, value: bytes, ttl: int) -> None:
+        await self.execute('SET', key, value, 'EX', ttl)
+
+    async def get_counter(self, key: str) -> int:
+        return int(await self.execute('GET', key) or 0)
+
+    async def get_with_counter(self, counter_key: str, key: str) -> tuple[int, bytes | None]:
+        counter, value = await self.execute_many(('GET', counter_key), ('GET', key))
+        return int(counter or 0), value
+
+    async def incr(self, key: str) -> int:
+        return await self.execute('INCR', key)
+
+    async def stats(self) -> dict[str, int | None]:
+        info, size = await self.execute_many(('INFO', 'stats'), ('DBSIZE',))
+        evictions = re.search(rb'evicted_keys:(\d+)', info or b'')
+        return {'size': size, 'evictions': int(evictions.group(1)) if evictions else None}
+
+
+CACHE_ERRORS = (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, RedisError)
+
+
+class ResponseCache:
+    """
+    Read-through cache of rendered responses keyed by normalized request parameters.
+    Entries are tagged with namespace version they were rendered at, writes bump the version
+    instead of deleting entries, so entries tagged with an older one are treated as misses and age out
+    through TTL or LRU eviction. Version and entry are read in one round trip.
+    Backend failures and timeouts are logged and treated as cache misses.
+    """
+
+    def __init__(self, backend: CacheBackend, namespace: str, ttl: int):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _make_key(self, params: dict[str, Any]) -> str:
+        digest = hashlib.sha1(orjson.dumps(params, option=orjson.OPT_SORT_KEYS)).hexdigest()
+        return f'{self.namespace}:{digest}'
+
+    async def get(
+        self, params: dict[str, Any]
+    ) -> tuple[tuple[str, int] | None, tuple[bytes, dict[str, str]] | None]:
+        """
+        Return key with current version and cached body with headers, if any.
+        Key must be passed to `set`, so a page rendered while a write bumped the version
+        is tagged with the older version and never served.
+        """
+        key = self._make_key(params)
+        try:
+            version, value = await self.backend.get_with_counter(f'{self.namespace}:version', key)
+        except CACHE_ERRORS as err:
+            logging.warning(f'Error reading {self.namespace} cache: {err!r}')
+            return None, None
+        if value is not None:
+            value_version, headers, body = value.split(b'\n', 2)
+            if int(value_version) == version:
+                self.hits += 1
+                return (key, version), (body, orjson.loads(headers))
+        self.misses += 1
+        return (key, version), None
+
+    async def set(self, key: tuple[str, int] | None, body: bytes, headers: dict[str, str]) -> None:
+        if key is None:
+            return
+        key, version = key
+        value = b'%d\n' % version + orjson.dumps(headers) + b'\n' + body
+        try:
+            await self.backend.set(key, value, self.ttl)
+        except CACHE_ERRORS as err:
+            logging.warning(f'Error writing {self.namespace} cache: {err!r}')
+
+    async def invalidate(self) -> None:
+        try:
+            await self.backend.incr(f'{self.namespace}:version')
+        except CACHE_ERRORS as err:
+            logging.error(f'Error invalidating {self.namespace} cache: {err!r}')
+
+    async def stats(self) -> dict[str, int | float | None]:
+        try:
+            stats = await self.backend.stats()
+        except CACHE_ERRORS as err:
+            logging.warning(f'Error reading {self.namespace} cache stats: {err!r}')
+            stats = {'size': None, 'evictions': None}
+        lookups = self.hits + self.misses
+        return {
+            'size': stats['size'], 'hits': self.hits, 'misses': self.misses,
+            'evictions': stats['evictions'], 'hit_ratio': self.hits / lookups if lookups else None,
+        }
+
+
+def get_response_cache(namespace: str) -> ResponseCache | None:
+    """Build response cache from settings, None if caching is disabled"""
+    if settings.RESPONSE_CACHE_BACKEND == 'memory':
+        backend = MemoryCacheBackend(maxsize=settings.RESPONSE_CACHE_SIZE)
+    elif settings.RESPONSE_CACHE_BACKEND == 'redis':
+        backend = RedisCacheBackend(settings.RESPONSE_CACHE_URL, timeout=settings.RESPONSE_CACHE_TIMEOUT_SECONDS)
+    else:
+        return None
+    return ResponseCache(backend, namespace=namespace, ttl=settings.RESPONSE_CACHE_TTL_SECONDS)
+
+
+posts_cache = get_response_cache('posts')
+if posts_cache is not None:
+    track_cache('posts', posts_cache.stats)
@@ -0,0 +1,69 @@
+"""
+Maintenance commands, run as `python -m app.commands <command>`.
+"""
+import argparse
+import asyncio
+
+from .config import settings
+from .db import SessionLocal, engine
+from .media import precompress
+from .storages import local_storage
+from . import services
+
+
+async def reconcile_likes_count() -> None:
+    """Fix drift between `Post.likes_count` and actual `post_like` rows"""
+    async with SessionLocal() as db:
+        fixed = await services.reconcile_likes_count(db=db)
+    print(f'Fixed likes count of {fixed} post(s)')
+
+
+async def recalculate_trending_scores() -> None:
+    """Recompute trending scores with current TRENDING_HALF_LIFE_HOURS"""
+    async with SessionLocal() as db:
+        updated = await services.recalculate_trending_scores(db=db)
+    print(f'Recalculated trending score of {updated} post(s)')
+
+
+async def migrate_user_images() -> None:
+    """Rename existing profile pictures for content-addressed storage"""
+    async with SessionLocal() as db:
+        migrated = await services.migrate_user_images(db=db)
+    local_storage.shutdown(wait=True)  # Let derivatives finish
+    print(f'Migrated pictures of {migrated} user(s)')
+
+
+async def rebuild_feeds() -> None:
+    """Fix followers counts and refill feeds with recent posts of followed users"""
+    async with SessionLocal() as db:
+        added = await services.rebuild_feeds(db=db)
+    print(f'Added {added} feed item(s)')
+
+
+async def compress_static() -> None:
+    """Build ".gz" siblings of static files"""
+    written = precompress(settings.STATIC_DIR)
+    print(f'Compressed {written} static file(s)')
+
+
+COMMANDS = {
+    'reconcile_likes_count': reconcile_likes_count,
+    'recalculate_trending_scores': recalculate_trending_scores,
+    'migrate_user_images': migrate_user_images,
+    'rebuild_feeds': rebuild_feeds,
+    'compress_static': compress_static,
+}
+
+
+async def run(command: str) -> None:
+    try:
+        await COMMANDS[command]()
+    finally:
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Application maintenance commands')
+    parser.add_argument('command', choices=COMMANDS.keys())
+    args = parser.parse_args()
+    asyncio.run(run(args.command))
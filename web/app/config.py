@@ -2,16 +2,57 @@ import os
 
 from pydantic import BaseSettings
 from pathlib import Path
+from typing import Literal
 
 
 class Settings(BaseSettings):
     SECRET_KEY: str
     DB_URL: str
     TESTS_DB_URL: str
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 3.0  # Seconds to wait for a free connection before answering 503
+    DB_POOL_RECYCLE: int = 1800  # Seconds, -1 to keep connections forever
+    DB_POOL_PRE_PING: bool = True
+    DB_STATEMENT_TIMEOUT_MS: int = 30000  # 0 disables
+    DB_REPLICA_URLS: list[str] = []  # Read-only routes are spread over these, e.g. '["postgresql://..."]'
+    DB_REPLICA_EJECT_SECONDS: float = 30.0  # Replica failing to connect is skipped for this long
+    DB_READ_YOUR_WRITES_SECONDS: float = 5.0  # Reads after a write go to primary, covers replication lag
     HOSTNAME: str
     BASE_DIR = Path(__file__).resolve().parent.parent
     MEDIA_DIR: str = os.path.join(BASE_DIR, 'media')
     STATIC_DIR: str = os.path.join(BASE_DIR, 'static')
+    MEDIA_CACHE_CONTROL: str = 'public, max-age=31536000, immutable'  # Uploaded file names are never reused
+    STATIC_CACHE_CONTROL: str = 'public, no-cache'
     USER_IMAGES_FOLDER: str = 'images'
+    USER_IMAGES_CONTENT_ADDRESSED: bool = False
+    UPLOAD_CHUNK_SIZE: int = 64 * 1024
+    MAX_UPLOAD_SIZE: int = 5 * 1024 * 1024
+    AVATAR_SIZES: list[int] = [64, 128, 256]
+    AVATAR_FORMAT: str = 'webp'
+    AVATAR_QUALITY: int = 80
+    AVATAR_WORKERS: int = 2
+    AVATAR_DERIVATIVES_CACHE_SIZE: int = 4096
+    AVATAR_DERIVATIVES_RECHECK_SECONDS: int = 5
+    USER_CACHE_SIZE: int = 1024
+    USER_CACHE_TTL_SECONDS: int = 60
+    TOKEN_CACHE_SIZE: int = 4096
+    BCRYPT_ROUNDS: int = 12
+    PASSWORD_HASHING_WORKERS: int = 2
+    PASSWORD_HASHING_QUEUE_SIZE: int = 32
+    EXPORT_BATCH_SIZE: int = 1000
+    FEED_FANOUT_MAX_FOLLOWERS: int = 10000  # Posts of authors with more followers are merged into feeds at read time
+    FEED_BACKFILL_POSTS: int = 20  # Recent posts of followed user added to follower's feed
+    TRENDING_HALF_LIFE_HOURS: float = 24  # Post age at which its likes weigh half, run recalculate_trending_scores after change
+    TRENDING_SIZE: int = 100  # Top posts kept in memory, max limit of trending endpoint
+    TRENDING_REFRESH_SECONDS: int = 30
+    RESPONSE_CACHE_BACKEND: Literal['memory', 'redis', 'none'] = 'memory'
+    RESPONSE_CACHE_URL: str = 'redis://localhost:6379/0'
+    RESPONSE_CACHE_TTL_SECONDS: int = 30
+    RESPONSE_CACHE_TIMEOUT_SECONDS: float = 0.5
+    RESPONSE_CACHE_SIZE: int = 1024
+    QUERY_BUDGET: int = 10  # Queries per request above which a warning is logged
+    QUERY_BUDGETS: dict[str, int] = {}  # Per route template overrides, e.g. {"/posts/{id}": 3}
+    QUERY_ROUTE_COMMENTS: bool = True  # Tag SQL with route for pg_stat_statements and DB logs
 
 settings = Settings()
@@ -1,17 +1,195 @@
-from sqlalchemy import create_engine
+import hashlib
+import logging
+from time import monotonic, perf_counter
+
+from fastapi import Depends, Request
+from sqlalchemy import exc
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncEngine, AsyncSession
 from sqlalchemy.orm import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, PoolProxiedConnection
 
+from .cache import TTLCache
 from .config import settings
+from .metrics import POOL_CHECKOUT_WAIT, POOL_TIMEOUTS, track_pool, track_queries
+
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def get_async_url(url: str) -> URL:
+    """Swap driver of a Postgres URL for async one"""
+    return make_url(url).set(drivername='postgresql+asyncpg')
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Pool recording how long checkouts wait and how many of them time out"""
+
+    def connect(self) -> PoolProxiedConnection:
+        started_at = perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            POOL_CHECKOUT_WAIT.observe(perf_counter() - started_at)
+
+
+def create_db_engine(url: str, name: str) -> AsyncEngine:
+    """
+    Engine with pool configured from settings. Checkouts waiting longer than `DB_POOL_TIMEOUT`
+    raise `sqlalchemy.exc.TimeoutError` answered with 503, and queries running longer than
+    `DB_STATEMENT_TIMEOUT_MS` are cancelled by the server.
+    Queries are tracked into request metrics and pool usage is reported under `name`.
+    """
+    server_settings = {}
+    if settings.DB_STATEMENT_TIMEOUT_MS:
+        server_settings['statement_timeout'] = str(settings.DB_STATEMENT_TIMEOUT_MS)
+    engine = create_async_engine(
+        get_async_url(url),
+        poolclass=TimedQueuePool,
+        pool_size=settings.DB_POOL_SIZE,
+        max_overflow=settings.DB_MAX_OVERFLOW,
+        pool_timeout=settings.DB_POOL_TIMEOUT,
+        pool_recycle=settings.DB_POOL_RECYCLE,
+        pool_pre_ping=settings.DB_POOL_PRE_PING,
+        connect_args={'server_settings': server_settings},
+    )
+    track_queries(engine.sync_engine)
+    track_pool(engine.sync_engine.pool, name)
+    return engine
+
+
+def make_session_factory(engine: AsyncEngine) -> async_sessionmaker:
+    return async_sessionmaker(bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
+class ReplicaSet:
+    """
+    Read replicas taken in round-robin order. Replica failing to connect is ejected
+    for `DB_REPLICA_EJECT_SECONDS`, when none is healthy reads go to primary.
+    """
+
+    def __init__(self, engines: list[AsyncEngine]):
+        self.engines = engines
+        self.session_factories = [make_session_factory(engine) for engine in engines]
+        self.ejected_until = [0.0] * len(engines)
+        self._next = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.engines)
+
+    def healthy(self) -> list[int]:
+        """Indexes of replicas not ejected, starting from the next one in turn"""
+        count = len(self.engines)
+        start = self._next
+        self._next = (start + 1) % count
+        now = monotonic()
+        return [index % count for index in range(start, start + count) if self.ejected_until[index % count] <= now]
+
+    def eject(self, index: int) -> None:
+        self.ejected_until[index] = monotonic() + settings.DB_REPLICA_EJECT_SECONDS
+        logger.warning(
+            'Replica %s ejected for %ss', self.engines[index].url.render_as_string(), settings.DB_REPLICA_EJECT_SECONDS
+        )
+
+    def get_session_factory(self) -> async_sessionmaker | None:
+        healthy = self.healthy()
+        return self.session_factories[healthy[0]] if healthy else None
 
+    async def open_session(self) -> AsyncSession | None:
+        """
+        Session with connection already checked out, so a dead replica is noticed before handler runs.
+        Replica with exhausted pool is skipped but not ejected, that would move its load onto the others.
+        When all healthy replicas are exhausted pool timeout is raised instead of falling back to primary.
+        """
+        timeout = None
+        for index in self.healthy():
+            db = self.session_factories[index]()
+            try:
+                await db.connection()
+            except exc.TimeoutError as error:
+                await db.close()
+                timeout = error
+                continue
+            except (OSError, exc.DBAPIError):
+                await db.close()
+                self.eject(index)
+                continue
+            return db
+        if timeout is not None:
+            raise timeout
+        return None
 
-engine = create_engine(settings.DB_URL)
-SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+    async def dispose(self) -> None:
+        for engine in self.engines:
+            await engine.dispose()
+
+
+# Requesters who wrote recently, their reads go to primary until replicas catch up
+recent_writers = TTLCache(maxsize=4096)
+
+
+def get_requester_key(request: Request) -> str:
+    """Token of authenticated requester, client address of anonymous one"""
+    authorization = request.headers.get('authorization')
+    if authorization:
+        return hashlib.sha256(authorization.encode()).hexdigest()
+    return request.client.host if request.client else ''
+
+
+def wrote_recently(request: Request) -> bool:
+    return settings.DB_READ_YOUR_WRITES_SECONDS > 0 and recent_writers.get(get_requester_key(request)) is not None
+
+
+def pinned_to_primary(request: Request) -> bool:
+    """Whether reads of requester go to primary while others may read lagging replicas"""
+    return bool(replicas) and wrote_recently(request)
+
+
+engine = create_db_engine(settings.DB_URL, name='primary')
+SessionLocal = make_session_factory(engine)
+replicas = ReplicaSet([
+    create_db_engine(url, name=f'replica{index}') for index, url in enumerate(settings.DB_REPLICA_URLS)
+])
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
+
+def get_session_factory() -> async_sessionmaker:
+    """
+    Dependency for handlers which need a session outliving dependencies scope,
+    e.g. to read from DB while streaming response.
+    """
+    return SessionLocal
+
+
+async def get_write_db(request: Request, session_factory: async_sessionmaker = Depends(get_session_factory)):
+    """Primary session, requester doing anything but reading is remembered to read own writes"""
+    async with session_factory() as db:
         yield db
-    finally:
-        db.close()
+    if request.method not in SAFE_METHODS and settings.DB_READ_YOUR_WRITES_SECONDS > 0:
+        recent_writers.set(get_requester_key(request), True, ttl=settings.DB_READ_YOUR_WRITES_SECONDS)
+
+
+async def get_read_db(request: Request, primary: AsyncSession = Depends(get_write_db)):
+    """
+    Replica session for read-only handlers, primary one when there are no healthy replicas
+    or requester wrote recently. Primary session is shared with `get_current_user`.
+    """
+    db = await replicas.open_session() if replicas and not wrote_recently(request) else None
+    if db is None:
+        yield primary
+        return
+    async with db:
+        yield db
+
+
+def get_read_session_factory(
+    request: Request, session_factory: async_sessionmaker = Depends(get_session_factory)
+) -> async_sessionmaker:
+    """`get_session_factory` counterpart for read-only handlers"""
+    if replicas and not wrote_recently(request):
+        return replicas.get_session_factory() or session_factory
+    return session_factory
@@ -1,19 +1,59 @@
 import os
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse
+from sqlalchemy import exc
 
 from app.config import settings
-from app.routers import users, posts
+from app.db import replicas
+from app.media import MediaFiles
+from app.metrics import MetricsMiddleware, registry
+from app.routers import users, posts, feed
+from app.storages import local_storage
+from app.utils import HashingPoolBusy, hashing_pool
 
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+app.add_event_handler('shutdown', hashing_pool.shutdown)
+app.add_event_handler('shutdown', local_storage.shutdown)
+app.add_event_handler('shutdown', replicas.dispose)
+
+
+@app.exception_handler(HashingPoolBusy)
+async def hashing_pool_busy_handler(request: Request, exc: HashingPoolBusy) -> JSONResponse:
+    return JSONResponse(
+        {'detail': 'Server is busy, try again later'},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={'Retry-After': '1'},
+    )
+
+
+@app.get('/metrics', include_in_schema=False)
+async def metrics() -> PlainTextResponse:
+    await registry.collect()
+    return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
+
+
+@app.exception_handler(exc.TimeoutError)
+async def db_pool_timeout_handler(request: Request, error: exc.TimeoutError) -> JSONResponse:
+    """No DB connection got free within `DB_POOL_TIMEOUT`, shed load instead of queueing"""
+    return JSONResponse(
+        {'detail': 'Server is busy, try again later'},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={'Retry-After': '1'},
+    )
+
 
 app.include_router(users.router, tags=['users'])
 app.include_router(posts.router, tags=['posts'])
-app.mount('/static', StaticFiles(directory=settings.STATIC_DIR), name='static')
-app.mount('/media', StaticFiles(directory=settings.MEDIA_DIR), name='media')
+app.include_router(feed.router, tags=['feed'])
+app.mount(
+    '/static',
+    MediaFiles(directory=settings.STATIC_DIR, cache_control=settings.STATIC_CACHE_CONTROL, precompressed=True),
+    name='static'
+)
+app.mount('/media', MediaFiles(directory=settings.MEDIA_DIR, cache_control=settings.MEDIA_CACHE_CONTROL), name='media')
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,3 +62,4 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
@@ -0,0 +1,196 @@
+import gzip
+import os
+import re
+import shutil
+import stat
+
+import anyio
+from mimetypes import guess_type
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Receive, Scope, Send
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+# Siblings looked up in order of preference
+PRECOMPRESSED_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+
+
+class RangeNotSatisfiable(Exception):
+    """Requested byte range lies outside of file"""
+
+
+def parse_range(range_header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parse single "Range: bytes=" header into inclusive (start, end) offsets.
+    Return None for headers that should be ignored, multiple ranges included,
+    in which case whole file is served.
+    """
+    match = RANGE_RE.match(range_header.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if not start and not end:
+        return None
+    if not start:
+        # Suffix range, last N bytes
+        length = int(end)
+        if not length or not size:
+            raise RangeNotSatisfiable
+        return max(size - length, 0), size - 1
+    start = int(start)
+    if end and int(end) < start:
+        return None  # Invalid, "last-byte-pos" before "first-byte-pos"
+    if start >= size:
+        raise RangeNotSatisfiable
+    return start, min(int(end), size - 1) if end else size - 1
+
+
+class RangeFileResponse(FileResponse):
+    """
+    FileResponse answering single byte range requests with 206 Partial Content.
+    Body is handed to server with zero-copy "http.response.zerocopysend" or
+    "http.response.pathsend" ASGI extensions when supported.
+    """
+
+    def __init__(self, path: str, stat_result: os.stat_result, **kwargs):
+        super().__init__(path, stat_result=stat_result, **kwargs)
+        self.headers['accept-ranges'] = 'bytes'
+        self.range: tuple[int, int] | None = None
+
+    def set_range(self, request_headers: Headers) -> None:
+        range_header = request_headers.get('range')
+        if range_header is None:
+            return
+        if_range = request_headers.get('if-range')
+        if if_range is not None and if_range not in (self.headers['etag'], self.headers['last-modified']):
+            return  # File changed since client got its part, send whole file
+        self.range = parse_range(range_header, self.stat_result.st_size)
+        if self.range is not None:
+            start, end = self.range
+            self.status_code = 206
+            self.headers['content-range'] = f'bytes {start}-{end}/{self.stat_result.st_size}'
+            self.headers['content-length'] = str(end - start + 1)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        extensions = scope.get('extensions') or {}
+        zerocopy = 'http.response.zerocopysend' in extensions
+        if scope['method'].upper() == 'HEAD' or (self.range is None and not zerocopy):
+            await super().__call__(scope, receive, send)
+            return
+
+        start, end = self.range or (0, self.stat_result.st_size - 1)
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        async with await anyio.open_file(self.path, mode='rb') as file:
+            if zerocopy:
+                await send({
+                    'type': 'http.response.zerocopysend',
+                    'file': file.wrapped,
+                    'offset': start,
+                    'count': end - start + 1,
+                })
+            else:
+                await file.seek(start)
+                remaining = end - start + 1
+                while remaining:
+                    chunk = await file.read(min(self.chunk_size, remaining))
+                    remaining -= len(chunk)
+                    more_body = bool(remaining and chunk)
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': more_body})
+                    if not more_body:
+                        break
+        if self.background is not None:
+            await self.background()
+
+
+class MediaFiles(StaticFiles):
+    """
+    StaticFiles with configurable "Cache-Control", byte range requests and,
+    with `precompressed`, ".br"/".gz" siblings served to clients accepting them.
+    Dotfiles and storage ".refs" sidecars are never served.
+    """
+
+    def __init__(self, *, cache_control: str | None = None, precompressed: bool = False, **kwargs):
+        super().__init__(**kwargs)
+        self.cache_control = cache_control
+        self.precompressed = precompressed
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        file_name = os.path.basename(path)
+        if file_name.startswith('.') or file_name.endswith('.refs'):
+            raise HTTPException(status_code=404)
+
+        if self.precompressed and scope['method'] in ('GET', 'HEAD'):
+            accept_encoding = Headers(scope=scope).get('accept-encoding', '')
+            accepted = {value.split(';')[0].strip() for value in accept_encoding.split(',')}
+            for encoding, suffix in PRECOMPRESSED_SUFFIXES.items():
+                if encoding not in accepted:
+                    continue
+                full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, path + suffix)
+                if stat_result and stat.S_ISREG(stat_result.st_mode):
+                    return self.file_response(
+                        full_path, stat_result, scope, encoding=encoding, media_type=guess_type(path)[0]
+                    )
+        return await super().get_response(path, scope)
+
+    def file_response(
+        self,
+        full_path: str,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+        encoding: str | None = None,
+        media_type: str | None = None,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        headers = {}
+        if self.cache_control:
+            headers['cache-control'] = self.cache_control
+        if self.precompressed:
+            headers['vary'] = 'Accept-Encoding'
+        if encoding:
+            headers['content-encoding'] = encoding
+
+        response = RangeFileResponse(
+            full_path, status_code=status_code, stat_result=stat_result, headers=headers, media_type=media_type
+        )
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        try:
+            response.set_range(request_headers)
+        except RangeNotSatisfiable:
+            return Response(
+                status_code=416, headers={**headers, 'content-range': f'bytes */{stat_result.st_size}'}
+            )
+        return response
+
+
+def precompress(directory: str, min_size: int = 1024) -> int:
+    """
+    Write ".gz" siblings of compressible files in `directory` served by `MediaFiles(precompressed=True)`,
+    skipping up-to-date ones and those not getting smaller. Return number of files written.
+    ".br" siblings are picked up too but have to be built by deployment tooling.
+    """
+    written = 0
+    for root, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            path = os.path.join(root, file_name)
+            if file_name.endswith(tuple(PRECOMPRESSED_SUFFIXES.values())):
+                continue
+            media_type = guess_type(path)[0] or ''
+            if not media_type.startswith(COMPRESSIBLE_TYPES) or os.path.getsize(path) < min_size:
+                continue
+            gz_path = path + '.gz'
+            if os.path.exists(gz_path) and os.path.getmtime(gz_path) >= os.path.getmtime(path):
+                continue
+            tmp_path = gz_path + '.tmp'
+            with open(path, 'rb') as source, gzip.GzipFile(tmp_path, 'wb', compresslevel=9, mtime=0) as target:
+                shutil.copyfileobj(source, target)
+            if os.path.getsize(tmp_path) < os.path.getsize(path):
+                os.replace(tmp_path, gz_path)
+                written += 1
+            else:
+                os.remove(tmp_path)
+    return written
@@ -0,0 +1,312 @@
+"""
+Request metrics exposed on `/metrics` in Prometheus text format.
+Values live in process memory, with several workers each one reports its own.
+"""
+import inspect
+import logging
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Awaitable, Callable
+
+from sqlalchemy import Engine, event
+from sqlalchemy.pool import QueuePool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def format_labels(labelnames: tuple[str, ...], labelvalues: tuple[str, ...], extra: str = '') -> str:
+    pairs = [
+        '{}="{}"'.format(name, value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in zip(labelnames, labelvalues)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}', *self.samples()])
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{format_labels(self.labelnames, labels)} {value}' for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Values read at scrape time instead of tracked
+        self.callbacks: dict[tuple[str, ...], Callable[[], float | None]] = {}
+
+    def dec(self, *labelvalues: str, amount: float = 1) -> None:
+        self.inc(*labelvalues, amount=-amount)
+
+    def set(self, value: float | None, *labelvalues: str) -> None:
+        """Set value, None drops the sample"""
+        if value is None:
+            self.values.pop(labelvalues, None)
+        else:
+            self.values[labelvalues] = value
+
+    def set_callback(self, callback: Callable[[], float | None], *labelvalues: str) -> None:
+        self.callbacks[labelvalues] = callback
+
+    def samples(self) -> list[str]:
+        samples = super().samples()
+        for labels, callback in self.callbacks.items():
+            value = callback()
+            if value is not None:  # Not known yet, e.g. ratio of nothing
+                samples.append(f'{self.name}{format_labels(self.labelnames, labels)} {value}')
+        return samples
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: tuple[float, ...] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = buckets
+        # Per labels: count of observations falling into each bucket (last one is +Inf) and their sum
+        self.values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        values = self.values.get(labelvalues)
+        if values is None:
+            values = self.values[labelvalues] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = values
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def samples(self) -> list[str]:
+        samples = []
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                bucket_labels = format_labels(self.labelnames, labels, 'le="{}"'.format(bound))
+                samples.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            samples.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {total[0]}')
+            samples.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}')
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+        # Update values which need I/O to be read, awaited before render
+        self.collectors: list[Callable[[], Awaitable[None]]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    async def collect(self) -> None:
+        for collector in self.collectors:
+            await collector()
+
+    def render(self) -> str:
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+registry = Registry()
+REQUESTS = registry.register(Counter(
+    'http_requests_total', 'Requests by route and status code', ('method', 'route', 'status')
+))
+REQUEST_DURATION = registry.register(Histogram(
+    'http_request_duration_seconds', 'Request latency including body streaming', ('method', 'route')
+))
+REQUESTS_IN_PROGRESS = registry.register(Gauge('http_requests_in_progress', 'Requests being processed'))
+REQUEST_DB_DURATION = registry.register(Histogram(
+    'http_request_db_duration_seconds', 'Time spent in DB queries per request', ('method', 'route')
+))
+REQUEST_DB_QUERIES = registry.register(Histogram(
+    'http_request_db_queries', 'DB queries per request', ('method', 'route'), buckets=QUERIES_BUCKETS
+))
+
+POOL_CHECKOUT_WAIT = registry.register(Histogram(
+    'db_pool_checkout_wait_seconds', 'Time to get a connection from the pool, connecting included'
+))
+POOL_TIMEOUTS = registry.register(Counter('db_pool_timeouts_total', 'Checkouts given up after DB_POOL_TIMEOUT'))
+
+
+POOL_SIZE = registry.register(Gauge('db_pool_size', 'Connections kept in the pool', ('engine',)))
+POOL_CHECKED_OUT = registry.register(Gauge('db_pool_checked_out', 'Connections in use', ('engine',)))
+POOL_OVERFLOW = registry.register(Gauge(
+    'db_pool_overflow', 'Connections opened above pool size, negative while pool is not filled yet', ('engine',)
+))
+
+
+def track_pool(pool: QueuePool, name: str) -> None:
+    """Report usage of pool of engine `name` at scrape time"""
+    POOL_SIZE.set_callback(pool.size, name)
+    POOL_CHECKED_OUT.set_callback(pool.checkedout, name)
+    POOL_OVERFLOW.set_callback(pool.overflow, name)
+
+
+CACHE_ENTRIES = registry.register(Gauge('cache_entries', 'Entries held by cache', ('cache',)))
+CACHE_HITS = registry.register(Gauge('cache_hits', 'Lookups served from cache since start', ('cache',)))
+CACHE_MISSES = registry.register(Gauge('cache_misses', 'Lookups not found in cache since start', ('cache',)))
+CACHE_EVICTIONS = registry.register(Gauge(
+    'cache_evictions', 'Entries evicted to stay within cache size since start', ('cache',)
+))
+CACHE_HIT_RATIO = registry.register(Gauge('cache_hit_ratio', 'Hits of all lookups since start', ('cache',)))
+
+
+def track_cache(name: str, stats: Callable[[], dict[str, int | None] | Awaitable[dict[str, int | None]]]) -> None:
+    """Report size, hits, misses and evictions returned by `stats` of cache `name` at scrape time"""
+    async def collect() -> None:
+        values = stats()
+        if inspect.isawaitable(values):
+            values = await values
+        hits, misses = values['hits'], values['misses']
+        CACHE_ENTRIES.set(values['size'], name)
+        CACHE_HITS.set(hits, name)
+        CACHE_MISSES.set(misses, name)
+        CACHE_EVICTIONS.set(values['evictions'], name)  # Unknown for some backends
+        CACHE_HIT_RATIO.set(hits / (hits + misses) if hits + misses else None, name)
+
+    registry.collectors.append(collect)
+
+
+class RequestStats:
+    MAX_STATEMENTS = 100
+
+    __slots__ = ('scope', 'queries', 'db_time', 'statements', '_tag')
+
+    def __init__(self, scope: Scope):
+        self.scope = scope
+        self.queries = 0
+        self.db_time = 0.0
+        self.statements: list[str] = []
+        self._tag: str | None = None
+
+    @property
+    def route(self) -> str:
+        return get_route_name(self.scope)
+
+    @property
+    def tag(self) -> str:
+        """SQL comment naming the route, route is matched by the time endpoint queries"""
+        if self._tag is None:
+            method = self.scope['method'] if self.scope['method'].isalpha() else 'UNKNOWN'
+            self._tag = f" /* route='{method} {self.route.replace('*/', '')}' */"
+        return self._tag
+
+
+# Stats of request being handled by current task, None outside of requests
+current_stats: ContextVar[RequestStats | None] = ContextVar('current_stats', default=None)
+# Called with stats of every finished request, used by tests to check query budgets
+request_observers: list[Callable[[RequestStats], None]] = []
+
+
+def track_queries(engine: Engine) -> None:
+    """Count queries and their time into `current_stats` and tag them with route, using engine events"""
+    @event.listens_for(engine, 'before_cursor_execute', retval=True)
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = current_stats.get()
+        if stats is not None:
+            if len(stats.statements) < stats.MAX_STATEMENTS:
+                stats.statements.append(statement)
+            if settings.QUERY_ROUTE_COMMENTS:
+                statement += stats.tag
+        # Kept on statement's context, so failed statements leave nothing behind on pooled connection
+        context._query_started_at = perf_counter()
+        return statement, parameters
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = current_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_time += perf_counter() - context._query_started_at
+
+
+def check_query_budget(stats: RequestStats) -> None:
+    """Log offending statements of a request which ran more queries than its route is allowed to"""
+    route = stats.route
+    budget = settings.QUERY_BUDGETS.get(route, settings.QUERY_BUDGET)
+    if stats.queries > budget:
+        logger.warning(
+            '%s %s ran %d queries, budget is %d:\n%s',
+            stats.scope['method'], route, stats.queries, budget, '\n'.join(stats.statements)
+        )
+
+
+def get_route_name(scope: Scope) -> str:
+    """Templated path of matched route, keeps label cardinality bounded"""
+    route = scope.get('route')
+    if route is not None:
+        return route.path
+    mount_path = scope.get('root_path', '')[len(scope.get('app_root_path', '')):]
+    if mount_path:
+        return f'{mount_path}/{{path}}'
+    return 'unmatched'
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, unlike `BaseHTTPMiddleware` it does not buffer or wrap streamed bodies"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        stats = RequestStats(scope)
+        token = current_stats.set(stats)
+        REQUESTS_IN_PROGRESS.inc()
+        started_at = perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = perf_counter() - started_at
+            REQUESTS_IN_PROGRESS.dec()
+            current_stats.reset(token)
+            method, route = scope['method'], get_route_name(scope)
+            REQUESTS.inc(method, route, str(status_code))
+            REQUEST_DURATION.observe(elapsed, method, route)
+            REQUEST_DB_DURATION.observe(stats.db_time, method, route)
+            REQUEST_DB_QUERIES.observe(stats.queries, method, route)
+            check_query_budget(stats)
+            for observer in request_observers:
+                observer(stats)
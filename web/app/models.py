@@ -1,27 +1,53 @@
 from sqlalchemy import (
     Column,
     Integer,
+    Float,
     String,
     ForeignKey,
-    Boolean
+    Boolean,
+    Index,
+    DDL,
+    event,
+    literal_column,
+    text
 )
-from sqlalchemy.orm import  relationship
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import  relationship, column_property
 from sqlalchemy.sql.sqltypes import TIMESTAMP, DATE
 from sqlalchemy.sql import func
 
 from .db import Base
 
 
+def has_pg_trgm(bind) -> bool:
+    """pg_trgm is a contrib extension and may be missing on some servers"""
+    return bind is not None and bool(
+        bind.scalar(text("SELECT count(*) FROM pg_available_extensions WHERE name = 'pg_trgm'"))
+    )
+
+
+def get_search_vector(title, content):
+    """
+    Weighted full-text document of a post. Text search config is inlined as a constant,
+    planner matches the expression index only against an identical expression.
+    """
+    config = literal_column("'english'::regconfig")
+    return func.setweight(func.to_tsvector(config, title), literal_column("'A'")) \
+        .op('||', return_type=TSVECTOR)(func.setweight(func.to_tsvector(config, content), literal_column("'B'")))
+
+
 class User(Base):
     __tablename__ = 'user'
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     email = Column(String, nullable=False, unique=True)
     password = Column(String, nullable=False)
     first_name = Column(String, nullable=False)
     birth_date = Column(DATE, nullable=False)
     profile_picture = Column(String(120), nullable=True)
+    followers_count = Column(Integer, server_default='0', nullable=False)
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=func.now())
+    updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.current_timestamp(), nullable=False)
 
     posts = relationship('Post', back_populates='user')
     likes = relationship('PostLike', back_populates='user')
@@ -30,17 +56,34 @@ class User(Base):
 class Post(Base):
     __tablename__ = 'post'
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
     title = Column(String, nullable=False)
     content = Column(String, nullable=False)
     is_active = Column(Boolean, server_default='TRUE', nullable=False)
+    likes_count = Column(Integer, server_default='0', nullable=False)
+    # Likes decayed by post age in log2 scale, see `services.trending_score`, 0 while post has no likes
+    trending_score = Column(Float, server_default='0', nullable=False)
     published_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.current_timestamp(), nullable=False)
+    # Computed on read instead of stored, ix_post_search_vector serves queries using this very expression
+    search_vector = column_property(get_search_vector(title, content), deferred=True)
 
     user = relationship(User, back_populates='posts')
     likes = relationship('PostLike', back_populates='post')
 
+    __table_args__ = (
+        Index('ix_post_published_at_id', published_at.desc(), id.desc()),
+        # Serves user's posts newest first and user delete cascade
+        Index('ix_post_user_id_published_at_id', user_id, published_at.desc(), id.desc()),
+        # Serves top trending posts, posts without likes are left out
+        Index('ix_post_trending_score', trending_score.desc(), id.desc(), postgresql_where=trending_score > 0),
+        Index('ix_post_search_vector', get_search_vector(title, content), postgresql_using='gin'),
+        # Serves substring (LIKE '%...%') search on title
+        Index('ix_post_title_trgm', title, postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'}) \
+            .ddl_if(callable_=lambda ddl, target, bind, **kw: has_pg_trgm(bind)),
+    )
+
 
 class PostLike(Base):
     __tablename__ = 'post_like'
@@ -50,3 +93,45 @@ class PostLike(Base):
 
     user = relationship(User, back_populates='likes')
     post = relationship(Post, back_populates='likes')
+
+    __table_args__ = (
+        # Primary key leads with post_id, likes of a user (user delete cascade) need their own index
+        Index('ix_post_like_user_id', user_id),
+    )
+
+
+class UserFollow(Base):
+    __tablename__ = 'user_follow'
+
+    follower_id = Column(Integer, ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    followee_id = Column(Integer, ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        # Primary key serves followees of a user, fan-out needs followers of an author
+        Index('ix_user_follow_followee_id', followee_id),
+    )
+
+
+class FeedItem(Base):
+    """
+    Post in precomputed home feed of a user, added when followed author publishes it.
+    Primary key order lets a page of feed be read with a single index range scan.
+    """
+    __tablename__ = 'feed_item'
+
+    user_id = Column(Integer, ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    published_at = Column(TIMESTAMP(timezone=True), primary_key=True)
+    post_id = Column(Integer, ForeignKey('post.id', ondelete='CASCADE'), primary_key=True)
+    author_id = Column(Integer, nullable=False)  # Lets unfollow drop author posts without joining post
+
+    __table_args__ = (
+        Index('ix_feed_item_post_id', post_id),  # Post delete cascade
+    )
+
+
+event.listen(
+    Post.__table__,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(callable_=lambda ddl, target, bind, **kw: has_pg_trgm(bind)),
+)
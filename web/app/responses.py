@@ -0,0 +1,22 @@
+from typing import Iterable
+
+from fastapi.responses import ORJSONResponse
+
+from .schemas import BaseModel
+
+
+class ORMListResponse(ORJSONResponse):
+    """
+    Response for hot list endpoints serializing ORM objects we loaded ourselves.
+    Only schema fields (or their `get_<field>` getters) are picked from each object
+    and dumped with orjson, skipping pydantic validation of every item.
+    Return annotation of route is still used for OpenAPI schema.
+    """
+
+    def __init__(self, objs: Iterable, schema: type[BaseModel], **kwargs):
+        fields = [(field, getattr(schema, f'get_{field}', None)) for field in schema.__fields__]
+        content = [
+            {field: getter(obj) if callable(getter) else getattr(obj, field) for field, getter in fields}
+            for obj in objs
+        ]
+        super().__init__(content, **kwargs)
@@ -0,0 +1,32 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
+
+from .. import models, schemas
+from .. import selectors
+from ..auth import get_current_user
+from ..db import get_read_db
+from ..responses import ORMListResponse
+from ..utils import encode_cursor, decode_cursor
+
+router = APIRouter(prefix='/feed', tags=['feed'])
+
+
+@router.get('/', status_code=status.HTTP_200_OK)
+async def get_feed(
+    limit: int = Query(default=20, ge=1, le=100, title='Limit', description='Limit the qty of posts items'),
+    cursor: str | None = Query(default=None, title='Cursor', description='Value of "X-Next-Cursor" header from the previous page'),
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+) -> list[schemas.PostOut]:
+    """Posts of followed users, newest first"""
+    position = None
+    if cursor:
+        position = decode_cursor(cursor, datetime, int)
+        if position is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+    posts = await selectors.get_feed(user_id=current_user.id, limit=limit, position=position, db=db)
+    headers = {}
+    if len(posts) == limit:
+        headers['X-Next-Cursor'] = encode_cursor(posts[-1].published_at, posts[-1].id)
+    return ORMListResponse(posts, schemas.PostOut, headers=headers)
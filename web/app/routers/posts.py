@@ -1,68 +1,265 @@
 from fastapi import (
     APIRouter,
+    BackgroundTasks,
+    Request,
     Response,
     HTTPException,
     Path, Query, Body,
     status,
     Depends, 
 )
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy import Select, select, update, delete, func, tuple_
+from datetime import datetime
+from typing import AsyncIterator
+import orjson
 
-from ..db import get_db
+from ..db import get_read_db, get_read_session_factory, get_session_factory, get_write_db, pinned_to_primary
+from ..config import settings
+from ..responses import ORMListResponse
+from ..cache import posts_cache
+from ..trending import trending_posts
 from ..auth import get_current_user
+from ..utils import encode_cursor, decode_cursor, make_etag, is_not_modified
+from ..services import create_posts, fan_out_posts, like_posts, unlike_posts, update_posts
 from .. import models, schemas
 
 router = APIRouter(prefix='/posts', tags=['posts'])
 
 
+def filter_posts(posts_query: Select, id: list[int] | None, title: str | None) -> Select:
+    """Apply filters shared by posts listing endpoints"""
+    if id:
+        posts_query = posts_query.where(models.Post.id.in_(id))
+    if title:
+        posts_query = posts_query.where(models.Post.title.contains(title))
+    return posts_query
+
+
+async def invalidate_posts_cache() -> None:
+    """Must be called after any change of posts or their likes"""
+    if posts_cache is not None:
+        await posts_cache.invalidate()
+
+
+async def fan_out(post_ids: list[int], session_factory: async_sessionmaker) -> None:
+    """Background task adding new posts to followers feeds once response is sent"""
+    async with session_factory() as db:
+        await fan_out_posts(post_ids=post_ids, db=db)
+        await db.commit()
+
+
+def get_post_etag(post: models.Post) -> str:
+    """Likes count is part of version as it changes without "updated_at" bump"""
+    return make_etag(post.id, post.updated_at.timestamp(), post.likes_count)
+
+
 @router.get('/', status_code=status.HTTP_200_OK)
 async def get_posts(
+    request: Request,
     id: list[int] | None = Query(default=None, title='Posts IDs', description='List of Posts IDs to retrieve'),
-    limit: int | None = Query(default=100, gte=1, le=10000, title='Limit', description='Limit the qty of posts items'),
-    offset: int | None = Query(default=0, gte=0, title='Offset', description='Post index to start retrieving from'),
+    limit: int | None = Query(default=100, ge=1, le=10000, title='Limit', description='Limit the qty of posts items'),
+    offset: int | None = Query(default=0, ge=0, title='Offset', description='Post index to start retrieving from'),
+    cursor: str | None = Query(
+        default=None, title='Cursor',
+        description='Value of "X-Next-Cursor" header from the previous page, takes precedence over offset'
+    ),
     title: str | None = Query(default=None),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ) -> list[schemas.PostOut]:
-    posts_query = db.query(models.Post, func.count(models.PostLike.post_id).label('likes_count')) \
-        .join(models.PostLike, models.PostLike.post_id == models.Post.id, isouter=True) \
-        .group_by(models.Post.id) \
-        .order_by(models.Post.published_at.desc())
-    if id:
-        posts_query = posts_query.filter(models.Post.id.in_(id))
-    if title:
-        posts_query = posts_query.filter(models.Post.title.contains(title))
-    posts = posts_query.offset(offset).limit(limit).all()
-    posts = [{**post.__dict__, 'likes_count': likes_count} for post, likes_count in posts]
-    return posts
+    # Offset is ignored in cursor mode and ids order does not change the result
+    cache_params = {'id': sorted(set(id or [])), 'limit': limit, 'offset': None if cursor else offset, 'cursor': cursor, 'title': title}
+    cache_key = None
+    # Page cached by others may come from a lagging replica, recent writer reads primary to see own writes
+    use_cache = posts_cache is not None and not pinned_to_primary(request)
+    if use_cache:
+        cache_key, cached = await posts_cache.get(cache_params)
+        if cached is not None:
+            body, headers = cached
+            if is_not_modified(request, headers['ETag']):
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={**headers, 'X-Cache': 'HIT'})
+            return Response(body, media_type='application/json', headers={**headers, 'X-Cache': 'HIT'})
+
+    posts_query = select(models.Post).order_by(models.Post.published_at.desc(), models.Post.id.desc())
+    posts_query = filter_posts(posts_query, id=id, title=title)
+    if cursor:
+        position = decode_cursor(cursor, datetime, int)
+        if position is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+        # Seek past the last row of previous page instead of scanning skipped rows
+        posts_query = posts_query.where(tuple_(models.Post.published_at, models.Post.id) < position)
+    else:
+        posts_query = posts_query.offset(offset)
+    posts_query = posts_query.limit(limit)
+
+    def get_page_headers(posts) -> dict[str, str]:
+        headers = {'ETag': make_etag(limit, *(get_post_etag(post) for post in posts))}
+        if posts and len(posts) == limit:
+            last_post = posts[-1]
+            headers['X-Next-Cursor'] = encode_cursor(last_post.published_at, last_post.id)
+        return headers
+
+    if 'if-none-match' in request.headers:
+        # Check page version against light rows before loading full posts
+        versions = (await db.execute(posts_query.with_only_columns(
+            models.Post.id, models.Post.published_at, models.Post.updated_at, models.Post.likes_count
+        ))).all()
+        headers = get_page_headers(versions)
+        if is_not_modified(request, headers['ETag']):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    posts = (await db.scalars(posts_query)).all()
+    headers = get_page_headers(posts)
+    response = ORMListResponse(posts, schemas.PostOut, headers=headers)
+    if use_cache:
+        await posts_cache.set(cache_key, response.body, headers)
+        response.headers['X-Cache'] = 'MISS'
+    return response
+
+
+@router.get('/export', status_code=status.HTTP_200_OK, response_class=StreamingResponse)
+async def export_posts(
+    id: list[int] | None = Query(default=None, title='Posts IDs', description='List of Posts IDs to retrieve'),
+    title: str | None = Query(default=None),
+    current_user: models.User = Depends(get_current_user),
+    session_factory: async_sessionmaker = Depends(get_read_session_factory),
+) -> StreamingResponse:
+    """Stream all matching posts as newline delimited JSON"""
+    fields = schemas.PostOut.__fields__
+    posts_query = select(*(getattr(models.Post, field) for field in fields)) \
+        .order_by(models.Post.published_at.desc(), models.Post.id.desc())
+    posts_query = filter_posts(posts_query, id=id, title=title)
+
+    async def stream_posts() -> AsyncIterator[bytes]:
+        # Session of request is closed before response is streamed, so own one is needed
+        async with session_factory() as db:
+            # Server-side cursor keeps only one batch of rows in memory
+            result = await db.stream(posts_query.execution_options(yield_per=settings.EXPORT_BATCH_SIZE))
+            async for rows in result.mappings().partitions():
+                yield b''.join(orjson.dumps(dict(row)) + b'\n' for row in rows)
+
+    return StreamingResponse(stream_posts(), media_type='application/x-ndjson')
+
+
+@router.get('/search', status_code=status.HTTP_200_OK)
+async def search_posts(
+    q: str = Query(min_length=1, title='Search query', description='Words to look for in posts titles and contents'),
+    limit: int | None = Query(default=100, ge=1, le=10000, title='Limit', description='Limit the qty of posts items'),
+    cursor: str | None = Query(default=None, title='Cursor', description='Value of "X-Next-Cursor" header from the previous page'),
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+) -> list[schemas.PostOut]:
+    """Full-text search over posts, most relevant first"""
+    query = func.websearch_to_tsquery('english', q)
+    rank = func.ts_rank_cd(models.Post.search_vector, query)
+    posts_query = select(models.Post, rank) \
+        .where(models.Post.search_vector.op('@@')(query)) \
+        .order_by(rank.desc(), models.Post.id.desc())
+    if cursor:
+        position = decode_cursor(cursor, float, int)
+        if position is None:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor')
+        posts_query = posts_query.where(tuple_(rank, models.Post.id) < position)
+    posts = (await db.execute(posts_query.limit(limit))).all()
+    headers = {}
+    if len(posts) == limit:
+        last_post, last_rank = posts[-1]
+        headers['X-Next-Cursor'] = encode_cursor(last_rank, last_post.id)
+    return ORMListResponse((post for post, _ in posts), schemas.PostOut, headers=headers)
+
+
+@router.get('/trending', status_code=status.HTTP_200_OK)
+async def get_trending_posts(
+    background_tasks: BackgroundTasks,
+    limit: int = Query(default=20, ge=1, le=settings.TRENDING_SIZE, title='Limit', description='Limit the qty of posts items'),
+    current_user: models.User = Depends(get_current_user),
+    session_factory: async_sessionmaker = Depends(get_read_session_factory),
+) -> list[schemas.PostOut]:
+    """Posts ranked by likes decayed with post age, served from memory and refreshed in background"""
+    if not trending_posts.is_loaded:
+        await trending_posts.refresh(session_factory)  # First request of a worker waits for the list
+    elif trending_posts.claim_refresh():
+        background_tasks.add_task(trending_posts.refresh, session_factory)
+    return ORMListResponse(trending_posts.get(limit), schemas.PostOut)
 
 
 @router.post('/', status_code=status.HTTP_201_CREATED)
 async def create_post(
+    background_tasks: BackgroundTasks,
     post_data: schemas.PostCreate = Body(),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_write_db),
+    session_factory: async_sessionmaker = Depends(get_session_factory),
 ) -> schemas.PostOut:
-    post_data = {**post_data.dict(), 'user': current_user}
+    post_data = {**post_data.dict(), 'user_id': current_user.id}
     post_obj = models.Post(**post_data)
     db.add(post_obj)
-    db.commit()
-    db.refresh(post_obj)
-    post_obj.likes_count = 0
+    await db.commit()
+    await invalidate_posts_cache()
+    await db.refresh(post_obj)
+    background_tasks.add_task(fan_out, [post_obj.id], session_factory)
     return post_obj
 
 
+@router.post('/bulk', status_code=status.HTTP_201_CREATED)
+async def bulk_create_posts(
+    background_tasks: BackgroundTasks,
+    posts_data: schemas.PostCreateBulk = Body(),
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db),
+    session_factory: async_sessionmaker = Depends(get_session_factory),
+) -> list[schemas.PostOut]:
+    """Create many posts at once, none is created if any of them is invalid"""
+    posts = await create_posts(posts=posts_data.posts, user_id=current_user.id, db=db)
+    await db.commit()
+    await invalidate_posts_cache()
+    background_tasks.add_task(fan_out, [post.id for post in posts], session_factory)
+    return ORMListResponse(posts, schemas.PostOut, status_code=status.HTTP_201_CREATED)
+
+
+@router.patch('/bulk', status_code=status.HTTP_200_OK)
+async def bulk_update_posts(
+    posts_data: schemas.PostUpdateBulk = Body(),
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+) -> list[schemas.PostOut]:
+    """Update many posts at once, none is updated if any of them is not found"""
+    posts = await update_posts(posts=posts_data.posts, user_id=current_user.id, db=db)
+    if len(posts) < len(posts_data.posts):
+        updated_ids = {post.id for post in posts}
+        await db.rollback()
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=[
+            {'loc': ['body', 'posts', index, 'id'], 'msg': 'Post not found', 'type': 'not_found'}
+            for index, post in enumerate(posts_data.posts) if post.id not in updated_ids
+        ])
+    await db.commit()
+    await invalidate_posts_cache()
+    posts_by_id = {post.id: post for post in posts}
+    return ORMListResponse((posts_by_id[post.id] for post in posts_data.posts), schemas.PostOut)
+
+
 @router.get('/{id}', status_code=status.HTTP_200_OK)
 async def get_post(
+    request: Request,
+    response: Response,
     id: int = Path(title='Post ID', description='ID of the post to retrieve'),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_read_db),
 ) -> schemas.PostOut:
-    post_obj = db.query(models.Post).filter(models.Post.id == id).first()
+    if 'if-none-match' in request.headers:
+        # Check version before loading full row
+        version = (await db.execute(
+            select(models.Post.id, models.Post.updated_at, models.Post.likes_count).where(models.Post.id == id)
+        )).first()
+        if version is not None:
+            etag = get_post_etag(version)
+            if is_not_modified(request, etag):
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+    post_obj = await db.scalar(select(models.Post).where(models.Post.id == id))
     if post_obj is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Post not found')
-    post_obj.likes_count = db.query(models.PostLike).filter(models.PostLike.post_id == id).count()
+    response.headers['ETag'] = get_post_etag(post_obj)
     return post_obj
 
 
@@ -71,15 +268,19 @@ async def update_post(
     id: int = Path(title='Post ID', description='ID of the post to update'),
     post_data: schemas.PostUpdate = Body(),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_write_db)
 ) -> schemas.PostOut:
-    post_query = db.query(models.Post).filter(models.Post.id == id, models.Post.user_id == current_user.id)
-    if post_query.first() is None:
+    # Single round trip, updated row is loaded back with RETURNING
+    post_obj = await db.scalar(
+        update(models.Post)
+        .where(models.Post.id == id, models.Post.user_id == current_user.id)
+        .values(**post_data.dict(exclude_unset=True))
+        .returning(models.Post)
+    )
+    if post_obj is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Post not found')
-    post_query.update(post_data.dict(exclude_unset=True))
-    db.commit()
-    post_obj = post_query.first()
-    post_obj.likes_count = db.query(models.PostLike).filter(models.PostLike.post_id == id).count()
+    await db.commit()
+    await invalidate_posts_cache()
     return post_obj
 
 
@@ -87,40 +288,48 @@ async def update_post(
 async def delete_post(
     id: int = Path(title='Post ID', description='ID of the post to delete'),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_write_db)
 ) -> None:
-    post_deleted = db.query(models.Post). \
-        filter(models.Post.id == id, models.Post.user_id == current_user.id).delete()
-    if not post_deleted:
+    result = await db.execute(
+        delete(models.Post).where(models.Post.id == id, models.Post.user_id == current_user.id)
+    )
+    if not result.rowcount:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Post not found')
-    db.commit()
+    await db.commit()
+    await invalidate_posts_cache()
+    trending_posts.discard(id)
     return None
 
 
+@router.post('/likes', status_code=status.HTTP_200_OK)
+async def bulk_like_posts(
+    likes_data: schemas.PostLikesBulk = Body(),
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+) -> schemas.PostLikesBulkOut:
+    """Like or unlike many posts at once, report ids of posts which state changed"""
+    if likes_data.action == 'like':
+        _, changed = await like_posts(post_ids=likes_data.post_ids, user_id=current_user.id, db=db)
+    else:
+        changed = await unlike_posts(post_ids=likes_data.post_ids, user_id=current_user.id, db=db)
+    await db.commit()
+    await invalidate_posts_cache()
+    return {'changed': sorted(changed)}
+
+
 @router.post('/{post_id}/like', status_code=status.HTTP_201_CREATED)
 async def like_post(
     post_id: int = Path(title='Post ID', description='ID of the post to like'),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_write_db)
 ) -> None:
-    # Check if provided post exists
-    post_obj = db.query(models.Post).filter(models.Post.id == post_id, models.Post.is_active == True).first()
-    if not post_obj:
+    found, liked = await like_posts(post_ids=[post_id], user_id=current_user.id, db=db)
+    if not found:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Post not found')
-
-    # Check if like for this post and this user already exists 
-    like_obj: bool = db.query(models.PostLike).filter(
-        models.PostLike.post_id == post_id,
-        models.PostLike.user_id == current_user.id
-    ).first()
-    if like_obj:
+    if not liked:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Like already exists')
-
-    # Create PostLike object
-    like_obj = models.PostLike(post=post_obj, user=current_user)
-    db.add(like_obj)
-    db.commit()
-    db.refresh(like_obj)
+    await db.commit()
+    await invalidate_posts_cache()
     return Response(status_code=status.HTTP_201_CREATED)
 
 
@@ -128,11 +337,10 @@ async def like_post(
 async def unlike_post(
     post_id: int = Path(title='Post ID', description='ID of the post to unlike'),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_write_db)
 ) -> None:
-    like_query = db.query(models.PostLike).filter(models.PostLike.post_id == post_id, models.PostLike.user == current_user)
-    if not like_query.first():
+    if not await unlike_posts(post_ids=[post_id], user_id=current_user.id, db=db):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Like not found')
-    like_query.delete()
-    db.commit()
+    await db.commit()
+    await invalidate_posts_cache()
     return None
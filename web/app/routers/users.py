@@ -2,42 +2,104 @@ from fastapi import (
     APIRouter,
     Depends,
     HTTPException,
+    Path,
+    Request,
     status,
     Body,
-    UploadFile
+    UploadFile,
+    params,
 )
+from fastapi.routing import APIRoute
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
 from fastapi.responses import Response, JSONResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
+from starlette.types import Message
+from typing import Any, Callable, Coroutine
 
 from .. import models, schemas
 from .. import selectors
-from ..db import get_db
-from ..utils import hash_password, verify_password
-from ..auth import create_access_token, get_current_user
-from ..storages import local_storage
+from ..config import settings
+from ..db import get_read_db, get_write_db
+from ..utils import hash_password_async, verify_password_async, make_etag, http_date, is_not_modified
+from ..auth import create_access_token, get_current_user, invalidate_cached_user
+from ..services import follow_user, unfollow_user
+from ..storages import local_storage, UploadTooLarge
 
-router = APIRouter(prefix='/users', tags=['users'])
+# Multipart boundaries and part headers allowed on top of MAX_UPLOAD_SIZE when body size is checked
+MULTIPART_OVERHEAD = 16 * 1024
+
+
+def picture_too_large() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f'Picture size exceeds {settings.MAX_UPLOAD_SIZE} bytes.',
+    )
+
+
+class UploadRoute(APIRoute):
+    """
+    Route rejecting file uploads above MAX_UPLOAD_SIZE before multipart body is parsed and spooled to disk:
+    by declared Content-Length, and by counting received bytes when it is missing or understated.
+    Exact file size is still checked while the file is saved.
+    """
+
+    def get_route_handler(self) -> Callable[[Request], Coroutine[Any, Any, Response]]:
+        handler = super().get_route_handler()
+        if not any(isinstance(param.field_info, params.File) for param in self.dependant.body_params):
+            return handler
+
+        async def limited_handler(request: Request) -> Response:
+            max_size = settings.MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD
+            content_length = request.headers.get('content-length', '')
+            if content_length.isdigit() and int(content_length) > max_size:
+                raise picture_too_large()
+            receive = request.receive
+            received = 0
+
+            async def limited_receive() -> Message:
+                nonlocal received
+                message = await receive()
+                if message['type'] == 'http.request':
+                    received += len(message.get('body', b''))
+                    if received > max_size:
+                        raise picture_too_large()  # Passed through by body parsing, unlike other errors
+                return message
+
+            request._receive = limited_receive
+            return await handler(request)
+
+        return limited_handler
+
+
+router = APIRouter(prefix='/users', tags=['users'], route_class=UploadRoute)
+
+
+def get_user_validators(id: int, updated_at: datetime, profile_picture: str | None) -> dict[str, str]:
+    # Avatar derivatives appear in background without touching the row
+    derivatives = sorted(local_storage.get_user_image_derivatives(profile_picture)) if profile_picture else []
+    return {'ETag': make_etag(id, updated_at.timestamp(), *derivatives), 'Last-Modified': http_date(updated_at)}
 
 
 @router.post('/', status_code=status.HTTP_201_CREATED)
-def register(user: schemas.UserCreate, db: Session = Depends(get_db)) -> schemas.UserOut:
+async def register(user: schemas.UserCreate, db: AsyncSession = Depends(get_write_db)) -> schemas.UserOut:
     """Register user account"""
-    if db.query(models.User).filter(models.User.email == user.email).first():
+    if await db.scalar(select(models.User).where(models.User.email == user.email)):
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='User with this email already exists')
-    user.password = hash_password(user.password)
+    user.password = await hash_password_async(user.password)
     user_obj = models.User(**user.dict())
     db.add(user_obj)
-    db.commit()
-    db.refresh(user_obj)
+    await db.commit()
+    await db.refresh(user_obj)
     return user_obj
 
 
 @router.post('/login/', status_code=status.HTTP_200_OK)
-def login(credentials: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)) -> schemas.Token:
+async def login(credentials: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_write_db)) -> schemas.Token:
     """Login with email and password"""
-    user_obj = db.query(models.User).filter(models.User.email == credentials.username).first()
-    if user_obj and verify_password(plain=credentials.password, hashed=user_obj.password):
+    user_obj = await db.scalar(select(models.User).where(models.User.email == credentials.username))
+    if user_obj and await verify_password_async(plain=credentials.password, hashed=user_obj.password):
         return {
             'access_token': create_access_token(user_id=user_obj.id),
             'type': 'bearer'
@@ -46,49 +108,65 @@ def login(credentials: OAuth2PasswordRequestForm = Depends(), db: Session = Depe
 
 
 @router.get('/{id}', status_code=status.HTTP_200_OK)
-def get_user(
+async def get_user(
     id: int,
+    request: Request,
+    response: Response,
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ) -> schemas.UserOut:
     """Retrieve user data"""
-    user_obj = selectors.get_user(id=id, db=db)
+    if 'if-none-match' in request.headers or 'if-modified-since' in request.headers:
+        # Check version before loading full row
+        version = (await db.execute(
+            select(models.User.updated_at, models.User.profile_picture).where(models.User.id == id)
+        )).first()
+        if version is not None:
+            validators = get_user_validators(id, *version)
+            if is_not_modified(request, validators['ETag'], last_modified=version.updated_at):
+                return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=validators)
+    user_obj = await selectors.get_user(id=id, db=db)
     if not user_obj:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
+    response.headers.update(get_user_validators(user_obj.id, user_obj.updated_at, user_obj.profile_picture))
     return user_obj
 
 
 @router.patch('/', status_code=status.HTTP_200_OK)
-def update_user(
+async def update_user(
     user_data: schemas.UserUpdate = Body(),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_write_db)
 ) -> schemas.UserOut:
     """Update user profile"""
-    user_query = db.query(models.User).filter(models.User.id == current_user.id)
     user_data = user_data.dict(exclude_unset=True)
     if user_data:
-        user_query.update(user_data)
-        db.commit()
-    user_obj = user_query.first()
-    return user_obj
+        await db.execute(update(models.User).where(models.User.id == current_user.id).values(**user_data))
+        await db.commit()
+        invalidate_cached_user(current_user.id)
+    return current_user
 
 
 @router.post('/picture', status_code=status.HTTP_200_OK)
 async def upload_picture(
     file: UploadFile,
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_write_db),
 ) -> schemas.Status:
     """Upload new user profile picture and delete current if set"""
     current_picture_name = current_user.profile_picture
-    new_picture_name = await local_storage.upload_user_image(file=file)
+    try:
+        new_picture_name = await local_storage.upload_user_image(file=file)
+    except UploadTooLarge:
+        raise picture_too_large()
 
     if new_picture_name is not None:
         if current_picture_name is not None:
             await local_storage.delete_user_image(file_name=current_user.profile_picture)
         current_user.profile_picture = new_picture_name
-        db.commit()
+        await db.commit()
+        invalidate_cached_user(current_user.id)
+        local_storage.schedule_user_image_derivatives(file_name=new_picture_name)
         return {'status': True}
 
     return JSONResponse({'detail': 'Error uploading picture.'}, status_code=status.HTTP_400_BAD_REQUEST)
@@ -97,10 +175,42 @@ async def upload_picture(
 @router.delete('/picture', status_code=status.HTTP_204_NO_CONTENT)
 async def delete_picture(
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_write_db),
 ) -> None:
     """Delete current user profile picture"""
     if current_user.profile_picture:
         await local_storage.delete_user_image(file_name=current_user.profile_picture)
         current_user.profile_picture = None
-        db.commit()
+        await db.commit()
+        invalidate_cached_user(current_user.id)
+
+
+@router.post('/{id}/follow', status_code=status.HTTP_201_CREATED)
+async def follow(
+    id: int = Path(title='User ID', description='ID of the user to follow'),
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+) -> None:
+    """Follow user, their posts show up in the feed"""
+    if id == current_user.id:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Cannot follow yourself')
+    found, followed = await follow_user(followee_id=id, follower_id=current_user.id, db=db)
+    if not found:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='User not found')
+    if not followed:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail='Follow already exists')
+    await db.commit()
+    return Response(status_code=status.HTTP_201_CREATED)
+
+
+@router.post('/{id}/unfollow', status_code=status.HTTP_204_NO_CONTENT)
+async def unfollow(
+    id: int = Path(title='User ID', description='ID of the user to unfollow'),
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_write_db)
+) -> None:
+    """Unfollow user and remove their posts from the feed"""
+    if not await unfollow_user(followee_id=id, follower_id=current_user.id, db=db):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Follow not found')
+    await db.commit()
+    return None
@@ -1,22 +1,43 @@
 from pydantic import BaseModel, Field, validator, EmailStr
-from copy import deepcopy
 from datetime import datetime, date
+from typing import Any, Literal
 
 from app.config import settings
+from app.storages import local_storage
+
+
+class GetterProxy:
+    """
+    Read-only view of an object with some attributes replaced by computed values,
+    lets getters be applied without copying or mutating the source object.
+    """
+    __slots__ = ('_obj', '_computed')
+
+    def __init__(self, obj: Any):
+        self._obj = obj
+        self._computed: dict[str, Any] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        computed = self._computed
+        if name in computed:
+            return computed[name]
+        return getattr(self._obj, name)
 
 
 class BaseModel(BaseModel):
     @classmethod
     def from_orm(cls, obj, getter_binding=None):
         getter_binding = getter_binding or {}
-        obj = deepcopy(obj)
+        proxy = None
         for field in cls.__fields__:
             method = getter_binding.get(field)
             if method is None:
                 method = getattr(cls, f"get_{field}", None)
             if method is not None and callable(method):
-                setattr(obj, field, method(obj))
-        return super().from_orm(obj)
+                proxy = proxy or GetterProxy(obj)
+                # Getters of following fields see values computed so far
+                proxy._computed[field] = method(proxy)
+        return super().from_orm(proxy or obj)
 
 
 class Status(BaseModel):
@@ -57,11 +78,23 @@ class UserUpdate(UserBase):
 class UserOut(UserBase):
     id: int
     email: EmailStr
+    profile_picture_sizes: dict[int, str] | None  # Before `profile_picture` so its getter sees file name
     profile_picture: str | None
 
     class Config:
         orm_mode = True
 
+    @staticmethod
+    def get_profile_picture_sizes(obj):
+        """Avatar URLs by size, original image is used until derivatives are generated"""
+        profile_pic_name = obj.profile_picture
+        if profile_pic_name is not None:
+            derivatives = local_storage.get_user_image_derivatives(profile_pic_name)
+            return {
+                size: f'{settings.HOSTNAME}/media/images/{derivatives.get(size, profile_pic_name)}'
+                for size in settings.AVATAR_SIZES
+            }
+
     @staticmethod
     def get_profile_picture(obj):
         profile_pic_name = obj.profile_picture
@@ -101,6 +134,24 @@ class PostUpdate(BasePost):
     is_active: bool | None
 
 
+class PostUpdateBulkItem(PostUpdate):
+    id: int = Field(description='ID of the post to update')
+
+
+class PostCreateBulk(BaseModel):
+    posts: list[PostCreate] = Field(min_items=1, max_items=1000)
+
+
+class PostUpdateBulk(BaseModel):
+    posts: list[PostUpdateBulkItem] = Field(min_items=1, max_items=1000)
+
+    @validator('posts')
+    def validate_unique_ids(cls, posts: list[PostUpdateBulkItem]) -> list[PostUpdateBulkItem]:
+        if len({post.id for post in posts}) != len(posts):
+            raise ValueError('Post IDs must be unique')
+        return posts
+
+
 class PostOut(BasePost):
     id: int | None
     user_id: int 
@@ -111,3 +162,12 @@ class PostOut(BasePost):
 
     class Config:
         orm_mode = True
+
+
+class PostLikesBulk(BaseModel):
+    action: Literal['like', 'unlike']
+    post_ids: list[int] = Field(min_items=1, max_items=1000, unique_items=True)
+
+
+class PostLikesBulkOut(BaseModel):
+    changed: list[int]
@@ -1,8 +1,59 @@
-from sqlalchemy.orm import Session
+from datetime import datetime
+
+from sqlalchemy import select, true, tuple_, union
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from . import models
+from .config import settings
 
 
-def get_user(id: int| str, db: Session | None = None) -> models.User | None:
-    user_obj = db.query(models.User).filter(models.User.id == id).first()
+async def get_user(id: int, db: AsyncSession | None = None) -> models.User | None:
+    user_obj = await db.scalar(select(models.User).where(models.User.id == id))
     return user_obj
+
+
+async def get_feed(user_id: int, limit: int, position: tuple[datetime, int] | None, db: AsyncSession) -> list[models.Post]:
+    """
+    Page of user home feed, newest first, starting after (published_at, id) `position`.
+    Precomputed feed is read with a single range scan of `feed_item` primary key, posts of followed
+    authors too popular to be fanned out are merged in with a range scan of their posts each.
+    """
+    timeline = select(models.FeedItem.post_id, models.FeedItem.published_at) \
+        .where(models.FeedItem.user_id == user_id) \
+        .order_by(models.FeedItem.published_at.desc(), models.FeedItem.post_id.desc()) \
+        .limit(limit)
+    popular_followees = select(models.UserFollow.followee_id) \
+        .join(models.User, models.User.id == models.UserFollow.followee_id) \
+        .where(models.UserFollow.follower_id == user_id, models.User.followers_count > settings.FEED_FANOUT_MAX_FOLLOWERS) \
+        .cte('popular_followees') \
+        .prefix_with('MATERIALIZED')  # Keeps planner from reading posts of every followee before filtering
+    popular_posts = select(models.Post.id, models.Post.published_at) \
+        .where(models.Post.user_id == popular_followees.c.followee_id) \
+        .order_by(models.Post.published_at.desc(), models.Post.id.desc()) \
+        .limit(limit)
+    if position is not None:
+        timeline = timeline.where(tuple_(models.FeedItem.published_at, models.FeedItem.post_id) < position)
+        popular_posts = popular_posts.where(tuple_(models.Post.published_at, models.Post.id) < position)
+    popular_posts = popular_posts.lateral('popular_posts')
+    # Posts fanned out before their author became popular are in both, UNION drops duplicates
+    page = union(
+        select(timeline.subquery()),
+        select(popular_posts.c.id, popular_posts.c.published_at).select_from(popular_followees).join(popular_posts, true()),
+    ).subquery('page')
+    posts = await db.scalars(
+        select(models.Post)
+        .join(page, models.Post.id == page.c.post_id)
+        .order_by(page.c.published_at.desc(), page.c.post_id.desc())
+        .limit(limit)
+    )
+    return list(posts)
+
+
+async def get_trending_posts(limit: int, db: AsyncSession) -> list[models.Post]:
+    """Active posts with highest `trending_score`, read from partial index of liked posts"""
+    return list(await db.scalars(
+        select(models.Post)
+        .where(models.Post.trending_score > 0, models.Post.is_active == True)
+        .order_by(models.Post.trending_score.desc(), models.Post.id.desc())
+        .limit(limit)
+    ))
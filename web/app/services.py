@@ -0,0 +1,272 @@
+import logging
+
+from sqlalchemy import Boolean, Integer, Select, String, case, cast, column, func, literal, select, true, update, delete, values
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models, schemas
+from .config import settings
+from .storages import local_storage
+
+
+def trending_score(likes_count):
+    """
+    SQL expression of `Post.trending_score` for given likes count: log2(likes) + published_at / half-life.
+    Ranks posts same as likes halved every TRENDING_HALF_LIFE_HOURS of post age would at any moment,
+    as the current time term is common to all posts, so stored scores never need decaying.
+    """
+    half_life = settings.TRENDING_HALF_LIFE_HOURS * 3600
+    return case(
+        (likes_count > 0, func.log(2, likes_count) + func.extract('epoch', models.Post.published_at) / half_life),
+        else_=0,
+    )
+
+
+def _shift_likes_count(post_ids, delta: int):
+    """UPDATE of denormalized `Post.likes_count` and `Post.trending_score` returning ids of changed posts"""
+    return update(models.Post) \
+        .where(models.Post.id.in_(post_ids)) \
+        .values(
+            likes_count=models.Post.likes_count + delta,
+            trending_score=trending_score(models.Post.likes_count + delta),
+            updated_at=models.Post.updated_at,
+        ) \
+        .returning(models.Post.id)  # Keep "updated_at" untouched as likes do not modify post content
+
+
+async def like_posts(post_ids: list[int], user_id: int, db: AsyncSession) -> tuple[set[int], set[int]]:
+    """
+    Like active posts and bump their counters in a single statement, caller is responsible for commit.
+    Return ids of posts found and ids of posts that were not liked by user before.
+    """
+    found = select(models.Post.id, literal(user_id, Integer).label('user_id')) \
+        .where(models.Post.id.in_(post_ids), models.Post.is_active == True) \
+        .cte('found')
+    inserted = insert(models.PostLike) \
+        .from_select(['post_id', 'user_id'], select(found.c.id, found.c.user_id)) \
+        .on_conflict_do_nothing() \
+        .returning(models.PostLike.post_id) \
+        .cte('inserted')
+    updated = _shift_likes_count(select(inserted.c.post_id), delta=1).cte('updated')
+    rows = (await db.execute(
+        select(found.c.id, updated.c.id).join(updated, updated.c.id == found.c.id, isouter=True)
+    )).all()
+    return {found_id for found_id, _ in rows}, {liked_id for _, liked_id in rows if liked_id is not None}
+
+
+async def unlike_posts(post_ids: list[int], user_id: int, db: AsyncSession) -> set[int]:
+    """
+    Remove user likes and decrement counters in a single statement, caller is responsible for commit.
+    Return ids of posts that were actually unliked.
+    """
+    deleted = delete(models.PostLike) \
+        .where(models.PostLike.post_id.in_(post_ids), models.PostLike.user_id == user_id) \
+        .returning(models.PostLike.post_id) \
+        .cte('deleted')
+    updated = _shift_likes_count(select(deleted.c.post_id), delta=-1).cte('updated')
+    return set((await db.scalars(select(updated.c.id))).all())
+
+
+async def create_posts(posts: list[schemas.PostCreate], user_id: int, db: AsyncSession) -> list[models.Post]:
+    """
+    Insert posts with multi-row INSERT ... RETURNING, caller is responsible for commit.
+    Return created posts in order of `posts`.
+    """
+    rows = [{**post.dict(), 'user_id': user_id} for post in posts]
+    return list(await db.scalars(insert(models.Post).returning(models.Post, sort_by_parameter_order=True), rows))
+
+
+async def update_posts(posts: list[schemas.PostUpdateBulkItem], user_id: int, db: AsyncSession) -> list[models.Post]:
+    """
+    Apply changes of user posts with a single UPDATE ... FROM (VALUES ...), caller is responsible for commit.
+    Fields not set or set to null are left untouched. Return updated posts, ones not found or not owned are missing.
+    """
+    changes = values(
+        column('id', Integer), column('title', String), column('content', String), column('is_active', Boolean),
+        name='changes',
+    ).data([(post.id, post.title, post.content, post.is_active) for post in posts])
+    return list(await db.scalars(
+        update(models.Post)
+        .where(models.Post.id == changes.c.id, models.Post.user_id == user_id)
+        .values(
+            # Nulls are sent as untyped literals, column made of them only would be text
+            title=func.coalesce(cast(changes.c.title, String), models.Post.title),
+            content=func.coalesce(cast(changes.c.content, String), models.Post.content),
+            is_active=func.coalesce(cast(changes.c.is_active, Boolean), models.Post.is_active),
+        )
+        .returning(models.Post)
+        .execution_options(synchronize_session=False)
+    ))
+
+
+def _shift_followers_count(user_ids, delta: int):
+    """UPDATE of denormalized `User.followers_count` returning ids of changed users"""
+    return update(models.User) \
+        .where(models.User.id.in_(user_ids)) \
+        .values(followers_count=models.User.followers_count + delta, updated_at=models.User.updated_at) \
+        .returning(models.User.id)  # Followers are not part of user profile version
+
+
+def _fan_out_followees(follows: Select):
+    """
+    INSERT of recent posts of followees into feeds of followers, from (follower_id, followee_id) rows.
+    Authors having more than `FEED_FANOUT_MAX_FOLLOWERS` followers are skipped, their posts are merged on read.
+    """
+    follows = follows.subquery('follows')
+    recent_posts = select(models.Post.id, models.Post.user_id, models.Post.published_at) \
+        .where(models.Post.user_id == follows.c.followee_id) \
+        .order_by(models.Post.published_at.desc(), models.Post.id.desc()) \
+        .limit(settings.FEED_BACKFILL_POSTS) \
+        .lateral('recent_posts')
+    feed_items = select(follows.c.follower_id, recent_posts.c.published_at, recent_posts.c.id, recent_posts.c.user_id) \
+        .select_from(follows) \
+        .join(models.User, models.User.id == follows.c.followee_id) \
+        .join(recent_posts, true()) \
+        .where(models.User.followers_count <= settings.FEED_FANOUT_MAX_FOLLOWERS)
+    return insert(models.FeedItem) \
+        .from_select(['user_id', 'published_at', 'post_id', 'author_id'], feed_items) \
+        .on_conflict_do_nothing()
+
+
+async def follow_user(followee_id: int, follower_id: int, db: AsyncSession) -> tuple[bool, bool]:
+    """
+    Follow user, bump their counter and add their recent posts to follower's feed, caller is responsible for commit.
+    Return whether followee was found and whether they were not followed before.
+    """
+    found = select(models.User.id).where(models.User.id == followee_id).cte('found')
+    inserted = insert(models.UserFollow) \
+        .from_select(['follower_id', 'followee_id'], select(literal(follower_id, Integer), found.c.id)) \
+        .on_conflict_do_nothing() \
+        .returning(models.UserFollow.followee_id) \
+        .cte('inserted')
+    updated = _shift_followers_count(select(inserted.c.followee_id), delta=1).cte('updated')
+    row = (await db.execute(select(found.c.id, updated.c.id).join(updated, updated.c.id == found.c.id, isouter=True))).first()
+    if row is None or row[1] is None:
+        return row is not None, False
+    await db.execute(_fan_out_followees(
+        select(models.UserFollow.follower_id, models.UserFollow.followee_id)
+        .where(models.UserFollow.follower_id == follower_id, models.UserFollow.followee_id == followee_id)
+    ))
+    return True, True
+
+
+async def unfollow_user(followee_id: int, follower_id: int, db: AsyncSession) -> bool:
+    """
+    Unfollow user, decrement their counter and drop their posts from follower's feed, caller is responsible for commit.
+    Return whether user was followed.
+    """
+    deleted = delete(models.UserFollow) \
+        .where(models.UserFollow.follower_id == follower_id, models.UserFollow.followee_id == followee_id) \
+        .returning(models.UserFollow.followee_id) \
+        .cte('deleted')
+    updated = _shift_followers_count(select(deleted.c.followee_id), delta=-1).cte('updated')
+    if await db.scalar(select(updated.c.id)) is None:
+        return False
+    await db.execute(
+        delete(models.FeedItem).where(models.FeedItem.user_id == follower_id, models.FeedItem.author_id == followee_id)
+    )
+    return True
+
+
+async def fan_out_posts(post_ids: list[int], db: AsyncSession) -> int:
+    """
+    Add new posts to feeds of their authors' followers with a single INSERT ... SELECT, caller is responsible for commit.
+    Authors having more than `FEED_FANOUT_MAX_FOLLOWERS` followers are skipped. Return number of feed items added.
+    """
+    feed_items = select(
+        models.UserFollow.follower_id, models.Post.published_at, models.Post.id, models.Post.user_id
+    ) \
+        .join(models.UserFollow, models.UserFollow.followee_id == models.Post.user_id) \
+        .join(models.User, models.User.id == models.Post.user_id) \
+        .where(models.Post.id.in_(post_ids), models.User.followers_count <= settings.FEED_FANOUT_MAX_FOLLOWERS)
+    result = await db.execute(
+        insert(models.FeedItem)
+        .from_select(['user_id', 'published_at', 'post_id', 'author_id'], feed_items)
+        .on_conflict_do_nothing()
+    )
+    return result.rowcount
+
+
+async def rebuild_feeds(db: AsyncSession) -> int:
+    """
+    Recalculate `User.followers_count` and add recent posts of all followees to feeds,
+    recovers fan-outs lost with a crashed worker. Return number of feed items added.
+    """
+    actual_counts = select(models.User.id, func.count(models.UserFollow.follower_id).label('followers_count')) \
+        .join(models.UserFollow, models.UserFollow.followee_id == models.User.id, isouter=True) \
+        .group_by(models.User.id) \
+        .subquery()
+    await db.execute(
+        update(models.User)
+        .where(models.User.id == actual_counts.c.id, models.User.followers_count != actual_counts.c.followers_count)
+        .values(followers_count=actual_counts.c.followers_count, updated_at=models.User.updated_at)
+        .execution_options(synchronize_session=False)
+    )
+    result = await db.execute(_fan_out_followees(select(models.UserFollow.follower_id, models.UserFollow.followee_id)))
+    await db.commit()
+    return result.rowcount
+
+
+async def reconcile_likes_count(db: AsyncSession) -> int:
+    """Recalculate `Post.likes_count` from `post_like` rows, return number of fixed posts"""
+    actual_counts = select(models.Post.id, func.count(models.PostLike.post_id).label('likes_count')) \
+        .join(models.PostLike, models.PostLike.post_id == models.Post.id, isouter=True) \
+        .group_by(models.Post.id) \
+        .subquery()
+    result = await db.execute(
+        update(models.Post)
+        .where(models.Post.id == actual_counts.c.id, models.Post.likes_count != actual_counts.c.likes_count)
+        .values(
+            likes_count=actual_counts.c.likes_count,
+            trending_score=trending_score(actual_counts.c.likes_count),
+            updated_at=models.Post.updated_at,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def recalculate_trending_scores(db: AsyncSession) -> int:
+    """Recompute `Post.trending_score` of liked posts, needed after TRENDING_HALF_LIFE_HOURS change"""
+    result = await db.execute(
+        update(models.Post)
+        .where(models.Post.trending_score > 0)
+        .values(trending_score=trending_score(models.Post.likes_count), updated_at=models.Post.updated_at)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
+    return result.rowcount
+
+
+async def migrate_user_images(db: AsyncSession) -> int:
+    """
+    Move uuid-named profile pictures to content-addressed storage rewriting `User.profile_picture`.
+    Safe to rerun as migrated pictures are skipped. Return number of migrated users.
+    """
+    users = (await db.execute(
+        select(models.User.id, models.User.profile_picture).where(models.User.profile_picture.is_not(None))
+    )).all()
+    migrated = 0
+    for user_id, file_name in users:
+        if local_storage.is_content_file_name(file_name):
+            continue
+        try:
+            new_file_name = await local_storage.import_user_image(file_name=file_name)
+        except (OSError, ValueError) as err:
+            logging.error(f'Error migrating picture of user {user_id}: {err}')
+            continue
+        result = await db.execute(
+            update(models.User)
+            .where(models.User.id == user_id, models.User.profile_picture == file_name)
+            .values(profile_picture=new_file_name)
+        )
+        await db.commit()
+        if result.rowcount:
+            await local_storage.delete_user_image(file_name=file_name)
+            local_storage.schedule_user_image_derivatives(file_name=new_file_name)
+            migrated += 1
+        else:
+            # Picture changed meanwhile
+            await local_storage.delete_user_image(file_name=new_file_name)
+    return migrated
@@ -1,25 +1,47 @@
 import os
 from abc import ABC, abstractmethod
+import fcntl
+import hashlib
 import logging
+import re
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator
 
 from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
 from imghdr import what
+from PIL import Image, ImageOps
 from uuid import uuid4
 
+from app.cache import TTLCache
 from app.config import settings
+from app.metrics import track_cache
+
+
+CONTENT_FILE_NAME_RE = re.compile(r'^[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.\w+$')
+
+
+class UploadTooLarge(Exception):
+    """Uploaded file exceeds `settings.MAX_UPLOAD_SIZE`"""
 
 
 class BaseStorage(ABC):
+    HEADER_SIZE = 512
+
     @staticmethod
     def generate_file_name(file_extension: str):
         return f'{uuid4()}.{file_extension}'
 
     @staticmethod
-    async def is_image(file):
-        header = await file.read(512)
-        await file.seek(0)
+    def is_image(header: bytes) -> bool:
         return what(None, header) is not None
 
+    @staticmethod
+    def get_derivative_name(file_name: str, size: int) -> str:
+        return f'{os.path.splitext(file_name)[0]}_{size}.{settings.AVATAR_FORMAT}'
+
     @abstractmethod
     async def upload_user_image(self, *, file: UploadFile) -> str | None:
         pass
@@ -27,41 +49,262 @@ class BaseStorage(ABC):
     async def delete_user_image(self, *, file_name: str) -> bool:
         pass
 
+    @abstractmethod
+    async def import_user_image(self, *, file_name: str) -> str:
+        pass
+
+    def schedule_user_image_derivatives(self, *, file_name: str) -> Future | None:
+        pass
+
+    def get_user_image_derivatives(self, file_name: str) -> dict[int, str]:
+        return {}
+
 
 class LocalStorage(BaseStorage):
     """
     Local storage for API.
+    With `settings.USER_IMAGES_CONTENT_ADDRESSED` images are named by sha256 of their
+    bytes and sharded into `ab/cd/` subdirectories, identical uploads share one file
+    whose references are counted in a `.refs` sidecar.
+    Avatar derivatives (`settings.AVATAR_SIZES` squares in `settings.AVATAR_FORMAT`)
+    are stored next to original image and generated in a bounded thread pool,
+    Pillow releases the GIL while decoding, resizing and encoding.
+    Generated sizes are cached per image, so serializing users doesn't stat files each time.
     """
-    
+
+    def __init__(self, derivative_workers: int, derivatives_cache_size: int):
+        self.derivative_workers = derivative_workers
+        self._executor: ThreadPoolExecutor | None = None
+        self.derivatives_cache = TTLCache(maxsize=derivatives_cache_size)
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.derivative_workers, thread_name_prefix='avatars')
+        return self._executor
+
+    def shutdown(self, wait: bool = False) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=not wait)
+            self._executor = None
+
+    @property
+    def user_images_dir(self) -> str:
+        return os.path.join(settings.MEDIA_DIR, settings.USER_IMAGES_FOLDER)
+
+    def _save_image(self, source: BinaryIO, file_extension: str, content_addressed: bool, max_size: int | None) -> str | None:
+        """
+        Copy `source` to user images directory in chunks, runs in threadpool.
+        Data goes to a temporary file which is renamed into place only when
+        the whole upload is accepted, so readers never see partial images.
+        Return file name or None if `source` is not an image.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.user_images_dir, prefix='.upload-')
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as tmp_file:
+                header = b''
+                size = 0
+                while chunk := source.read(settings.UPLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise UploadTooLarge
+                    if len(header) < self.HEADER_SIZE:
+                        header += chunk[:self.HEADER_SIZE - len(header)]
+                        if len(header) == self.HEADER_SIZE and not self.is_image(header):
+                            return None
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+                if not self.is_image(header):
+                    return None
+            if content_addressed:
+                file_name = self.get_content_file_name(digest.hexdigest(), what(None, header))
+                self._add_reference(file_name, tmp_path)
+            else:
+                file_name = self.generate_file_name(file_extension)
+                os.replace(tmp_path, os.path.join(self.user_images_dir, file_name))
+            return file_name
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
     async def upload_user_image(self, *, file: UploadFile) -> str | None:
         """
         Upload an image to user images directory.
         Return file name if success, None in case of error.
+        Raise `UploadTooLarge` if file exceeds `settings.MAX_UPLOAD_SIZE`.
         """
         try:
-            if not await self.is_image(file):
-                return False
-            file_name = self.generate_file_name(file.filename.split('.')[-1])
-            file_content = await file.read()
-            file_path = os.path.join(settings.MEDIA_DIR, settings.USER_IMAGES_FOLDER, file_name)
-            with open(file_path, 'wb') as new_file:
-                new_file.write(file_content)
-            return file_name
+            return await run_in_threadpool(
+                self._save_image,
+                file.file,
+                file.filename.split('.')[-1],
+                content_addressed=settings.USER_IMAGES_CONTENT_ADDRESSED,
+                max_size=settings.MAX_UPLOAD_SIZE,
+            )
+        except UploadTooLarge:
+            raise
         except Exception as err:
             logging.error(f'Error uploading file: {err} in {self.__class__.__name__}')
             return None
 
+    async def import_user_image(self, *, file_name: str) -> str:
+        """
+        Copy an existing uuid-named image into content-addressed storage,
+        return its new file name. Original image is left in place.
+        """
+        def copy() -> str:
+            with open(os.path.join(self.user_images_dir, file_name), 'rb') as source:
+                new_file_name = self._save_image(source, '', content_addressed=True, max_size=None)
+            if new_file_name is None:
+                raise ValueError(f'{file_name} is not an image')
+            return new_file_name
+        return await run_in_threadpool(copy)
+
     async def delete_user_image(self, *, file_name: str) -> bool:
         """
-        Delete an image from user images directory.
+        Delete an image and its derivatives from user images directory.
+        Content-addressed images are only removed with their last reference.
         """
         try:
-            os.remove(os.path.join(settings.MEDIA_DIR, settings.USER_IMAGES_FOLDER, file_name))
+            if self.is_content_file_name(file_name):
+                await run_in_threadpool(self._remove_reference, file_name)
+            else:
+                await run_in_threadpool(os.remove, os.path.join(self.user_images_dir, file_name))
+                await run_in_threadpool(self._delete_derivatives, file_name)
+            self.derivatives_cache.delete(file_name)
             return True
         except Exception as err:
             logging.error(f'Error deleting file: {err} in {self.__class__.__name__}')
             return False
 
+    @staticmethod
+    def get_content_file_name(digest: str, image_type: str) -> str:
+        """Shard by leading digest bytes so no single directory grows huge"""
+        return f'{digest[:2]}/{digest[2:4]}/{digest}.{image_type}'
+
+    @staticmethod
+    def is_content_file_name(file_name: str) -> bool:
+        return CONTENT_FILE_NAME_RE.match(file_name) is not None
+
+    @contextmanager
+    def _lock(self, file_name: str) -> Iterator[None]:
+        """
+        Serialize reference counting of content-addressed images between threads and processes,
+        one lock file per shard directory. Uuid-named images are never shared and need no lock.
+        """
+        if not self.is_content_file_name(file_name):
+            yield
+            return
+        shard_dir = os.path.join(self.user_images_dir, os.path.dirname(file_name))
+        os.makedirs(shard_dir, exist_ok=True)
+        with open(os.path.join(shard_dir, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _get_references(self, file_name: str) -> int:
+        try:
+            with open(os.path.join(self.user_images_dir, f'{file_name}.refs')) as refs_file:
+                return int(refs_file.read())
+        except FileNotFoundError:
+            return 0
+
+    def _set_references(self, file_name: str, count: int) -> None:
+        refs_path = os.path.join(self.user_images_dir, f'{file_name}.refs')
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(refs_path), prefix='.refs-')
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(str(count))
+        os.replace(tmp_path, refs_path)
+
+    def _add_reference(self, file_name: str, tmp_path: str) -> None:
+        """Put content-addressed image in place unless already stored and count new reference"""
+        with self._lock(file_name):
+            file_path = os.path.join(self.user_images_dir, file_name)
+            if not os.path.exists(file_path):
+                os.replace(tmp_path, file_path)
+            self._set_references(file_name, self._get_references(file_name) + 1)
+
+    def _remove_reference(self, file_name: str) -> None:
+        """Drop a reference to content-addressed image, deleting it with the last one"""
+        with self._lock(file_name):
+            count = self._get_references(file_name) - 1
+            if count > 0:
+                self._set_references(file_name, count)
+                return
+            for path in (file_name, f'{file_name}.refs'):
+                try:
+                    os.remove(os.path.join(self.user_images_dir, path))
+                except FileNotFoundError:
+                    pass
+            self._delete_derivatives(file_name)
+
+    def _delete_derivatives(self, file_name: str) -> None:
+        for size in settings.AVATAR_SIZES:
+            try:
+                os.remove(os.path.join(self.user_images_dir, self.get_derivative_name(file_name, size)))
+            except FileNotFoundError:
+                pass
+
+    def _make_derivatives(self, file_name: str) -> None:
+        """Generate avatar derivatives of an uploaded image, runs in derivatives pool"""
+        if len(self._find_derivatives(file_name)) == len(settings.AVATAR_SIZES):
+            return  # Same content uploaded before
+        source_path = os.path.join(self.user_images_dir, file_name)
+        try:
+            with Image.open(source_path) as image:
+                # Let JPEG decoder downscale while decoding, no need for full resolution
+                image.draft('RGB', (max(settings.AVATAR_SIZES),) * 2)
+                image = ImageOps.exif_transpose(image)
+                if image.mode not in ('RGB', 'RGBA'):
+                    image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+                for size in sorted(settings.AVATAR_SIZES, reverse=True):
+                    avatar = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+                    fd, tmp_path = tempfile.mkstemp(dir=self.user_images_dir, prefix='.derivative-')
+                    try:
+                        with os.fdopen(fd, 'wb') as tmp_file:
+                            avatar.save(tmp_file, format=settings.AVATAR_FORMAT, quality=settings.AVATAR_QUALITY)
+                        os.replace(tmp_path, os.path.join(self.user_images_dir, self.get_derivative_name(file_name, size)))
+                    finally:
+                        if os.path.exists(tmp_path):
+                            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass  # Original replaced or deleted before its turn came
+        except Exception as err:
+            logging.error(f'Error generating derivatives of {file_name}: {err} in {self.__class__.__name__}')
+        with self._lock(file_name):
+            if not os.path.exists(source_path):
+                # Original was replaced or deleted meanwhile
+                self._delete_derivatives(file_name)
+
+    def schedule_user_image_derivatives(self, *, file_name: str) -> Future:
+        """Generate avatar derivatives in background, off the request path"""
+        return self.executor.submit(self._make_derivatives, file_name)
+
+    def _find_derivatives(self, file_name: str) -> dict[int, str]:
+        derivatives = {}
+        for size in settings.AVATAR_SIZES:
+            derivative_name = self.get_derivative_name(file_name, size)
+            if os.path.exists(os.path.join(self.user_images_dir, derivative_name)):
+                derivatives[size] = derivative_name
+        return derivatives
+
+    def get_user_image_derivatives(self, file_name: str) -> dict[int, str]:
+        """
+        Return names of already generated derivatives by size.
+        Complete set doesn't change while image is in use and is cached until evicted,
+        images with derivatives still being generated are rechecked after a few seconds.
+        """
+        derivatives = self.derivatives_cache.get(file_name)
+        if derivatives is None:
+            derivatives = self._find_derivatives(file_name)
+            is_complete = len(derivatives) == len(settings.AVATAR_SIZES)
+            self.derivatives_cache.set(
+                file_name, derivatives, ttl=None if is_complete else settings.AVATAR_DERIVATIVES_RECHECK_SECONDS
+            )
+        return derivatives
+
 
-local_storage = LocalStorage()
+local_storage = LocalStorage(
+    derivative_workers=settings.AVATAR_WORKERS, derivatives_cache_size=settings.AVATAR_DERIVATIVES_CACHE_SIZE
+)
+track_cache('avatar_derivatives', local_storage.derivatives_cache.stats)
@@ -0,0 +1,54 @@
+"""
+Top posts by `Post.trending_score` kept in process memory, every worker process holds its own copy.
+Requests are answered from memory, the list is reloaded in background once TRENDING_REFRESH_SECONDS old,
+so posts changed in between are shown as they were at last refresh.
+"""
+import time
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from .config import settings
+from . import models, selectors
+
+
+class TrendingPosts:
+    def __init__(self, size: int, refresh_seconds: float):
+        self.size = size
+        self.refresh_seconds = refresh_seconds
+        self.posts: list[models.Post] = []
+        self.refreshed_at: float | None = None
+        self.refreshing = False
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.refreshed_at is not None
+
+    def get(self, limit: int) -> list[models.Post]:
+        return self.posts[:limit]
+
+    def claim_refresh(self) -> bool:
+        """Whether loaded list is stale and caller should refresh it, only one refresh is claimed at a time"""
+        if self.refreshing or time.monotonic() - self.refreshed_at < self.refresh_seconds:
+            return False
+        self.refreshing = True
+        return True
+
+    async def refresh(self, session_factory: async_sessionmaker) -> None:
+        try:
+            async with session_factory() as db:
+                self.posts = await selectors.get_trending_posts(limit=self.size, db=db)
+            self.refreshed_at = time.monotonic()
+        finally:
+            self.refreshing = False
+
+    def discard(self, post_id: int) -> None:
+        """Drop deleted post without waiting for refresh"""
+        self.posts = [post for post in self.posts if post.id != post_id]
+
+    def clear(self) -> None:
+        self.posts = []
+        self.refreshed_at = None
+        self.refreshing = False
+
+
+trending_posts = TrendingPosts(size=settings.TRENDING_SIZE, refresh_seconds=settings.TRENDING_REFRESH_SECONDS)
@@ -1,7 +1,22 @@
+import asyncio
+import base64
+import hashlib
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from functools import partial
+from typing import Any, Callable
+
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
 from passlib.context import CryptContext
 
+from .config import settings
+
 
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto', bcrypt__rounds=settings.BCRYPT_ROUNDS)
 
 
 def hash_password(password: str) -> str:
@@ -10,3 +25,112 @@ def hash_password(password: str) -> str:
 
 def verify_password(plain: str, hashed: str) -> bool:
     return pwd_context.verify(secret=plain, hash=hashed)
+
+
+class HashingPoolBusy(Exception):
+    """Raised when password hashing queue is full"""
+
+
+class HashingPool:
+    """
+    Runs password hashing in dedicated worker processes so bcrypt does not occupy
+    event loop or Starlette threadpool. At most `max_pending` calls may be running
+    or queued, calls above that limit fail immediately with `HashingPoolBusy`.
+    With 0 workers hashing falls back to Starlette threadpool.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor: ProcessPoolExecutor | None = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # "spawn" keeps workers free of parent's event loop, threads and DB connections
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        if self.pending >= self.max_pending:
+            raise HashingPoolBusy
+        self.pending += 1
+        try:
+            if not self.workers:
+                return await run_in_threadpool(func, *args, **kwargs)
+            return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+        finally:
+            self.pending -= 1
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+hashing_pool = HashingPool(workers=settings.PASSWORD_HASHING_WORKERS, max_pending=settings.PASSWORD_HASHING_QUEUE_SIZE)
+
+
+async def hash_password_async(password: str) -> str:
+    return await hashing_pool.run(hash_password, password)
+
+
+async def verify_password_async(plain: str, hashed: str) -> bool:
+    return await hashing_pool.run(verify_password, plain=plain, hashed=hashed)
+
+
+def encode_cursor(*position: datetime | float | int) -> str:
+    """Build an opaque pagination cursor pointing at position of the last row of a page"""
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in position]
+    raw = json.dumps(values).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, *types: type) -> tuple | None:
+    """
+    Decode cursor built by `encode_cursor` casting its values to given types,
+    return None if it is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(types):
+            return None
+        return tuple(
+            datetime.fromisoformat(value) if type_ is datetime else type_(value)
+            for value, type_ in zip(values, types)
+        )
+    except (ValueError, TypeError):
+        return None
+
+
+def make_etag(*version: Any) -> str:
+    """Strong entity tag of a resource representation identified by version parts"""
+    return '"' + hashlib.sha1(repr(version).encode()).hexdigest() + '"'
+
+
+def http_date(value: datetime) -> str:
+    return format_datetime(value.astimezone(timezone.utc), usegmt=True)
+
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime | None = None) -> bool:
+    """
+    Evaluate conditional GET headers of request against current resource validators,
+    "If-None-Match" takes precedence over "If-Modified-Since".
+    """
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is not None and last_modified is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        # HTTP dates have seconds precision
+        return last_modified.replace(microsecond=0) <= since
+    return False
@@ -0,0 +1,101 @@
+"""
+Throughput of creating and updating posts one per request vs in batches with `POST /posts/bulk`
+and `PATCH /posts/bulk`, measured in posts per second through the in-process ASGI app.
+
+Dataset is (re)created in `--db-url` database, which is DROPPED first, TESTS_DB_URL by default.
+
+Run from `web/` directory:
+    python -m benchmarks.bulk_posts --posts 2000 --batch-sizes 10 100 1000 --concurrency 10
+"""
+import argparse
+import asyncio
+import time
+from typing import Any
+
+from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from app.config import settings
+from app.db import get_async_url, get_session_factory
+from app.main import app
+from app.utils import hashing_pool
+
+from .endpoints import ACTORS, Dataset, auth, seed
+
+
+Request = tuple[str, str, dict, int]  # Method, URL, JSON body and actor sending it
+
+
+async def send_all(client: AsyncClient, dataset: Dataset, requests: list[Request], concurrency: int) -> tuple[float, list[Any]]:
+    """Return elapsed seconds and response bodies in order of `requests`"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(method: str, url: str, json: dict, actor: int) -> Any:
+        async with semaphore:
+            response = await client.request(method, url, json=json, headers=auth(dataset, actor))
+        if response.status_code not in (200, 201):
+            raise RuntimeError(f'{method} {url}: {response.status_code} {response.text}')
+        return response.json()
+
+    started_at = time.perf_counter()
+    results = await asyncio.gather(*(send(*request) for request in requests))
+    return time.perf_counter() - started_at, results
+
+
+def post_data(n: int) -> dict[str, str]:
+    return {'title': f'Benchmark post {n}', 'content': 'Benchmark content ' * 10}
+
+
+def create_requests(posts: int, batch_size: int) -> list[Request]:
+    """Batch size 1 goes through single item endpoint"""
+    requests = []
+    for n, start in enumerate(range(0, posts, batch_size)):
+        numbers = range(start, min(start + batch_size, posts))
+        if batch_size == 1:
+            requests.append(('POST', '/posts/', post_data(start), n % ACTORS))
+        else:
+            requests.append(('POST', '/posts/bulk', {'posts': [post_data(number) for number in numbers]}, n % ACTORS))
+    return requests
+
+
+def update_requests(created: list[Request], results: list[Any]) -> list[Request]:
+    """Update posts by the actors who created them, in the same batches"""
+    requests = []
+    for (_, _, _, actor), result in zip(created, results):
+        if isinstance(result, dict):
+            requests.append(('PATCH', f'/posts/{result["id"]}', {'title': 'Updated post'}, actor))
+        else:
+            requests.append(('PATCH', '/posts/bulk', {'posts': [{'id': post['id'], 'title': 'Updated post'} for post in result]}, actor))
+    return requests
+
+
+async def main(args: argparse.Namespace) -> None:
+    dataset = seed(args.db_url, users=ACTORS, posts=1, likes=0, requests=1, seed_value=0)
+    bench_engine = create_async_engine(get_async_url(args.db_url), pool_size=args.concurrency)
+    BenchSessionLocal = async_sessionmaker(bind=bench_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+    app.dependency_overrides[get_session_factory] = lambda: BenchSessionLocal
+
+    print(f'{args.posts} posts per mode, concurrency {args.concurrency}')
+    print(f'{"mode":<12} {"requests":>10} {"created/s":>12} {"updated/s":>12}')
+    try:
+        async with AsyncClient(app=app, base_url='http://bench') as client:
+            for batch_size in [1, *args.batch_sizes]:
+                creates = create_requests(args.posts, batch_size)
+                create_elapsed, results = await send_all(client, dataset, creates, args.concurrency)
+                update_elapsed, _ = await send_all(client, dataset, update_requests(creates, results), args.concurrency)
+                mode = 'single' if batch_size == 1 else f'bulk x{batch_size}'
+                print(f'{mode:<12} {len(creates):>10} {args.posts / create_elapsed:>12.1f} {args.posts / update_elapsed:>12.1f}')
+    finally:
+        app.dependency_overrides.clear()
+        hashing_pool.shutdown()
+        await bench_engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--posts', type=int, default=2000, help='Posts created and updated per mode')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--db-url', default=settings.TESTS_DB_URL, help='Database to seed, dropped first')
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,339 @@
+"""
+Latency and throughput of every route in `routers/posts.py`, `routers/users.py` and `routers/feed.py`
+against a seeded, reproducible dataset (Faker with fixed seed).
+
+Dataset is (re)created in `--db-url` database, which is DROPPED first, TESTS_DB_URL by default.
+Only PostgreSQL is supported as models use its column types and indexes.
+Requests go to the app in-process through ASGI unless `--url` of a running server
+is given, in which case `--db-url` must point at the database of that server.
+
+Run from `web/` directory:
+    python -m benchmarks.endpoints --requests 200 --concurrency 20 --output results.json
+    python -m benchmarks.endpoints --compare results.json --threshold 0.1
+Exits with 1 on failed requests or, with `--compare`, when an endpoint throughput dropped
+or p95 latency grew by more than `--threshold` relative to saved results.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable
+
+from faker import Faker
+from httpx import AsyncClient
+from sqlalchemy import create_engine, func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from app import models
+from app.auth import create_access_token
+from app.config import settings
+from app.db import Base, get_async_url, get_session_factory
+from app.main import app
+from app.services import trending_score
+from app.storages import local_storage
+from app.utils import hash_password, hashing_pool
+
+ACTORS = 10  # Users sending authenticated requests, never seeded with likes
+FOLLOW_TARGETS = 50  # Last users, never seeded as followed, enough for actors to follow in 500 requests
+PASSWORD = 'benchmark-password'
+BENCH_IMAGES_FOLDER = 'bench_images'
+
+
+@dataclass
+class Dataset:
+    user_ids: list[int]
+    post_ids: list[int]
+    own_post_ids: list[int]  # Posts of actors, one per request, patched then deleted
+    words: list[str]
+    emails: list[str]
+
+    def actor_id(self, n: int) -> int:
+        return self.user_ids[n % ACTORS]
+
+
+@dataclass
+class Endpoint:
+    name: str
+    method: str
+    status: int
+    build: Callable[[Dataset, int], dict[str, Any]]  # Request kwargs of n-th request
+    safe: bool = False  # Can be warmed up without changing state
+
+
+def seed(db_url: str, users: int, posts: int, likes: int, requests: int, seed_value: int) -> Dataset:
+    """Recreate tables and fill them with deterministic fake data"""
+    fake = Faker()
+    Faker.seed(seed_value)
+    rng = random.Random(seed_value)
+    engine = create_engine(db_url)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    now = datetime.now(timezone.utc)
+    password = hash_password(PASSWORD)  # Same hash for all, bcrypt is slow by design
+
+    with engine.begin() as connection:
+        emails = [f'{n}.{fake.email()}' for n in range(users)]
+        user_ids = connection.scalars(insert(models.User).returning(models.User.id), [
+            {
+                'email': email, 'password': password, 'first_name': fake.first_name(),
+                'birth_date': fake.date_of_birth(minimum_age=18, maximum_age=80),
+            }
+            for email in emails
+        ]).all()
+        post_rows = [
+            {
+                'user_id': rng.choice(user_ids), 'title': fake.sentence(nb_words=5)[:50],
+                'content': fake.paragraph(nb_sentences=8)[:1000],
+                'published_at': now - timedelta(seconds=rng.randrange(365 * 24 * 3600)),
+            }
+            for _ in range(posts)
+        ]
+        post_ids = connection.scalars(insert(models.Post).returning(models.Post.id), post_rows).all()
+        own_post_ids = connection.scalars(insert(models.Post).returning(models.Post.id), [
+            {'user_id': user_ids[n % ACTORS], 'title': fake.sentence(nb_words=5)[:50], 'content': fake.paragraph()[:1000]}
+            for n in range(requests)
+        ]).all()
+
+        like_pairs = {(rng.choice(post_ids), rng.choice(user_ids[ACTORS:])) for _ in range(likes)} if users > ACTORS else set()
+        if like_pairs:
+            connection.execute(insert(models.PostLike), [
+                {'post_id': post_id, 'user_id': user_id} for post_id, user_id in sorted(like_pairs)
+            ])
+            counts = select(models.PostLike.post_id, func.count().label('count')) \
+                .group_by(models.PostLike.post_id) \
+                .subquery()
+            connection.execute(
+                update(models.Post)
+                .where(models.Post.id == counts.c.post_id)
+                .values(likes_count=counts.c.count, trending_score=trending_score(counts.c.count))
+            )
+
+        # Actors follow some users, their posts are put into feeds as fan-out on create does
+        followees = user_ids[ACTORS:-FOLLOW_TARGETS]
+        follows = [
+            {'follower_id': user_ids[n], 'followee_id': followee_id}
+            for n in range(min(ACTORS, users)) for followee_id in rng.sample(followees, min(20, len(followees)))
+        ]
+        if follows:
+            connection.execute(insert(models.UserFollow), follows)
+            connection.execute(insert(models.FeedItem).from_select(
+                ['user_id', 'published_at', 'post_id', 'author_id'],
+                select(models.UserFollow.follower_id, models.Post.published_at, models.Post.id, models.Post.user_id)
+                .join(models.Post, models.Post.user_id == models.UserFollow.followee_id)
+            ))
+            connection.execute(
+                update(models.User)
+                .where(models.User.id.in_({follow['followee_id'] for follow in follows}))
+                .values(followers_count=select(func.count()).where(models.UserFollow.followee_id == models.User.id).scalar_subquery())
+            )
+
+        words = [word for row in post_rows[:200] for word in row['title'].rstrip('.').split()]
+    engine.dispose()
+    return Dataset(user_ids, post_ids, own_post_ids, words, emails)
+
+
+def auth(dataset: Dataset, n: int) -> dict[str, str]:
+    return {'Authorization': f'Bearer {create_access_token(user_id=str(dataset.actor_id(n)))}'}
+
+
+def build_endpoints(image: bytes) -> list[Endpoint]:
+    """Ordered so that state changing requests find what they need, e.g. unlike after like"""
+    def like_target(dataset: Dataset, n: int) -> int:
+        return dataset.post_ids[n // ACTORS % len(dataset.post_ids)]
+
+    return [
+        Endpoint('posts.list', 'GET', 200, lambda d, n: {'url': '/posts/', 'params': {'limit': 20}, 'headers': auth(d, n)}, safe=True),
+        Endpoint('posts.list_title', 'GET', 200, lambda d, n: {
+            'url': '/posts/', 'params': {'limit': 20, 'title': d.words[n % len(d.words)]}, 'headers': auth(d, n)
+        }, safe=True),
+        Endpoint('posts.list_offset', 'GET', 200, lambda d, n: {
+            'url': '/posts/', 'params': {'limit': 20, 'offset': (n * 20) % max(len(d.post_ids), 1)}, 'headers': auth(d, n)
+        }, safe=True),
+        Endpoint('posts.export', 'GET', 200, lambda d, n: {'url': '/posts/export', 'headers': auth(d, n)}, safe=True),
+        Endpoint('posts.search', 'GET', 200, lambda d, n: {
+            'url': '/posts/search', 'params': {'q': d.words[n % len(d.words)], 'limit': 20}, 'headers': auth(d, n)
+        }, safe=True),
+        Endpoint('posts.trending', 'GET', 200, lambda d, n: {
+            'url': '/posts/trending', 'params': {'limit': 20}, 'headers': auth(d, n)
+        }, safe=True),
+        Endpoint('posts.get', 'GET', 200, lambda d, n: {
+            'url': f'/posts/{d.post_ids[n % len(d.post_ids)]}', 'headers': auth(d, n)
+        }, safe=True),
+        Endpoint('posts.create', 'POST', 201, lambda d, n: {
+            'url': '/posts/', 'json': {'title': f'Benchmark post {n}', 'content': 'Benchmark content ' * 10}, 'headers': auth(d, n)
+        }),
+        Endpoint('posts.update', 'PATCH', 200, lambda d, n: {
+            'url': f'/posts/{d.own_post_ids[n]}', 'json': {'title': f'Updated post {n}'}, 'headers': auth(d, n)
+        }),
+        Endpoint('posts.like', 'POST', 201, lambda d, n: {'url': f'/posts/{like_target(d, n)}/like', 'headers': auth(d, n)}),
+        Endpoint('posts.unlike', 'POST', 204, lambda d, n: {'url': f'/posts/{like_target(d, n)}/unlike', 'headers': auth(d, n)}),
+        Endpoint('posts.likes_bulk', 'POST', 200, lambda d, n: {
+            'url': '/posts/likes',
+            'json': {'action': 'like' if n % 2 == 0 else 'unlike', 'post_ids': d.post_ids[n // 2 % len(d.post_ids):][:20]},
+            'headers': auth(d, n),
+        }),
+        Endpoint('posts.create_bulk', 'POST', 201, lambda d, n: {
+            'url': '/posts/bulk',
+            'json': {'posts': [{'title': f'Benchmark post {n}.{i}', 'content': 'Benchmark content ' * 10} for i in range(20)]},
+            'headers': auth(d, n),
+        }),
+        Endpoint('posts.update_bulk', 'PATCH', 200, lambda d, n: {
+            'url': '/posts/bulk',
+            'json': {'posts': [{'id': id, 'title': f'Updated post {n}'} for id in d.own_post_ids[n % ACTORS::ACTORS][:20]]},
+            'headers': auth(d, n),
+        }),
+        Endpoint('posts.delete', 'DELETE', 204, lambda d, n: {'url': f'/posts/{d.own_post_ids[n]}', 'headers': auth(d, n)}),
+        Endpoint('users.follow', 'POST', 201, lambda d, n: {
+            'url': f'/users/{d.user_ids[-1 - n // ACTORS % FOLLOW_TARGETS]}/follow', 'headers': auth(d, n)
+        }),
+        Endpoint('users.unfollow', 'POST', 204, lambda d, n: {
+            'url': f'/users/{d.user_ids[-1 - n // ACTORS % FOLLOW_TARGETS]}/unfollow', 'headers': auth(d, n)
+        }),
+        Endpoint('feed.get', 'GET', 200, lambda d, n: {'url': '/feed/', 'params': {'limit': 20}, 'headers': auth(d, n)}, safe=True),
+        Endpoint('users.register', 'POST', 201, lambda d, n: {
+            'url': '/users/', 'json': {
+                'email': f'bench{n}-{d.emails[n % len(d.emails)]}', 'first_name': 'Bench',
+                'password': PASSWORD, 'birth_date': '2000-01-01',
+            }
+        }),
+        Endpoint('users.login', 'POST', 200, lambda d, n: {
+            'url': '/users/login/', 'data': {'username': d.emails[n % ACTORS], 'password': PASSWORD}
+        }),
+        Endpoint('users.get', 'GET', 200, lambda d, n: {
+            'url': f'/users/{d.user_ids[n % len(d.user_ids)]}', 'headers': auth(d, n)
+        }, safe=True),
+        Endpoint('users.update', 'PATCH', 200, lambda d, n: {
+            'url': '/users/', 'json': {'first_name': f'Name{n}'}, 'headers': auth(d, n)
+        }),
+        Endpoint('users.upload_picture', 'POST', 200, lambda d, n: {
+            'url': '/users/picture', 'files': {'file': ('image.jpg', image, 'image/jpeg')}, 'headers': auth(d, n)
+        }),
+        Endpoint('users.delete_picture', 'DELETE', 204, lambda d, n: {'url': '/users/picture', 'headers': auth(d, n)}),
+    ]
+
+
+def percentile(ordered: list[float], percent: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    index = max(0, min(len(ordered) - 1, round(percent / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+async def measure(
+    client: AsyncClient, endpoint: Endpoint, dataset: Dataset, requests: int, concurrency: int
+) -> dict[str, float | int]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    errors = 0
+
+    async def send(n: int):
+        nonlocal errors
+        async with semaphore:
+            started_at = time.perf_counter()
+            response = await client.request(endpoint.method, **endpoint.build(dataset, n))
+            latencies.append(time.perf_counter() - started_at)
+            if response.status_code != endpoint.status:
+                errors += 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(send(n) for n in range(requests)))
+    elapsed = time.perf_counter() - started_at
+    latencies.sort()
+    return {
+        'requests': requests,
+        'errors': errors,
+        'throughput': requests / elapsed,
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+    }
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], threshold: float) -> list[str]:
+    """Return descriptions of endpoints which regressed beyond `threshold`"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['throughput'] < base['throughput'] * (1 - threshold):
+            regressions.append(f'{name}: throughput {base["throughput"]:.1f} -> {result["throughput"]:.1f} req/s')
+        if result['p95'] > base['p95'] * (1 + threshold):
+            regressions.append(f'{name}: p95 {base["p95"]:.2f} -> {result["p95"]:.2f} ms')
+    return regressions
+
+
+async def main(args: argparse.Namespace) -> int:
+    with open(os.path.join(settings.STATIC_DIR, 'image.jpg'), 'rb') as image_file:
+        image = image_file.read()
+    endpoints = [endpoint for endpoint in build_endpoints(image) if not args.endpoints or endpoint.name in args.endpoints]
+    dataset = seed(args.db_url, args.users, args.posts, args.likes, args.requests, args.seed)
+
+    bench_engine = create_async_engine(get_async_url(args.db_url), pool_size=args.concurrency)
+    BenchSessionLocal = async_sessionmaker(bind=bench_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+    app.dependency_overrides[get_session_factory] = lambda: BenchSessionLocal
+    settings.USER_IMAGES_FOLDER = BENCH_IMAGES_FOLDER
+    images_dir = os.path.join(settings.MEDIA_DIR, BENCH_IMAGES_FOLDER)
+    os.makedirs(images_dir, exist_ok=True)
+
+    client = AsyncClient(base_url=args.url) if args.url else AsyncClient(app=app, base_url='http://bench')
+    results = {}
+    print(f'{args.requests} requests per endpoint, concurrency {args.concurrency}, '
+          f'{args.users} users, {args.posts} posts, seed {args.seed}')
+    print(f'{"endpoint":<24} {"req/s":>10} {"p50 ms":>10} {"p95 ms":>10} {"p99 ms":>10} {"errors":>8}')
+    try:
+        async with client:
+            for endpoint in endpoints:
+                if endpoint.safe:
+                    for n in range(args.warmup):
+                        await client.request(endpoint.method, **endpoint.build(dataset, n))
+                result = await measure(client, endpoint, dataset, args.requests, args.concurrency)
+                results[endpoint.name] = result
+                print(f'{endpoint.name:<24} {result["throughput"]:>10.1f} {result["p50"]:>10.2f} '
+                      f'{result["p95"]:>10.2f} {result["p99"]:>10.2f} {result["errors"]:>8}')
+    finally:
+        app.dependency_overrides.clear()
+        local_storage.shutdown(wait=True)
+        hashing_pool.shutdown()
+        shutil.rmtree(images_dir, ignore_errors=True)
+        await bench_engine.dispose()
+
+    failed = sum(result['errors'] for result in results.values()) > 0
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump({'params': {
+                key: getattr(args, key) for key in ('requests', 'concurrency', 'users', 'posts', 'likes', 'seed', 'url')
+            }, 'results': results}, output_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=10, help='Unmeasured requests to read-only endpoints')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--likes', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db-url', default=settings.TESTS_DB_URL, help='Database to seed, dropped first')
+    parser.add_argument('--url', help='Base URL of a running server, app is called in-process by default')
+    parser.add_argument('--endpoints', nargs='+', help='Only run these endpoints, e.g. posts.list users.get')
+    parser.add_argument('--output', help='Save results to JSON file')
+    parser.add_argument('--compare', help='JSON file with results of a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Allowed relative regression, 0.1 = 10%%')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main(args)))
@@ -0,0 +1,73 @@
+"""
+Latency and allocations of `UserOut.from_orm`: previous implementation deep-copying
+ORM object before applying getters vs current `GetterProxy` based one.
+
+Run from `web/` directory:
+    python -m benchmarks.from_orm --iterations 10000
+"""
+import argparse
+import time
+import tracemalloc
+from copy import deepcopy
+from datetime import date
+
+from pydantic import BaseModel
+
+from app import models, schemas
+
+
+class DeepcopyUserOut(schemas.UserOut):
+    """`UserOut` with getters applied the previous way"""
+
+    @classmethod
+    def from_orm(cls, obj, getter_binding=None):
+        getter_binding = getter_binding or {}
+        obj = deepcopy(obj)
+        for field in cls.__fields__:
+            method = getter_binding.get(field)
+            if method is None:
+                method = getattr(cls, f"get_{field}", None)
+            if method is not None and callable(method):
+                setattr(obj, field, method(obj))
+        return BaseModel.from_orm.__func__(cls, obj)
+
+
+def build_user() -> models.User:
+    return models.User(
+        id=1, email='test@mail.com', first_name='Joe', password='hash',
+        birth_date=date(2000, 1, 1), profile_picture='image.jpg',
+    )
+
+
+def measure(schema: type[schemas.UserOut], user: models.User, iterations: int) -> tuple[float, float]:
+    """Return microseconds and peak allocated bytes per call"""
+    started_at = time.perf_counter()
+    for _ in range(iterations):
+        schema.from_orm(user)
+    elapsed = time.perf_counter() - started_at
+
+    allocated = 0
+    tracemalloc.start()
+    for _ in range(iterations):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        schema.from_orm(user)
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return elapsed / iterations * 1_000_000, allocated / iterations
+
+
+def main(iterations: int) -> None:
+    user = build_user()
+    assert DeepcopyUserOut.from_orm(user).dict() == schemas.UserOut.from_orm(user).dict()
+    print(f'{"implementation":<16} {"us per call":>12} {"bytes per call":>15}   ({iterations} calls)')
+    for label, schema in (('deepcopy', DeepcopyUserOut), ('proxy', schemas.UserOut)):
+        latency, allocated = measure(schema, user, iterations)
+        print(f'{label:<16} {latency:>12.2f} {allocated:>15.0f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=10000)
+    args = parser.parse_args()
+    main(args.iterations)
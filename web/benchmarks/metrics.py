@@ -0,0 +1,89 @@
+"""
+Per-request overhead of `MetricsMiddleware` and of query tracking engine events.
+ASGI apps are called directly, without HTTP client, so the difference is not lost in noise.
+
+Run from `web/` directory:
+    python -m benchmarks.metrics --iterations 20000 --queries 2000
+"""
+import argparse
+import asyncio
+import time
+
+from fastapi import FastAPI
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from app.config import settings
+from app.db import get_async_url
+from app.metrics import MetricsMiddleware, RequestStats, current_stats, track_queries
+
+
+def build_app() -> FastAPI:
+    bench_app = FastAPI()
+
+    @bench_app.get('/items/{id}')
+    async def get_item(id: int):
+        return {'id': id}
+
+    return bench_app
+
+
+async def call(app, iterations: int) -> float:
+    """Return best per-request time in microseconds of 3 rounds"""
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        pass
+
+    best = float('inf')
+    for _ in range(3):
+        started_at = time.perf_counter()
+        for n in range(iterations):
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http',
+                'path': f'/items/{n}', 'raw_path': f'/items/{n}'.encode(), 'root_path': '', 'query_string': b'',
+                'headers': [], 'server': ('bench', 80),
+            }
+            await app(scope, receive, send)
+        best = min(best, time.perf_counter() - started_at)
+    return best / iterations * 1_000_000
+
+
+async def query(queries: int, tracked: bool) -> float:
+    """Return per-query time in microseconds of `SELECT 1` round trips"""
+    engine = create_async_engine(get_async_url(settings.DB_URL))
+    if tracked:
+        track_queries(engine.sync_engine)
+        current_stats.set(RequestStats({'method': 'GET', 'route': None}))
+    try:
+        async with engine.connect() as connection:
+            await connection.execute(text('SELECT 1'))
+            started_at = time.perf_counter()
+            for _ in range(queries):
+                await connection.execute(text('SELECT 1'))
+            return (time.perf_counter() - started_at) / queries * 1_000_000
+    finally:
+        await engine.dispose()
+
+
+async def main(iterations: int, queries: int) -> None:
+    plain = await call(build_app(), iterations)
+    instrumented = await call(MetricsMiddleware(build_app()), iterations)
+    print(f'request, {iterations} iterations (us per request, best of 3)')
+    print(f'  without middleware: {plain:.1f}')
+    print(f'  with middleware:    {instrumented:.1f} (+{instrumented - plain:.1f})')
+    if queries:
+        untracked = await query(queries, tracked=False)
+        tracked = await query(queries, tracked=True)
+        print(f'query, {queries} x SELECT 1 (us per query)')
+        print(f'  without events: {untracked:.1f}')
+        print(f'  with events:    {tracked:.1f} (+{tracked - untracked:.1f})')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=2000, help='DB round trips, 0 to skip DB part')
+    args = parser.parse_args()
+    asyncio.run(main(args.iterations, args.queries))
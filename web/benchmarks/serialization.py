@@ -0,0 +1,68 @@
+"""
+Per-item cost of serializing posts lists:
+  - default: validation against `list[PostOut]` + JSONResponse (previous behaviour)
+  - orjson: validation against `list[PostOut]` + ORJSONResponse (app-wide default)
+  - fast: `ORMListResponse`, no validation + orjson (hot list endpoints)
+
+Run from `web/` directory:
+    python -m benchmarks.serialization --sizes 100 1000 10000
+"""
+import argparse
+import time
+from datetime import datetime, timezone
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import parse_obj_as
+
+from app import models, schemas
+from app.responses import ORMListResponse
+
+
+def build_posts(size: int) -> list[models.Post]:
+    now = datetime.now(timezone.utc)
+    return [
+        models.Post(
+            id=n, user_id=n % 100, title=f'Title {n}', content='Content ' * 20,
+            is_active=True, likes_count=n % 1000, published_at=now, updated_at=now,
+        )
+        for n in range(size)
+    ]
+
+
+def default(posts: list[models.Post]) -> bytes:
+    return JSONResponse(jsonable_encoder(parse_obj_as(list[schemas.PostOut], posts))).body
+
+
+def orjson(posts: list[models.Post]) -> bytes:
+    return ORJSONResponse(jsonable_encoder(parse_obj_as(list[schemas.PostOut], posts))).body
+
+
+def fast(posts: list[models.Post]) -> bytes:
+    return ORMListResponse(posts, schemas.PostOut).body
+
+
+def measure(func, posts: list[models.Post], repeat: int) -> float:
+    """Return best per-item time in microseconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func(posts)
+        best = min(best, time.perf_counter() - started_at)
+    return best / len(posts) * 1_000_000
+
+
+def main(sizes: list[int], repeat: int) -> None:
+    print(f'{"posts":>8} {"default":>12} {"orjson":>12} {"fast":>12}   (us per item, best of {repeat})')
+    for size in sizes:
+        posts = build_posts(size)
+        results = [measure(func, posts, repeat) for func in (default, orjson, fast)]
+        print(f'{size:>8} ' + ' '.join(f'{result:>12.2f}' for result in results))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    main(args.sizes, args.repeat)
@@ -0,0 +1,77 @@
+"""
+Throughput of concurrent requests hitting a slow query: blocking `Session` inside
+`async def` route (previous DB layer) vs `AsyncSession` from `app.db`.
+
+Run from `web/` directory:
+    python -m benchmarks.slow_queries --requests 100 --concurrency 20 --delay 0.05
+"""
+import argparse
+import asyncio
+import time
+
+from fastapi import FastAPI, Depends
+from httpx import AsyncClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker, Session
+
+from app.config import settings
+from app.db import get_write_db, engine
+
+
+def build_app(concurrency: int) -> FastAPI:
+    sync_engine = create_engine(settings.DB_URL, pool_size=concurrency)
+    SyncSessionLocal = sessionmaker(bind=sync_engine, autocommit=False, autoflush=False)
+
+    def get_sync_db():
+        db = SyncSessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    bench_app = FastAPI()
+
+    @bench_app.get('/sync')
+    async def sync_route(delay: float, db: Session = Depends(get_sync_db)):
+        db.execute(text('SELECT pg_sleep(:delay)'), {'delay': delay})
+
+    @bench_app.get('/async')
+    async def async_route(delay: float, db: AsyncSession = Depends(get_write_db)):
+        await db.execute(text('SELECT pg_sleep(:delay)'), {'delay': delay})
+
+    return bench_app
+
+
+async def measure(client: AsyncClient, path: str, requests: int, concurrency: int, delay: float) -> float:
+    """Return requests per second"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send():
+        async with semaphore:
+            response = await client.get(path, params={'delay': delay})
+            response.raise_for_status()
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(send() for _ in range(requests)))
+    return requests / (time.perf_counter() - started_at)
+
+
+async def main(requests: int, concurrency: int, delay: float) -> None:
+    bench_app = build_app(concurrency)
+    async with AsyncClient(app=bench_app, base_url='http://bench') as client:
+        print(f'{requests} requests, concurrency {concurrency}, query time {delay}s')
+        print(f'  theoretical max: {concurrency / delay:.1f} req/s')
+        for label, path in (('before (sync Session)', '/sync'), ('after (AsyncSession)', '/async')):
+            throughput = await measure(client, path, requests, concurrency, delay)
+            print(f'  {label}: {throughput:.1f} req/s')
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--delay', type=float, default=0.05, help='Seconds each query sleeps in DB')
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency, args.delay))
@@ -1,22 +1,36 @@
 import os
+import shutil
 import pytest
 
+from contextlib import contextmanager
+
 from fastapi.testclient import TestClient
 from faker import Faker
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.orm import sessionmaker, Session
-from typing import Generator
+from sqlalchemy.pool import NullPool
+from typing import AsyncGenerator, Callable, ContextManager, Generator
 
 from app import models
 from app.main import app
-from app.db import get_db, Base
+from app.db import get_session_factory, recent_writers, get_async_url, Base
 from app.config import settings
 from app.utils import hash_password
-from app.auth import create_access_token
+from app.auth import create_access_token, user_cache, token_cache
+from app.cache import posts_cache
+from app.trending import trending_posts
+from app.metrics import RequestStats, request_observers, track_queries
+from app.storages import local_storage
 
 
+# Sync engine is used to seed and inspect DB from tests
 engine = create_engine(settings.TESTS_DB_URL)
 TestSessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
+# TestClient runs every request in its own event loop, so connections can't be pooled between requests
+async_engine = create_async_engine(get_async_url(settings.TESTS_DB_URL), poolclass=NullPool)
+AsyncTestSessionLocal = async_sessionmaker(bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+track_queries(async_engine.sync_engine)
 fake = Faker()
 TEST_IMAGES_DIR = os.path.join(settings.BASE_DIR, 'media', 'test_images')
 
@@ -29,6 +43,18 @@ def override_settings():
         yield
 
 
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Tables are recreated for every test so cached rows must not leak between tests"""
+    user_cache.clear()
+    token_cache.clear()
+    recent_writers.clear()
+    trending_posts.clear()
+    local_storage.derivatives_cache.clear()
+    if posts_cache is not None:
+        posts_cache.backend.clear()
+
+
 def pytest_runtest_setup(item):
     """Run once before test session"""
     # Make sure folder for media images exists  
@@ -37,9 +63,13 @@ def pytest_runtest_setup(item):
 
 def pytest_runtest_teardown(item):
     """Clear test image folder"""
+    local_storage.shutdown(wait=True)
     for filename in os.listdir(TEST_IMAGES_DIR):
         file_path = os.path.join(TEST_IMAGES_DIR, filename)
-        os.remove(file_path)
+        if os.path.isdir(file_path):
+            shutil.rmtree(file_path)  # Content-addressed shards
+        else:
+            os.remove(file_path)
 
 
 @pytest.fixture(scope='function')
@@ -53,14 +83,20 @@ def session() -> Generator[Session, None, None]:
         session.close()
 
 
+@pytest.fixture
+def anyio_backend() -> str:
+    return 'asyncio'
+
+
+@pytest.fixture(scope='function')
+async def async_session(session) -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncTestSessionLocal() as async_session:
+        yield async_session
+
+
 @pytest.fixture(scope='function')
 def client(session) -> Generator[TestClient, None, None]:
-    def override_get_db():
-        try:
-            yield session
-        finally:
-            pass
-    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_session_factory] = lambda: AsyncTestSessionLocal
     yield TestClient(app=app)
 
 
@@ -86,9 +122,17 @@ def extra_user_obj(session) -> models.User:
     return user_obj
 
 
+@pytest.fixture
+def auth_headers() -> Callable[[models.User], dict[str, str]]:
+    """Authorization headers of a user, for requests sent on behalf of someone else than `authorized_client` user"""
+    def make_auth_headers(user: models.User) -> dict[str, str]:
+        return {'Authorization': f'Bearer {create_access_token(user_id=str(user.id))}'}
+    return make_auth_headers
+
+
 @pytest.fixture(scope='function')
-def authorized_client(client, user_obj) -> TestClient:
-    client.headers = {'Authorization': f'Bearer {create_access_token(user_id=str(user_obj.id))}'}
+def authorized_client(client, user_obj, auth_headers) -> TestClient:
+    client.headers = auth_headers(user_obj)
     return client
 
 
@@ -99,3 +143,25 @@ def test_posts(session, user_obj):
     session.add_all(posts)
     session.commit()
     return session.query(models.Post).all()
+
+
+@pytest.fixture
+def max_queries() -> Callable[[int], ContextManager[list[RequestStats]]]:
+    """
+    Context manager asserting that every request sent inside it ran at most `limit` queries:
+        with max_queries(2):
+            client.get('posts/1')
+    """
+    @contextmanager
+    def assert_max_queries(limit: int):
+        finished: list[RequestStats] = []
+        request_observers.append(finished.append)
+        try:
+            yield finished
+        finally:
+            request_observers.remove(finished.append)
+        assert finished, 'No requests were sent'
+        for stats in finished:
+            statements = '\n'.join(stats.statements)
+            assert stats.queries <= limit, f'{stats.route} ran {stats.queries} queries, expected at most {limit}:\n{statements}'
+    return assert_max_queries
@@ -0,0 +1,175 @@
+import asyncio
+import pytest
+
+from unittest.mock import patch
+
+from app.cache import TTLCache, MemoryCacheBackend, RedisCacheBackend, RedisError, ResponseCache
+
+
+def test_get_set():
+    cache = TTLCache(maxsize=2)
+    assert cache.get('a') is None
+    assert cache.get('a', 'default') == 'default'
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 2, 'evictions': 0}
+
+    assert cache.delete('a') is True
+    assert cache.delete('a') is False
+    assert cache.get('a') is None
+
+
+def test_lru_eviction():
+    cache = TTLCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')  # "b" becomes least recently used
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.evictions == 1
+    assert len(cache) == 2
+
+
+def test_expiration():
+    cache = TTLCache(maxsize=10, ttl=10)
+    with patch('app.cache.time.monotonic', return_value=100):
+        cache.set('default_ttl', 1)
+        cache.set('custom_ttl', 2, ttl=30)
+    with patch('app.cache.time.monotonic', return_value=115):
+        assert cache.get('default_ttl') is None
+        assert cache.get('custom_ttl') == 2
+    with patch('app.cache.time.monotonic', return_value=131):
+        assert cache.get('custom_ttl') is None
+    assert len(cache) == 0
+
+
+class RedisStandIn:
+    """Local server answering the subset of Redis protocol used by `RedisCacheBackend`"""
+
+    def __init__(self, delays: dict[bytes, float] | None = None):
+        self.data: dict[bytes, bytes] = {}
+        self.delays = delays or {}  # Seconds to wait before replying to GET of the key
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while line := await reader.readline():
+            args = []
+            for _ in range(int(line[1:])):
+                length = int((await reader.readline())[1:])
+                args.append((await reader.readexactly(length + 2))[:-2])
+            command = args[0].upper()
+            if command == b'GET':
+                await asyncio.sleep(self.delays.get(args[1], 0))
+                value = self.data.get(args[1])
+                writer.write(b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value))
+            elif command == b'SET':
+                self.data[args[1]] = args[2]
+                writer.write(b'+OK\r\n')
+            elif command == b'INCR':
+                self.data[args[1]] = b'%d' % (int(self.data.get(args[1], 0)) + 1)
+                writer.write(b':%s\r\n' % self.data[args[1]])
+            elif command == b'DBSIZE':
+                writer.write(b':%d\r\n' % len(self.data))
+            elif command == b'INFO':
+                info = b'# Stats\r\nevicted_keys:0\r\n'
+                writer.write(b'$%d\r\n%s\r\n' % (len(info), info))
+            else:
+                writer.write(b'-ERR unknown command\r\n')
+            await writer.drain()
+        writer.close()
+
+
+@pytest.mark.anyio
+async def test_response_cache_memory():
+    cache = ResponseCache(MemoryCacheBackend(maxsize=10), namespace='test', ttl=10)
+    params = {'limit': 10, 'title': None}
+    key, cached = await cache.get(params)
+    assert cached is None
+
+    await cache.set(key, b'[]', {'ETag': '"etag"'})
+    assert (await cache.get({'title': None, 'limit': 10}))[1] == (b'[]', {'ETag': '"etag"'})  # Keys order ignored
+    assert (await cache.get({'limit': 20, 'title': None}))[1] is None
+
+    # Version bump makes previous entries stale
+    await cache.invalidate()
+    assert (await cache.get(params))[1] is None
+    assert await cache.stats() == {'size': 1, 'hits': 1, 'misses': 3, 'evictions': 0, 'hit_ratio': 0.25}
+
+
+@pytest.mark.anyio
+async def test_response_cache_invalidated_during_render():
+    cache = ResponseCache(MemoryCacheBackend(maxsize=10), namespace='test', ttl=10)
+    params = {'limit': 10}
+    key, _ = await cache.get(params)
+    await cache.invalidate()  # Write committed while page was rendered
+    await cache.set(key, b'[{"id": 1}]', {})
+    key, cached = await cache.get(params)
+    assert cached is None
+
+    await cache.set(key, b'[]', {})
+    assert (await cache.get(params))[1] == (b'[]', {})
+
+
+@pytest.mark.anyio
+async def test_response_cache_redis():
+    stand_in = RedisStandIn()
+    server = await asyncio.start_server(stand_in.handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        cache = ResponseCache(RedisCacheBackend(f'redis://127.0.0.1:{port}/0'), namespace='test', ttl=10)
+        params = {'limit': 10}
+        key, cached = await cache.get(params)
+        assert cached is None
+        await cache.set(key, b'[{"id": 1}]', {'ETag': '"etag"'})
+        assert (await cache.get(params))[1] == (b'[{"id": 1}]', {'ETag': '"etag"'})
+
+        await cache.invalidate()
+        assert stand_in.data[b'test:version'] == b'1'
+        assert (await cache.get(params))[1] is None
+        assert await cache.stats() == {'size': 2, 'hits': 1, 'misses': 2, 'evictions': 0, 'hit_ratio': 1 / 3}
+
+        with pytest.raises(RedisError):
+            await cache.backend.execute('FLUSHALL')
+
+
+@pytest.mark.anyio
+async def test_response_cache_redis_unavailable():
+    server = await asyncio.start_server(lambda reader, writer: None, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    server.close()
+    await server.wait_closed()
+
+    # Errors are treated as cache misses
+    cache = ResponseCache(RedisCacheBackend(f'redis://127.0.0.1:{port}/0'), namespace='test', ttl=10)
+    assert await cache.get({'limit': 10}) == (None, None)
+    await cache.set(('test:key', 0), b'[]', {})
+    await cache.invalidate()
+    assert await cache.stats() == {'size': None, 'hits': 0, 'misses': 0, 'evictions': None, 'hit_ratio': None}
+
+
+@pytest.mark.anyio
+async def test_redis_cancelled_command():
+    stand_in = RedisStandIn(delays={b'slow': 0.1})
+    stand_in.data = {b'slow': b'1', b'fast': b'2'}
+    server = await asyncio.start_server(stand_in.handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        backend = RedisCacheBackend(f'redis://127.0.0.1:{port}/0')
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(backend.get('slow'), 0.01)  # E.g. client disconnected
+        # Reply to cancelled command is not read as reply to the next one
+        assert await backend.get('fast') == b'2'
+
+
+@pytest.mark.anyio
+async def test_redis_timeout():
+    stand_in = RedisStandIn(delays={b'test:version': 10})
+    server = await asyncio.start_server(stand_in.handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server:
+        backend = RedisCacheBackend(f'redis://127.0.0.1:{port}/0', timeout=0.05)
+        cache = ResponseCache(backend, namespace='test', ttl=10)
+        # Hung server is treated as cache miss instead of blocking requests
+        assert await asyncio.wait_for(cache.get({'limit': 10}), 1) == (None, None)
+        assert await backend.incr('test:version') == 1
@@ -0,0 +1,185 @@
+import time
+import pytest
+
+from sqlalchemy import create_engine, exc, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from unittest.mock import patch
+
+from app import models
+from app.config import settings
+from app.db import Base, ReplicaSet, create_db_engine, get_async_url, get_write_db
+from app.main import app
+from app.metrics import POOL_CHECKOUT_WAIT, POOL_TIMEOUTS, RequestStats, current_stats, registry
+
+from .conftest import TestClient
+
+# Second local DB standing in for a replica, it is never written to so reads from it see no rows
+REPLICA_DB_URL = make_url(settings.TESTS_DB_URL).set(database=make_url(settings.TESTS_DB_URL).database + '_replica')
+
+
+@pytest.fixture(scope='module')
+def replica_db():
+    with create_engine(make_url(settings.TESTS_DB_URL).set(database='postgres'), isolation_level='AUTOCOMMIT').connect() as connection:
+        if not connection.scalar(text('SELECT 1 FROM pg_database WHERE datname = :name'), {'name': REPLICA_DB_URL.database}):
+            connection.execute(text(f'CREATE DATABASE "{REPLICA_DB_URL.database}"'))
+    replica_engine = create_engine(REPLICA_DB_URL)
+    Base.metadata.drop_all(bind=replica_engine)
+    Base.metadata.create_all(bind=replica_engine)
+    replica_engine.dispose()
+
+
+@pytest.fixture
+def replica(replica_db):
+    replicas = ReplicaSet([create_async_engine(get_async_url(REPLICA_DB_URL.render_as_string(hide_password=False)), poolclass=NullPool)])
+    with patch('app.db.replicas', replicas):
+        yield replicas
+
+
+@pytest.mark.anyio
+async def test_pool_timeout():
+    with \
+        patch.object(settings, 'DB_POOL_SIZE', 1), \
+        patch.object(settings, 'DB_MAX_OVERFLOW', 0), \
+        patch.object(settings, 'DB_POOL_TIMEOUT', 0.1):
+        engine = create_db_engine(settings.TESTS_DB_URL, name='test')
+    timeouts = POOL_TIMEOUTS.values.get((), 0)
+    checkouts = sum(POOL_CHECKOUT_WAIT.values[()][0]) if () in POOL_CHECKOUT_WAIT.values else 0
+    try:
+        async with engine.connect():
+            # Only connection is taken
+            with pytest.raises(exc.TimeoutError):
+                async with engine.connect():
+                    pass
+        assert POOL_TIMEOUTS.values[()] == timeouts + 1
+        assert sum(POOL_CHECKOUT_WAIT.values[()][0]) == checkouts + 2  # Timed out one included
+        assert engine.sync_engine.pool.checkedout() == 0
+    finally:
+        await engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_statement_timeout():
+    with patch.object(settings, 'DB_STATEMENT_TIMEOUT_MS', 100):
+        engine = create_db_engine(settings.TESTS_DB_URL, name='test')
+    try:
+        async with engine.connect() as connection:
+            assert await connection.scalar(text('SHOW statement_timeout')) == '100ms'
+            with pytest.raises(exc.DBAPIError, match='statement timeout'):
+                await connection.execute(text('SELECT pg_sleep(1)'))
+    finally:
+        await engine.dispose()
+
+
+def test_pool_exhausted_response(authorized_client: TestClient):
+    async def exhausted_get_db():
+        raise exc.TimeoutError('QueuePool limit of size 5 overflow 10 reached')
+        yield
+
+    with patch.dict(app.dependency_overrides, {get_write_db: exhausted_get_db}):
+        response = authorized_client.get('posts/')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert response.json() == {'detail': 'Server is busy, try again later'}
+
+
+def test_pool_metrics(client: TestClient):
+    response = client.get('metrics')
+    assert 'db_pool_size{engine="primary"} 5' in response.text
+    assert 'db_pool_checked_out{engine="primary"} 0' in response.text
+    assert 'db_pool_overflow{engine="primary"}' in response.text
+
+
+@pytest.mark.anyio
+async def test_replica_engine_tracked():
+    with patch.object(settings, 'DB_POOL_SIZE', 2):
+        replicas = ReplicaSet([create_db_engine(settings.TESTS_DB_URL, name='replica0')])
+    stats = RequestStats({'method': 'GET', 'route': None})
+    token = current_stats.set(stats)
+    try:
+        async with replicas.session_factories[0]() as db:
+            await db.execute(text('SELECT 1'))
+    finally:
+        current_stats.reset(token)
+        await replicas.dispose()
+    # Counted into request stats and pool reported with its name
+    assert stats.queries == 1
+    assert 'db_pool_size{engine="replica0"} 2' in registry.render()
+
+
+class TestReplicas:
+    def test_reads_go_to_replica(self, authorized_client: TestClient, test_posts, replica):
+        # Posts exist on primary only
+        response = authorized_client.get(f'posts/{test_posts[0].id}')
+        assert response.status_code == 404
+        response = authorized_client.get('posts/', params={'id': test_posts[0].id})
+        assert response.json() == []
+
+    def test_read_your_writes(self, authorized_client: TestClient, extra_user_obj: models.User, auth_headers, test_posts, replica):
+        response = authorized_client.post('posts/', json={'title': 'Title', 'content': 'Content'})
+        assert response.status_code == 201
+        post_id = response.json()['id']
+        response = authorized_client.get(f'posts/{post_id}')
+        assert response.status_code == 200
+        # Other requesters still read from replica
+        extra_user_headers = auth_headers(extra_user_obj)
+        response = authorized_client.get(f'posts/{post_id}', headers=extra_user_headers)
+        assert response.status_code == 404
+
+    def test_read_your_writes_cached_page(self, authorized_client: TestClient, extra_user_obj: models.User, auth_headers, replica):
+        extra_user_headers = auth_headers(extra_user_obj)
+        response = authorized_client.post('posts/', json={'title': 'Title', 'content': 'Content'})
+        post_id = response.json()['id']
+        # Page read from replica is cached after the write invalidated cache
+        response = authorized_client.get('posts/', headers=extra_user_headers)
+        assert response.json() == []
+        assert response.headers['X-Cache'] == 'MISS'
+        assert authorized_client.get('posts/', headers=extra_user_headers).headers['X-Cache'] == 'HIT'
+
+        # Writer skips cache and reads primary
+        response = authorized_client.get('posts/')
+        assert [post['id'] for post in response.json()] == [post_id]
+        assert 'X-Cache' not in response.headers
+
+    def test_read_your_writes_expired(self, authorized_client: TestClient, test_posts, replica):
+        with patch.object(settings, 'DB_READ_YOUR_WRITES_SECONDS', 0.01):
+            response = authorized_client.post('posts/', json={'title': 'Title', 'content': 'Content'})
+            time.sleep(0.02)
+            response = authorized_client.get(f'posts/{response.json()["id"]}')
+        assert response.status_code == 404
+
+    def test_unhealthy_replica_ejected(self, authorized_client: TestClient, test_posts):
+        dead_url = REPLICA_DB_URL.set(host='127.0.0.1', port=1).render_as_string(hide_password=False)
+        replicas = ReplicaSet([create_async_engine(get_async_url(dead_url), poolclass=NullPool)])
+        with patch('app.db.replicas', replicas):
+            response = authorized_client.get(f'posts/{test_posts[0].id}')
+            assert response.status_code == 200  # Served by primary
+            assert replicas.ejected_until[0] > time.monotonic()
+            assert replicas.healthy() == []
+
+    @pytest.mark.anyio
+    async def test_saturated_replica_not_ejected(self):
+        with \
+            patch.object(settings, 'DB_POOL_SIZE', 1), \
+            patch.object(settings, 'DB_MAX_OVERFLOW', 0), \
+            patch.object(settings, 'DB_POOL_TIMEOUT', 0.1):
+            replicas = ReplicaSet([create_db_engine(settings.TESTS_DB_URL, name=f'test{index}') for index in range(2)])
+        try:
+            async with replicas.engines[0].connect():
+                # Only connection of first replica is taken, next one serves the read
+                async with await replicas.open_session() as db:
+                    assert db.bind is replicas.engines[1]
+                    # All replicas exhausted, answered with 503 rather than moved onto primary
+                    with pytest.raises(exc.TimeoutError):
+                        await replicas.open_session()
+            assert replicas.ejected_until == [0.0, 0.0]
+        finally:
+            await replicas.dispose()
+
+    def test_round_robin(self):
+        replicas = ReplicaSet([create_async_engine(get_async_url(settings.TESTS_DB_URL)) for _ in range(3)])
+        assert [replicas.healthy()[0] for _ in range(4)] == [0, 1, 2, 0]
+        replicas.eject(1)
+        # Ejected replica's turn is taken by the next one
+        assert [replicas.healthy() for _ in range(3)] == [[2, 0], [2, 0], [0, 2]]
@@ -0,0 +1,76 @@
+from typing import Callable
+from unittest.mock import patch
+from sqlalchemy.orm import Session
+
+from app import models
+from app.config import settings
+
+from .conftest import TestClient
+
+
+class TestGetFeed:
+    def test_success(
+        self,
+        authorized_client: TestClient,
+        session: Session,
+        user_obj: models.User,
+        extra_user_obj: models.User,
+        auth_headers: Callable[[models.User], dict[str, str]]
+    ):
+        authorized_client.post(f'users/{extra_user_obj.id}/follow')
+        post_ids = [
+            authorized_client.post('posts/', json={'title': f'Title{n}', 'content': f'Content{n}'}, headers=auth_headers(extra_user_obj)).json()['id']
+            for n in range(3)
+        ]
+        # Own posts are not in feed
+        authorized_client.post('posts/', json={'title': 'Own title', 'content': 'Own content'})
+        # Fanned out in background
+        assert session.query(models.FeedItem).filter_by(user_id=user_obj.id).count() == 3
+
+        response = authorized_client.get('feed/', params={'limit': 2})
+        assert response.status_code == 200
+        assert [post['id'] for post in response.json()] == post_ids[:0:-1]
+        response = authorized_client.get('feed/', params={'limit': 2, 'cursor': response.headers['X-Next-Cursor']})
+        assert [post['id'] for post in response.json()] == post_ids[:1]
+        assert 'X-Next-Cursor' not in response.headers
+
+        # Deleted posts drop out of feed
+        authorized_client.delete(f'posts/{post_ids[0]}', headers=auth_headers(extra_user_obj))
+        response = authorized_client.get('feed/')
+        assert [post['id'] for post in response.json()] == post_ids[:0:-1]
+
+    def test_popular_authors(
+        self,
+        authorized_client: TestClient,
+        session: Session,
+        user_obj: models.User,
+        extra_user_obj: models.User,
+        auth_headers: Callable[[models.User], dict[str, str]]
+    ):
+        fanned_out_id = authorized_client.post('posts/', json={'title': 'Title', 'content': 'Content'}, headers=auth_headers(extra_user_obj)).json()['id']
+        authorized_client.post(f'users/{extra_user_obj.id}/follow')
+        with patch.object(settings, 'FEED_FANOUT_MAX_FOLLOWERS', 0):
+            post_id = authorized_client.post('posts/', json={'title': 'Title', 'content': 'Content'}, headers=auth_headers(extra_user_obj)).json()['id']
+            # Not fanned out but merged on read, post fanned out before author got popular is not duplicated
+            assert session.query(models.FeedItem).filter_by(post_id=post_id).count() == 0
+            response = authorized_client.get('feed/')
+        assert response.status_code == 200
+        assert [post['id'] for post in response.json()] == [post_id, fanned_out_id]
+
+    def test_fail(self, authorized_client: TestClient):
+        # Invalid cursor
+        response = authorized_client.get('feed/', params={'cursor': 'invalid'})
+        assert response.status_code == 400
+        assert response.json() == {'detail': 'Invalid cursor'}
+
+        # Not authenticated
+        response = authorized_client.get('feed/', headers={'Authorization': ''})
+        assert response.status_code == 401
+        assert response.json() == {'detail': 'Not authenticated'}
+
+    def test_queries(self, authorized_client: TestClient, extra_user_obj: models.User, max_queries):
+        authorized_client.post(f'users/{extra_user_obj.id}/follow')
+        # Current user and feed page
+        with max_queries(2):
+            response = authorized_client.get('feed/')
+        assert response.status_code == 200
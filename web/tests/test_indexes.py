@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from sqlalchemy.orm import Session
+
+from app.auth import create_access_token
+from app.config import settings
+from app.db import get_async_url
+from app.models import has_pg_trgm
+from app.utils import hash_password
+
+from .conftest import TestClient, async_engine, engine
+
+USERS = 2000
+POSTS = 20000
+LIKES = 50000
+FOLLOWS = 40000
+WORD = hashlib.md5(b'15').hexdigest()  # Content of 15th post
+
+
+def seed(session: Session) -> None:
+    """Enough rows for planner to prefer indexes wherever they apply"""
+    session.execute(text(f"""
+        INSERT INTO "user" (email, password, first_name, birth_date)
+        SELECT 'user' || n || '@example.com', :password, 'User' || n, '2000-01-01'
+        FROM generate_series(1, {USERS}) AS n
+    """), {'password': hash_password('password')})
+    session.execute(text(f"""
+        INSERT INTO post (user_id, title, content, published_at)
+        SELECT n % {USERS} + 1, 'Title ' || left(md5(n::text), 8), 'Content ' || md5(n::text), now() - n * interval '1 minute'
+        FROM generate_series(1, {POSTS}) AS n
+    """))
+    session.execute(text(f"""
+        INSERT INTO post_like (post_id, user_id)
+        SELECT DISTINCT n * 7919 % {POSTS} + 1, n % {USERS} + 1
+        FROM generate_series(1, {LIKES}) AS n
+    """))
+    session.execute(text("""
+        UPDATE post SET likes_count = counts.likes_count,
+            trending_score = log(2, counts.likes_count) + extract(epoch FROM published_at) / 86400
+        FROM (SELECT post_id, count(*) AS likes_count FROM post_like GROUP BY post_id) AS counts
+        WHERE post.id = counts.post_id
+    """))
+    session.execute(text(f"""
+        INSERT INTO user_follow (follower_id, followee_id)
+        SELECT DISTINCT n % {USERS} + 1, n * 7919 % {USERS} + 1
+        FROM generate_series(1, {FOLLOWS}) AS n
+        WHERE n % {USERS} != n * 7919 % {USERS}
+    """))
+    session.execute(text("""
+        UPDATE "user" SET followers_count = counts.followers_count
+        FROM (SELECT followee_id, count(*) AS followers_count FROM user_follow GROUP BY followee_id) AS counts
+        WHERE "user".id = counts.followee_id
+    """))
+    session.execute(text("""
+        INSERT INTO feed_item (user_id, published_at, post_id, author_id)
+        SELECT follower_id, published_at, post.id, post.user_id
+        FROM user_follow JOIN post ON post.user_id = user_follow.followee_id
+        WHERE post.id % 5 = 0
+    """))
+    # Followed by first user and too popular to be fanned out
+    session.execute(text('INSERT INTO user_follow (follower_id, followee_id) VALUES (1, 2) ON CONFLICT DO NOTHING'))
+    session.execute(text('UPDATE "user" SET followers_count = 1000000 WHERE id = 2'))
+    session.commit()
+    # Also moves GIN entries out of pending list, planner avoids indexes with a long one
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(text('VACUUM ANALYZE'))
+
+
+def capture_statements(client: TestClient, session: Session) -> list[tuple[str, tuple]]:
+    """Send a request to every route and return SQL they ran with parameters"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')) and not executemany:
+            statements.append((statement, parameters))
+
+    event.listen(async_engine.sync_engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        client.headers = {'Authorization': f'Bearer {create_access_token(user_id="1")}'}
+        client.get('posts/', params={'limit': 20})
+        client.get('posts/', params={'limit': 20, 'offset': 100, 'id': [1, 2, 3]})
+        if has_pg_trgm(session):
+            client.get('posts/', params={'limit': 20, 'title': WORD[:6]})
+        response = client.get('posts/', params={'limit': 20})
+        client.get('posts/', params={'limit': 20, 'cursor': response.headers['X-Next-Cursor']}, headers={'If-None-Match': '"0"'})
+        client.get('posts/export', params={'id': [1, 2, 3]})
+        client.get('posts/search', params={'q': WORD})
+        client.get('posts/search', params={'q': WORD, 'limit': 1, 'cursor': client.get(
+            'posts/search', params={'q': WORD, 'limit': 1}
+        ).headers['X-Next-Cursor']})
+        client.get('posts/trending')
+        client.get('posts/1', headers={'If-None-Match': '"0"'})
+        post_id = client.post('posts/', json={'title': 'title', 'content': 'content'}).json()['id']
+        client.post('posts/bulk', json={'posts': [{'title': 'title', 'content': 'content'}] * 2})
+        client.patch(f'posts/{post_id}', json={'title': 'updated title'})
+        client.patch('posts/bulk', json={'posts': [{'id': post_id, 'title': 'updated title'}]})
+        client.post(f'posts/{post_id}/like')
+        client.post(f'posts/{post_id}/unlike')
+        client.post('posts/likes', json={'action': 'like', 'post_ids': [1, 2, 3]})
+        client.post('posts/likes', json={'action': 'unlike', 'post_ids': [1, 2, 3]})
+        client.delete(f'posts/{post_id}')
+        client.get('users/2', headers={'If-None-Match': '"0"'})
+        client.post('users/3/unfollow')
+        client.post('users/3/follow')
+        response = client.get('feed/')
+        client.get('feed/', params={'cursor': response.headers['X-Next-Cursor']})
+        client.patch('users/', json={'first_name': 'Name'})
+        client.delete('users/picture')
+        client.post('users/', json={
+            'email': 'new@example.com', 'first_name': 'New', 'password': 'password', 'birth_date': '2000-01-01'
+        })
+        client.post('users/login/', data={'username': 'user1@example.com', 'password': 'password'})
+    finally:
+        event.remove(async_engine.sync_engine, 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+
+def find_seq_scans(plan: dict) -> list[str]:
+    """Relations read with sequential scan anywhere in plan tree"""
+    found = [plan['Relation Name']] if plan['Node Type'] == 'Seq Scan' else []
+    for subplan in plan.get('Plans', []):
+        found.extend(find_seq_scans(subplan))
+    return found
+
+
+async def explain(statements: list[tuple[str, tuple]]) -> list[tuple[str, dict]]:
+    engine = create_async_engine(get_async_url(settings.TESTS_DB_URL), poolclass=NullPool)
+    try:
+        async with engine.connect() as connection:
+            # asyncpg decodes json result
+            return [
+                (statement, (await connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {statement}', parameters)).scalar()[0]['Plan'])
+                for statement, parameters in statements
+            ]
+    finally:
+        await engine.dispose()
+
+
+def test_no_seq_scans(client: TestClient, session: Session):
+    seed(session)
+    statements = capture_statements(client, session)
+    assert len(statements) > 20
+    # Run by foreign keys ON DELETE CASCADE when a user is deleted
+    statements += [('DELETE FROM post WHERE user_id = $1', (1,)), ('DELETE FROM post_like WHERE user_id = $1', (1,))]
+    plans = asyncio.run(explain(statements))
+    failures = [
+        f'{", ".join(relations)}:\n{statement}' for statement, plan in plans if (relations := find_seq_scans(plan))
+    ]
+    assert not failures, 'Sequential scans on seeded data:\n\n' + '\n\n'.join(failures)
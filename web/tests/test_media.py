@@ -0,0 +1,136 @@
+import os
+import pytest
+
+from starlette.applications import Starlette
+from starlette.datastructures import Headers
+from starlette.routing import Mount
+
+from app.config import settings
+from app.media import MediaFiles, RangeFileResponse, RangeNotSatisfiable, parse_range, precompress
+
+from .conftest import TestClient
+
+
+@pytest.fixture
+def files_dir(tmp_path) -> str:
+    (tmp_path / 'app.css').write_bytes(b'body { color: red; }\n' * 100)
+    (tmp_path / 'data.bin').write_bytes(bytes(range(256)))
+    (tmp_path / 'image.jpg.refs').write_text('1')
+    return str(tmp_path)
+
+
+@pytest.fixture
+def files_client(files_dir: str) -> TestClient:
+    app = Starlette(routes=[
+        Mount('/files', MediaFiles(directory=files_dir, cache_control='public, no-cache', precompressed=True)),
+    ])
+    return TestClient(app=app)
+
+
+def test_parse_range():
+    assert parse_range('bytes=0-9', 100) == (0, 9)
+    assert parse_range('bytes=90-', 100) == (90, 99)
+    assert parse_range('bytes=90-200', 100) == (90, 99)
+    assert parse_range('bytes=-10', 100) == (90, 99)
+    assert parse_range('bytes=-200', 100) == (0, 99)
+    # Ignored
+    assert parse_range('bytes=0-1,5-6', 100) is None
+    assert parse_range('bytes=9-0', 100) is None
+    assert parse_range('items=0-9', 100) is None
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range('bytes=100-', 100)
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range('bytes=-0', 100)
+
+
+def test_media_cache_control(client: TestClient):
+    user_images_dir = os.path.join(settings.MEDIA_DIR, settings.USER_IMAGES_FOLDER)
+    with open(os.path.join(settings.STATIC_DIR, 'image.jpg'), 'rb') as image_bin, \
+        open(os.path.join(user_images_dir, 'image.jpg'), 'wb') as image_file:
+        image_file.write(image_bin.read())
+
+    response = client.get(f'media/{settings.USER_IMAGES_FOLDER}/image.jpg')
+    assert response.status_code == 200
+    assert response.headers['cache-control'] == 'public, max-age=31536000, immutable'
+    assert response.headers['accept-ranges'] == 'bytes'
+
+    response = client.get(f'media/{settings.USER_IMAGES_FOLDER}/image.jpg', headers={'If-None-Match': response.headers['etag']})
+    assert response.status_code == 304
+    assert response.headers['cache-control'] == 'public, max-age=31536000, immutable'
+
+
+class TestRange:
+    def test_success(self, files_client: TestClient):
+        response = files_client.get('files/data.bin', headers={'Range': 'bytes=10-19'})
+        assert response.status_code == 206
+        assert response.content == bytes(range(10, 20))
+        assert response.headers['content-range'] == 'bytes 10-19/256'
+        assert response.headers['content-length'] == '10'
+
+        response = files_client.get('files/data.bin', headers={'Range': 'bytes=-6'})
+        assert response.status_code == 206
+        assert response.content == bytes(range(250, 256))
+
+        # Resource changed since part was fetched
+        response = files_client.get('files/data.bin', headers={'Range': 'bytes=10-19', 'If-Range': '"outdated"'})
+        assert response.status_code == 200
+        assert response.content == bytes(range(256))
+
+        etag = response.headers['etag']
+        response = files_client.get('files/data.bin', headers={'Range': 'bytes=10-19', 'If-Range': etag})
+        assert response.status_code == 206
+
+    def test_fail(self, files_client: TestClient):
+        response = files_client.get('files/data.bin', headers={'Range': 'bytes=300-'})
+        assert response.status_code == 416
+        assert response.headers['content-range'] == 'bytes */256'
+
+    @pytest.mark.anyio
+    async def test_zerocopysend(self, files_dir: str):
+        path = os.path.join(files_dir, 'data.bin')
+        response = RangeFileResponse(path, stat_result=os.stat(path))
+        response.set_range(Headers({'range': 'bytes=5-9'}))
+        messages = []
+
+        async def send(message):
+            if message['type'] == 'http.response.zerocopysend':
+                message['file'].seek(message['offset'])
+                message = {**message, 'body': message['file'].read(message['count'])}
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': 'GET', 'extensions': {'http.response.zerocopysend': {}}}
+        await response(scope, None, send)
+        assert messages[0]['status'] == 206
+        assert messages[1]['body'] == bytes(range(5, 10))
+
+
+class TestPrecompressed:
+    def test_success(self, files_dir: str, files_client: TestClient):
+        assert precompress(files_dir) == 1  # Only compressible files
+        assert precompress(files_dir) == 0  # Up to date
+        assert sorted(os.listdir(files_dir)) == ['app.css', 'app.css.gz', 'data.bin', 'image.jpg.refs']
+
+        response = files_client.get('files/app.css', headers={'Accept-Encoding': 'gzip, deflate'})
+        assert response.status_code == 200
+        assert response.headers['content-encoding'] == 'gzip'
+        assert response.headers['content-type'].startswith('text/css')
+        assert response.headers['vary'] == 'Accept-Encoding'
+        assert int(response.headers['content-length']) == os.path.getsize(os.path.join(files_dir, 'app.css.gz'))
+        assert response.content == b'body { color: red; }\n' * 100  # Decoded by client
+
+        # Brotli sibling preferred
+        with open(os.path.join(files_dir, 'app.css.br'), 'wb') as br_file:
+            br_file.write(b'brotli')
+        response = files_client.get('files/app.css', headers={'Accept-Encoding': 'gzip, br'})
+        assert response.headers['content-encoding'] == 'br'
+
+    def test_identity(self, files_dir: str, files_client: TestClient):
+        precompress(files_dir)
+        response = files_client.get('files/app.css', headers={'Accept-Encoding': 'identity'})
+        assert response.status_code == 200
+        assert 'content-encoding' not in response.headers
+        assert response.headers['cache-control'] == 'public, no-cache'
+
+    def test_fail_hidden_files(self, files_client: TestClient):
+        response = files_client.get('files/image.jpg.refs')
+        assert response.status_code == 404
@@ -0,0 +1,122 @@
+import logging
+import pytest
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import DataError
+from unittest.mock import patch
+
+from app import models
+from app.config import settings
+from app.metrics import Counter, Histogram, Registry, RequestStats, current_stats, track_queries, CACHE_HITS, CACHE_HIT_RATIO, CACHE_MISSES, REQUESTS, REQUEST_DB_QUERIES
+
+from .conftest import TestClient, async_engine
+
+
+def test_render():
+    registry = Registry()
+    counter = registry.register(Counter('requests_total', 'Requests', ('route',)))
+    histogram = registry.register(Histogram('latency_seconds', 'Latency', ('route',), buckets=(0.1, 1.0)))
+    counter.inc('/a"b')
+    counter.inc('/a"b', amount=2)
+    histogram.observe(0.05, '/a')
+    histogram.observe(0.1, '/a')
+    histogram.observe(5, '/a')
+    assert registry.render() == '\n'.join([
+        '# HELP requests_total Requests',
+        '# TYPE requests_total counter',
+        'requests_total{route="/a\\"b"} 3',
+        '# HELP latency_seconds Latency',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{route="/a",le="0.1"} 2',
+        'latency_seconds_bucket{route="/a",le="1.0"} 2',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+        'latency_seconds_sum{route="/a"} 5.15',
+        'latency_seconds_count{route="/a"} 3',
+    ]) + '\n'
+
+
+def test_metrics(authorized_client: TestClient, test_posts: list[models.Post]):
+    route_requests = REQUESTS.values.get(('GET', '/posts/{id}', '200'), 0)
+    not_found_requests = REQUESTS.values.get(('GET', '/posts/{id}', '404'), 0)
+    queries = REQUEST_DB_QUERIES.values.get(('GET', '/posts/{id}'), ([], [0]))[1][0]
+
+    authorized_client.get(f'posts/{test_posts[0].id}')
+    authorized_client.get(f'posts/{test_posts[1].id}')
+    authorized_client.get('posts/0')
+    authorized_client.get('static/missing.css')
+
+    # Labeled by route template, not by concrete path
+    assert REQUESTS.values[('GET', '/posts/{id}', '200')] == route_requests + 2
+    assert REQUESTS.values[('GET', '/posts/{id}', '404')] == not_found_requests + 1
+    assert REQUESTS.values[('GET', '/static/{path}', '404')] >= 1
+    # User loaded by first request only, then cached, post loaded by every request
+    assert REQUEST_DB_QUERIES.values[('GET', '/posts/{id}')][1][0] == queries + 4
+
+    response = authorized_client.get('metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain; version=0.0.4')
+    assert 'http_requests_total{method="GET",route="/posts/{id}",status="200"}' in response.text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/posts/{id}",le="+Inf"}' in response.text
+    assert 'http_requests_in_progress 1' in response.text  # Request for metrics itself
+
+
+def test_cache_metrics(authorized_client: TestClient, test_posts: list[models.Post]):
+    authorized_client.get('metrics')
+    hits, misses = CACHE_HITS.values[('posts',)], CACHE_MISSES.values[('posts',)]
+
+    authorized_client.get('posts/')
+    authorized_client.get('posts/')
+
+    response = authorized_client.get('metrics')
+    assert (CACHE_HITS.values[('posts',)], CACHE_MISSES.values[('posts',)]) == (hits + 1, misses + 1)
+    assert CACHE_HIT_RATIO.values[('posts',)] == (hits + 1) / (hits + misses + 2)
+    assert 'cache_entries{cache="posts"} 1' in response.text
+    assert 'cache_evictions{cache="posts"} 0' in response.text
+
+
+def test_query_budget(authorized_client: TestClient, test_posts: list[models.Post], caplog: pytest.LogCaptureFixture):
+    with caplog.at_level(logging.WARNING, logger='app.metrics'):
+        with patch.object(settings, 'QUERY_BUDGETS', {'/posts/{id}': 1}):
+            authorized_client.get(f'posts/{test_posts[0].id}')  # Loads current user too
+            authorized_client.get(f'posts/{test_posts[0].id}')  # Within budget, user is cached
+        authorized_client.get(f'posts/{test_posts[0].id}')
+    assert len(caplog.records) == 1
+    message = caplog.records[0].getMessage()
+    assert message.startswith('GET /posts/{id} ran 2 queries, budget is 1:\n')
+    assert 'FROM "user"' in message and 'FROM post' in message  # Offending statements attached
+
+
+def test_query_route_comments(authorized_client: TestClient, test_posts: list[models.Post]):
+    statements = []
+
+    def after_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(async_engine.sync_engine, 'after_cursor_execute', after_cursor_execute)
+    try:
+        authorized_client.get(f'posts/{test_posts[0].id}')
+    finally:
+        event.remove(async_engine.sync_engine, 'after_cursor_execute', after_cursor_execute)
+    assert statements
+    assert all(statement.endswith(" /* route='GET /posts/{id}' */") for statement in statements)
+
+
+def test_query_time_after_failed_statement():
+    engine = create_engine(settings.TESTS_DB_URL, pool_size=1)
+    track_queries(engine)
+    stats = RequestStats({'type': 'http', 'method': 'GET'})
+    token = current_stats.set(stats)
+    try:
+        with engine.connect() as conn:
+            info = dict(conn.info)
+            with patch('app.metrics.perf_counter', side_effect=[1.0, 10.0, 11.0]):
+                with pytest.raises(DataError):
+                    conn.execute(text('SELECT 1 / 0'))
+                conn.rollback()
+                conn.execute(text('SELECT 1'))
+            # Timed from its own start and nothing left on pooled connection by failed statement
+            assert (stats.queries, stats.db_time) == (1, 1.0)
+            assert conn.info == info
+    finally:
+        current_stats.reset(token)
+        engine.dispose()
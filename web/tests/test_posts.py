@@ -1,7 +1,12 @@
+from datetime import timedelta
+from typing import Callable
+from unittest.mock import patch
 from sqlalchemy.orm import Session
 
 from app import schemas
 from app import models
+from app.config import settings
+from app.trending import trending_posts
 
 from .conftest import TestClient
 
@@ -60,12 +65,244 @@ class TestGetPosts:
         assert len(json) == 2
         assert all([str(post['id']) in posts_ids[:3] for post in json])
 
+    def test_cursor_success(self, authorized_client: TestClient, test_posts: list[models.Post]):
+        expected_ids = [post['id'] for post in authorized_client.get('posts/').json()]
+
+        # Walk all pages with cursor
+        received_ids = []
+        response = authorized_client.get('posts/?limit=2')
+        while True:
+            assert response.status_code == 200
+            received_ids += [post['id'] for post in response.json()]
+            cursor = response.headers.get('X-Next-Cursor')
+            if cursor is None:
+                break
+            response = authorized_client.get(f'posts/?limit=2&cursor={cursor}')
+        assert received_ids == expected_ids
+
+        # Cursor combined with "ids" and "title" query parameters
+        posts_ids = [post.id for post in test_posts]
+        response = authorized_client.get(f'posts/?id={posts_ids[0]}&id={posts_ids[1]}&id={posts_ids[2]}&limit=1&title=Title')
+        cursor = response.headers['X-Next-Cursor']
+        response = authorized_client.get(f'posts/?id={posts_ids[0]}&id={posts_ids[1]}&id={posts_ids[2]}&limit=5&title=Title&cursor={cursor}')
+        json = response.json()
+        assert response.status_code == 200
+        assert len(json) == 2
+        assert 'X-Next-Cursor' not in response.headers
+        assert all([post['id'] in posts_ids[:3] for post in json])
+
     def test_fail(self, client: TestClient):
         # Not authenticated
         response = client.get('posts/')
         assert response.status_code == 401
         assert response.json() == {'detail': 'Not authenticated'}
 
+    def test_bounds_fail(self, authorized_client: TestClient):
+        # Limit and offset out of bounds
+        response = authorized_client.get('posts/?limit=0')
+        assert response.status_code == 422
+        response = authorized_client.get('posts/?offset=-1')
+        assert response.status_code == 422
+
+    def test_conditional_get(self, authorized_client: TestClient, session: Session, test_posts: list[models.Post]):
+        response = authorized_client.get('posts/?limit=2')
+        etag = response.headers['ETag']
+        cursor = response.headers['X-Next-Cursor']
+
+        # Page not changed
+        response = authorized_client.get('posts/?limit=2', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.content == b''
+        assert response.headers['ETag'] == etag
+        assert response.headers['X-Next-Cursor'] == cursor
+
+        # Other page
+        response = authorized_client.get('posts/?limit=3', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
+        # Post on the page liked
+        posts_ids = [post['id'] for post in authorized_client.get('posts/?limit=2').json()]
+        authorized_client.post(f'posts/{posts_ids[0]}/like')
+        response = authorized_client.get('posts/?limit=2', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+
+    def test_response_cache(self, authorized_client: TestClient, test_posts: list[models.Post]):
+        response = authorized_client.get('posts/?limit=2&title=Title')
+        assert response.headers['X-Cache'] == 'MISS'
+        json = response.json()
+
+        # Same normalized parameters
+        response = authorized_client.get('posts/?title=Title&limit=2&offset=0')
+        assert response.headers['X-Cache'] == 'HIT'
+        assert response.json() == json
+        assert response.headers['ETag'] and response.headers['X-Next-Cursor']
+        response = authorized_client.get('posts/?title=Title&limit=2', headers={'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+        assert response.headers['X-Cache'] == 'HIT'
+
+        # Writes invalidate cache
+        response = authorized_client.post('posts/', json={'title': 'Title new', 'content': 'new content'})
+        new_post_id = response.json()['id']
+        response = authorized_client.get('posts/?limit=2&title=Title')
+        assert response.headers['X-Cache'] == 'MISS'
+        assert response.json()[0]['id'] == new_post_id
+
+        authorized_client.post(f'posts/{new_post_id}/like')
+        response = authorized_client.get('posts/?limit=2&title=Title')
+        assert response.headers['X-Cache'] == 'MISS'
+        assert response.json()[0]['likes_count'] == 1
+
+    def test_queries(self, authorized_client: TestClient, test_posts: list[models.Post], max_queries):
+        with max_queries(2):
+            response = authorized_client.get('posts/?limit=2')
+            authorized_client.get('posts/?limit=2', headers={'If-None-Match': response.headers['ETag']})
+
+    def test_cursor_fail(self, authorized_client: TestClient, test_posts: list[models.Post]):
+        # Malformed cursor
+        response = authorized_client.get('posts/?cursor=invalid')
+        assert response.status_code == 400
+        assert response.json() == {'detail': 'Invalid cursor'}
+
+
+class TestExportPosts:
+    def test_success(self, authorized_client: TestClient, test_posts: list[models.Post]):
+        with patch.object(settings, 'EXPORT_BATCH_SIZE', 2):  # Several batches
+            response = authorized_client.get('posts/export')
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        lines = response.text.splitlines()
+        assert len(lines) == len(test_posts)
+        posts = [schemas.PostOut.parse_raw(line) for line in lines]
+        assert [post.id for post in posts] == [post['id'] for post in authorized_client.get('posts/').json()]
+
+        # Filters same as for posts listing
+        posts_ids = [post.id for post in test_posts]
+        response = authorized_client.get(f'posts/export?id={posts_ids[0]}&id={posts_ids[1]}&title=Title1')
+        lines = response.text.splitlines()
+        assert len(lines) == 1
+        assert schemas.PostOut.parse_raw(lines[0]).id == posts_ids[0]
+
+    def test_fail(self, client: TestClient):
+        # Not authenticated
+        response = client.get('posts/export')
+        assert response.status_code == 401
+        assert response.json() == {'detail': 'Not authenticated'}
+
+
+class TestSearchPosts:
+    def test_success(self, authorized_client: TestClient, session: Session, user_obj: models.User, test_posts: list[models.Post]):
+        test_posts[0].title, test_posts[0].content = 'Gardening tips', 'Water tomatoes in the morning'
+        test_posts[1].title, test_posts[1].content = 'Cooking', 'Fresh tomatoes make the best sauce'
+        test_posts[2].title, test_posts[2].content = 'Tomatoes', 'All about tomatoes and tomato growing'
+        session.commit()
+
+        response = authorized_client.get('posts/search?q=tomatoes')
+        assert response.status_code == 200
+        json = response.json()
+        assert len(list(map(lambda post: schemas.PostOut(**post), json))) == 3
+        assert json[0]['id'] == test_posts[2].id  # Title match ranks highest
+        assert {post['id'] for post in json} == {post.id for post in test_posts[:3]}
+
+        # Nothing found
+        response = authorized_client.get('posts/search?q=spaceship')
+        assert response.status_code == 200
+        assert response.json() == []
+
+        # Cursor paging preserves rank order
+        received_ids = []
+        response = authorized_client.get('posts/search?q=tomatoes&limit=1')
+        while True:
+            assert response.status_code == 200
+            received_ids += [post['id'] for post in response.json()]
+            cursor = response.headers.get('X-Next-Cursor')
+            if cursor is None:
+                break
+            response = authorized_client.get(f'posts/search?q=tomatoes&limit=1&cursor={cursor}')
+        assert received_ids == [post['id'] for post in json]
+
+    def test_fail(self, authorized_client: TestClient):
+        # Missing query
+        response = authorized_client.get('posts/search')
+        assert response.status_code == 422
+
+        # Malformed cursor
+        response = authorized_client.get('posts/search?q=tomatoes&cursor=invalid')
+        assert response.status_code == 400
+        assert response.json() == {'detail': 'Invalid cursor'}
+
+        # Not authenticated
+        response = authorized_client.get('posts/search?q=tomatoes', headers={'Authorization': ''})
+        assert response.status_code == 401
+        assert response.json() == {'detail': 'Not authenticated'}
+
+
+class TestTrendingPosts:
+    def test_success(
+        self,
+        authorized_client: TestClient,
+        session: Session,
+        extra_user_obj: models.User,
+        auth_headers: Callable[[models.User], dict[str, str]],
+        test_posts: list[models.Post]
+    ):
+        posts_ids = [post.id for post in test_posts]
+        # Two likes two half-lives ago weigh less than one fresh like
+        test_posts[0].published_at -= timedelta(hours=settings.TRENDING_HALF_LIFE_HOURS * 2)
+        session.commit()
+        extra_user_headers = auth_headers(extra_user_obj)
+        for post_id in (posts_ids[0], posts_ids[2]):
+            authorized_client.post(f'posts/{post_id}/like')
+            authorized_client.post(f'posts/{post_id}/like', headers=extra_user_headers)
+        authorized_client.post(f'posts/{posts_ids[1]}/like')
+
+        response = authorized_client.get('posts/trending')
+        assert response.status_code == 200
+        json = response.json()
+        assert len(list(map(lambda post: schemas.PostOut(**post), json))) == 3
+        assert [post['id'] for post in json] == [posts_ids[2], posts_ids[1], posts_ids[0]]  # Posts without likes left out
+        assert [post['likes_count'] for post in json] == [2, 1, 2]
+        response = authorized_client.get('posts/trending?limit=2')
+        assert [post['id'] for post in response.json()] == [posts_ids[2], posts_ids[1]]
+
+        # Served from memory until refresh
+        authorized_client.post(f'posts/{posts_ids[2]}/unlike')
+        authorized_client.post(f'posts/{posts_ids[2]}/unlike', headers=extra_user_headers)
+        response = authorized_client.get('posts/trending')
+        assert [post['id'] for post in response.json()] == [posts_ids[2], posts_ids[1], posts_ids[0]]
+        with patch.object(trending_posts, 'refresh_seconds', 0):
+            response = authorized_client.get('posts/trending')  # Stale list is returned and refreshed after response
+            assert [post['id'] for post in response.json()] == [posts_ids[2], posts_ids[1], posts_ids[0]]
+        response = authorized_client.get('posts/trending')
+        assert [post['id'] for post in response.json()] == [posts_ids[1], posts_ids[0]]
+
+        # Deleted post is dropped at once
+        authorized_client.delete(f'posts/{posts_ids[1]}')
+        response = authorized_client.get('posts/trending')
+        assert [post['id'] for post in response.json()] == [posts_ids[0]]
+
+    def test_fail(self, authorized_client: TestClient):
+        # Limit out of bounds
+        response = authorized_client.get('posts/trending?limit=0')
+        assert response.status_code == 422
+        response = authorized_client.get(f'posts/trending?limit={settings.TRENDING_SIZE + 1}')
+        assert response.status_code == 422
+
+        # Not authenticated
+        response = authorized_client.get('posts/trending', headers={'Authorization': ''})
+        assert response.status_code == 401
+        assert response.json() == {'detail': 'Not authenticated'}
+
+    def test_queries(self, authorized_client: TestClient, test_posts: list[models.Post], max_queries):
+        authorized_client.post(f'posts/{test_posts[0].id}/like')
+        with max_queries(2):
+            authorized_client.get('posts/trending')
+        # Answered from memory
+        with max_queries(1):
+            response = authorized_client.get('posts/trending')
+        assert [post['id'] for post in response.json()] == [test_posts[0].id]
+
 
 class TestCreatePost:
     def test_success(self, authorized_client: TestClient, user_obj: models.User):
@@ -90,6 +327,48 @@ class TestCreatePost:
         assert response.json() == {'detail': 'Not authenticated'}
 
 
+    def test_queries(self, authorized_client: TestClient, max_queries):
+        # Current user, inserted post and fan-out to followers after response
+        with max_queries(4):
+            authorized_client.post('posts/', json={'title': 'new title', 'content': 'new content'})
+
+
+class TestBulkCreatePosts:
+    def test_success(self, authorized_client: TestClient, session: Session, user_obj: models.User):
+        posts_data = [{'title': f'title {n}', 'content': f'content {n}'} for n in range(3)]
+        response = authorized_client.post('posts/bulk', json={'posts': posts_data})
+        assert response.status_code == 201
+        json = response.json()
+        assert [schemas.PostOut(**post).title for post in json] == ['title 0', 'title 1', 'title 2']
+        assert all(post['user_id'] == user_obj.id and post['likes_count'] == 0 for post in json)
+        assert session.query(models.Post).count() == 3
+
+    def test_fail(self, authorized_client: TestClient, session: Session):
+        # Invalid item, none is created
+        posts_data = [{'title': 'title', 'content': 'content'}, {'title': 'a', 'content': 'content'}]
+        response = authorized_client.post('posts/bulk', json={'posts': posts_data})
+        assert response.status_code == 422
+        assert response.json()['detail'][0]['loc'] == ['body', 'posts', 1, 'title']
+        assert session.query(models.Post).count() == 0
+
+        # Empty and too large batches
+        response = authorized_client.post('posts/bulk', json={'posts': []})
+        assert response.status_code == 422
+        response = authorized_client.post('posts/bulk', json={'posts': [posts_data[0]] * 1001})
+        assert response.status_code == 422
+
+        # Not authenticated
+        response = authorized_client.post('posts/bulk', json={'posts': posts_data[:1]}, headers={'Authorization': ''})
+        assert response.status_code == 401
+        assert response.json() == {'detail': 'Not authenticated'}
+
+    def test_queries(self, authorized_client: TestClient, max_queries):
+        # Current user, single INSERT and fan-out to followers after response
+        with max_queries(3):
+            response = authorized_client.post('posts/bulk', json={'posts': [{'title': 'title', 'content': 'content'}] * 100})
+        assert response.status_code == 201
+
+
 class TestGetPost:
     def test_get_post_success(self, authorized_client: TestClient, test_posts: list[models.Post]):
         test_post = test_posts[0]
@@ -101,6 +380,35 @@ class TestGetPost:
         assert json['content'] == test_post.content
         assert json['likes_count'] == 0
 
+    def test_get_post_conditional(self, authorized_client: TestClient, test_posts: list[models.Post]):
+        test_post = test_posts[0]
+        response = authorized_client.get(f'posts/{test_post.id}')
+        etag = response.headers['ETag']
+
+        response = authorized_client.get(f'posts/{test_post.id}', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        response = authorized_client.get(f'posts/{test_post.id}', headers={'If-None-Match': f'"other", W/{etag}'})
+        assert response.status_code == 304
+
+        # Post updated
+        authorized_client.patch(f'posts/{test_post.id}', json={'title': 'updated title'})
+        response = authorized_client.get(f'posts/{test_post.id}', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        assert response.json()['title'] == 'updated title'
+
+        # Post liked
+        etag = response.headers['ETag']
+        authorized_client.post(f'posts/{test_post.id}/like')
+        response = authorized_client.get(f'posts/{test_post.id}', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.json()['likes_count'] == 1
+
+        # Not found
+        response = authorized_client.get('posts/0', headers={'If-None-Match': etag})
+        assert response.status_code == 404
+
     def test_get_post_fail(self, authorized_client: TestClient, test_posts: list[models.Post]):
         # Not found
         response = authorized_client.get('posts/0')
@@ -114,8 +422,13 @@ class TestGetPost:
         assert response.json() == {'detail': 'Not authenticated'}
 
 
+    def test_queries(self, authorized_client: TestClient, test_posts: list[models.Post], max_queries):
+        with max_queries(2):
+            authorized_client.get(f'posts/{test_posts[0].id}')
+
+
 class TestUpdatePost:
-    def test_update_post_success(self, authorized_client: TestClient, test_posts: list[models.Post]):
+    def test_update_post_success(self, authorized_client: TestClient, session: Session, test_posts: list[models.Post]):
         test_post = test_posts[0]
         response = authorized_client.patch(f'posts/{test_post.id}', json={'title': 'updated title', 'content': 'updated content'})
         assert response.status_code == 200
@@ -123,6 +436,7 @@ class TestUpdatePost:
         assert json['id'] == test_post.id
         assert json['title'] == 'updated title'
         assert json['content'] == 'updated content'
+        session.refresh(test_post)
         assert test_post.title == 'updated title'
         assert test_post.content == 'updated content'
 
@@ -163,6 +477,76 @@ class TestUpdatePost:
         assert response.json() == {'detail': 'Post not found'}
 
 
+    def test_queries(self, authorized_client: TestClient, test_posts: list[models.Post], max_queries):
+        with max_queries(2):
+            response = authorized_client.patch(f'posts/{test_posts[0].id}', json={'title': 'updated title'})
+        assert response.status_code == 200
+
+
+class TestBulkUpdatePosts:
+    def test_success(self, authorized_client: TestClient, session: Session, test_posts: list[models.Post]):
+        posts_data = [
+            {'id': test_posts[1].id, 'title': 'updated title'},
+            {'id': test_posts[0].id, 'content': 'updated content', 'is_active': False},
+        ]
+        response = authorized_client.patch('posts/bulk', json={'posts': posts_data})
+        assert response.status_code == 200
+        json = response.json()
+        # Same order as in request
+        assert [post['id'] for post in json] == [test_posts[1].id, test_posts[0].id]
+        assert json[0]['title'] == 'updated title'
+        assert json[0]['content'] == test_posts[1].content
+        assert json[1]['title'] == test_posts[0].title
+        assert json[1]['content'] == 'updated content'
+        assert json[1]['is_active'] is False
+        session.refresh(test_posts[0])
+        assert test_posts[0].content == 'updated content'
+        assert test_posts[0].updated_at > test_posts[0].published_at
+
+    def test_fail(
+        self,
+        authorized_client: TestClient,
+        session: Session,
+        test_posts: list[models.Post],
+        extra_user_obj: models.User
+    ):
+        # Invalid payload
+        response = authorized_client.patch('posts/bulk', json={'posts': [{'id': test_posts[0].id, 'title': 'a'}]})
+        assert response.status_code == 422
+        response = authorized_client.patch('posts/bulk', json={'posts': [{'id': test_posts[0].id}] * 2})
+        assert response.status_code == 422
+
+        # Not found and not owned posts, none is updated
+        test_posts[1].user_id = extra_user_obj.id
+        session.commit()
+        posts_data = [
+            {'id': test_posts[0].id, 'title': 'updated title'},
+            {'id': 0, 'title': 'updated title'},
+            {'id': test_posts[1].id, 'title': 'updated title'},
+        ]
+        response = authorized_client.patch('posts/bulk', json={'posts': posts_data})
+        assert response.status_code == 404
+        assert response.json() == {'detail': [
+            {'loc': ['body', 'posts', 1, 'id'], 'msg': 'Post not found', 'type': 'not_found'},
+            {'loc': ['body', 'posts', 2, 'id'], 'msg': 'Post not found', 'type': 'not_found'},
+        ]}
+        session.refresh(test_posts[0])
+        assert test_posts[0].title != 'updated title'
+
+        # Not authenticated
+        response = authorized_client.patch('posts/bulk', json={'posts': posts_data[:1]}, headers={'Authorization': ''})
+        assert response.status_code == 401
+        assert response.json() == {'detail': 'Not authenticated'}
+
+    def test_queries(self, authorized_client: TestClient, test_posts: list[models.Post], max_queries):
+        # Current user and single UPDATE
+        with max_queries(2):
+            response = authorized_client.patch('posts/bulk', json={
+                'posts': [{'id': post.id, 'title': 'updated title'} for post in test_posts]
+            })
+        assert response.status_code == 200
+
+
 class TestDeletePost:
     def test_success(self, authorized_client: TestClient, session: Session, test_posts: list[models.Post]):
         test_post = test_posts[0]
@@ -191,6 +575,36 @@ class TestDeletePost:
         assert response.json() == {'detail': 'Post not found'}
 
 
+class TestBulkLikePosts:
+    def test_success(self, authorized_client: TestClient, session: Session, user_obj: models.User, test_posts: list[models.Post]):
+        posts_ids = [post.id for post in test_posts]
+        session.add(models.PostLike(post_id=posts_ids[0], user=user_obj))
+        test_posts[0].likes_count = 1
+        session.commit()
+
+        response = authorized_client.post('posts/likes', json={'action': 'like', 'post_ids': posts_ids[:3]})
+        assert response.status_code == 200
+        assert response.json() == {'changed': posts_ids[1:3]}
+        assert session.query(models.PostLike).filter(models.PostLike.user_id == user_obj.id).count() == 3
+
+        response = authorized_client.post('posts/likes', json={'action': 'unlike', 'post_ids': posts_ids[1:]})
+        assert response.status_code == 200
+        assert response.json() == {'changed': posts_ids[1:3]}
+        assert [post.likes_count for post in session.query(models.Post).order_by(models.Post.id)] == [1, 0, 0, 0, 0]
+
+    def test_fail(self, authorized_client: TestClient, test_posts: list[models.Post]):
+        # Invalid payload
+        response = authorized_client.post('posts/likes', json={'action': 'share', 'post_ids': [test_posts[0].id]})
+        assert response.status_code == 422
+        response = authorized_client.post('posts/likes', json={'action': 'like', 'post_ids': []})
+        assert response.status_code == 422
+
+        # Not authenticated
+        response = authorized_client.post('posts/likes', json={'action': 'like', 'post_ids': [test_posts[0].id]}, headers={'Authorization': ''})
+        assert response.status_code == 401
+        assert response.json() == {'detail': 'Not authenticated'}
+
+
 class TestLikePost:
     def test_like_post_success(self, authorized_client: TestClient, session: Session, user_obj: models.User, test_posts: list[models.Post]):
         test_post_id = test_posts[0].id
@@ -205,6 +619,12 @@ class TestLikePost:
         assert test_post_like.user_id == user_id
         assert test_post_like.post_id == test_post_id
 
+        # Denormalized counter updated
+        session.refresh(test_posts[0])
+        assert test_posts[0].likes_count == 1
+        response = authorized_client.get(f'posts/{test_post_id}')
+        assert response.json()['likes_count'] == 1
+
     def test_like_post_fail(self, authorized_client: TestClient, session: Session, user_obj: models.User, test_posts: list[models.Post]):
         test_post = test_posts[0]
         assert session.query(models.PostLike).count() == 0
@@ -241,6 +661,12 @@ class TestLikePost:
         assert session.query(models.PostLike).filter(models.PostLike.post_id == test_post.id).count() == 0
 
 
+    def test_queries(self, authorized_client: TestClient, test_posts: list[models.Post], max_queries):
+        with max_queries(2):
+            response = authorized_client.post(f'posts/{test_posts[0].id}/like')
+        assert response.status_code == 201
+
+
 class TestUnlikePost:
     def test_unlike_post_success(self,
         authorized_client: TestClient,
@@ -252,11 +678,14 @@ class TestUnlikePost:
         # Create PostLike object
         like_obj = models.PostLike(post_id=test_post_id, user=user_obj)
         session.add(like_obj)
+        test_posts[0].likes_count = 1
         session.commit()
 
         response = authorized_client.post(f'posts/{test_post_id}/unlike')
         assert response.status_code == 204
         assert session.query(models.PostLike).filter(models.PostLike.post_id == test_post_id).count() == 0
+        session.refresh(test_posts[0])
+        assert test_posts[0].likes_count == 0
 
     def test_unlike_post_fail(
         self,
@@ -0,0 +1,27 @@
+import json
+from datetime import datetime, timezone
+
+from app import models, schemas
+from app.responses import ORMListResponse
+
+
+def test_orm_list_response():
+    posts = [
+        models.Post(
+            id=n, user_id=1, title=f'Title{n}', content=f'Content{n}', is_active=True, likes_count=n,
+            published_at=datetime(2024, 2, 12, 23, 25, 58, 213498, tzinfo=timezone.utc),
+            updated_at=datetime(2024, 2, 12, 23, 25, 58, tzinfo=timezone.utc),
+        )
+        for n in range(3)
+    ]
+    response = ORMListResponse(posts, schemas.PostOut, headers={'X-Next-Cursor': 'cursor'})
+    assert response.headers['X-Next-Cursor'] == 'cursor'
+    assert response.media_type == 'application/json'
+    # Same output as serializing through validated schema
+    assert json.loads(response.body) == [json.loads(schemas.PostOut.from_orm(post).json()) for post in posts]
+
+
+def test_orm_list_response_getters():
+    user = models.User(id=1, email='test@mail.com', first_name='Joe', birth_date=datetime(2000, 1, 1).date(), profile_picture='image.jpg')
+    response = ORMListResponse([user], schemas.UserOut)
+    assert json.loads(response.body) == [json.loads(schemas.UserOut.from_orm(user).json())]
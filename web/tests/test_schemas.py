@@ -0,0 +1,33 @@
+from datetime import date
+
+from app import models, schemas
+from app.config import settings
+
+
+def build_user(**kwargs) -> models.User:
+    return models.User(**{'id': 1, 'email': 'test@mail.com', 'first_name': 'Joe', 'birth_date': date(2000, 1, 1), **kwargs})
+
+
+def test_from_orm_getters():
+    user = build_user(profile_picture='image.jpg')
+    user_data = schemas.UserOut.from_orm(user)
+    assert user_data.dict() == {
+        'id': 1, 'email': 'test@mail.com', 'first_name': 'Joe', 'birth_date': date(2000, 1, 1),
+        'profile_picture': f'{settings.HOSTNAME}/media/images/image.jpg',
+        # Derivatives not generated yet
+        'profile_picture_sizes': {size: f'{settings.HOSTNAME}/media/images/image.jpg' for size in settings.AVATAR_SIZES},
+    }
+    assert user.profile_picture == 'image.jpg'  # Source object untouched
+
+    assert schemas.UserOut.from_orm(build_user()).profile_picture is None
+
+
+def test_from_orm_getter_binding():
+    user = build_user(profile_picture='image.jpg')
+    user_data = schemas.UserOut.from_orm(user, getter_binding={
+        'first_name': lambda obj: obj.first_name.upper(),
+        'profile_picture': lambda obj: None,
+    })
+    assert user_data.first_name == 'JOE'
+    assert user_data.profile_picture is None
+    assert (user.first_name, user.profile_picture) == ('Joe', 'image.jpg')
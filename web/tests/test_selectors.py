@@ -1,14 +1,18 @@
+import pytest
+
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from app.selectors import get_user
 from app import models
 
 
-def test_get_user(user_obj: models.User, session: Session):
+@pytest.mark.anyio
+async def test_get_user(user_obj: models.User, session: Session, async_session: AsyncSession):
     # User found
     assert \
-        get_user(id=user_obj.id, db=session).first_name == \
+        (await get_user(id=user_obj.id, db=async_session)).first_name == \
         session.query(models.User).filter(models.User.id == user_obj.id).first().first_name
 
     # User not found
-    assert get_user(id=user_obj.id+100, db=session) is None
+    assert await get_user(id=user_obj.id+100, db=async_session) is None
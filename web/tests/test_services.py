@@ -0,0 +1,168 @@
+import os
+import pytest
+import shutil
+
+from unittest.mock import patch
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.services import like_posts, unlike_posts, reconcile_likes_count, recalculate_trending_scores, migrate_user_images, fan_out_posts, rebuild_feeds
+from app.config import settings
+from app.storages import local_storage
+from app import models
+
+
+@pytest.mark.anyio
+async def test_like_posts(session: Session, async_session: AsyncSession, user_obj: models.User, test_posts: list[models.Post]):
+    test_posts[1].is_active = False
+    session.commit()
+    updated_at = test_posts[0].updated_at
+    post_ids = [test_posts[0].id, test_posts[1].id, 0]
+
+    found, liked = await like_posts(post_ids=post_ids, user_id=user_obj.id, db=async_session)
+    await async_session.commit()
+    assert found == {test_posts[0].id}  # Inactive and unexisting posts skipped
+    assert liked == {test_posts[0].id}
+    session.refresh(test_posts[0])
+    assert test_posts[0].likes_count == 1
+    assert test_posts[0].updated_at == updated_at  # Content timestamp untouched
+    half_life = settings.TRENDING_HALF_LIFE_HOURS * 3600
+    assert test_posts[0].trending_score == pytest.approx(test_posts[0].published_at.timestamp() / half_life)
+
+    # Already liked
+    found, liked = await like_posts(post_ids=post_ids, user_id=user_obj.id, db=async_session)
+    await async_session.commit()
+    assert found == {test_posts[0].id}
+    assert liked == set()
+    session.refresh(test_posts[0])
+    assert test_posts[0].likes_count == 1
+
+
+@pytest.mark.anyio
+async def test_unlike_posts(session: Session, async_session: AsyncSession, user_obj: models.User, extra_user_obj: models.User, test_posts: list[models.Post]):
+    session.add_all([
+        models.PostLike(post_id=test_posts[0].id, user=user_obj),
+        models.PostLike(post_id=test_posts[1].id, user=extra_user_obj),
+    ])
+    test_posts[0].likes_count = test_posts[1].likes_count = 1
+    session.commit()
+
+    unliked = await unlike_posts(post_ids=[test_posts[0].id, test_posts[1].id], user_id=user_obj.id, db=async_session)
+    await async_session.commit()
+    assert unliked == {test_posts[0].id}  # Like of another user untouched
+    session.refresh(test_posts[0])
+    session.refresh(test_posts[1])
+    assert (test_posts[0].likes_count, test_posts[1].likes_count) == (0, 1)
+    assert test_posts[0].trending_score == 0
+
+    assert await unlike_posts(post_ids=[test_posts[0].id], user_id=user_obj.id, db=async_session) == set()
+
+
+@pytest.mark.anyio
+async def test_reconcile_likes_count(
+    session: Session,
+    async_session: AsyncSession,
+    user_obj: models.User,
+    extra_user_obj: models.User,
+    test_posts: list[models.Post]
+):
+    session.add_all([
+        models.PostLike(post_id=test_posts[0].id, user=user_obj),
+        models.PostLike(post_id=test_posts[0].id, user=extra_user_obj),
+    ])
+    test_posts[1].likes_count = 5  # Drifted counter
+    session.commit()
+
+    assert await reconcile_likes_count(db=async_session) == 2
+    assert [(post.id, post.likes_count) for post in session.query(models.Post).order_by(models.Post.id)] == \
+        [(test_posts[0].id, 2)] + [(post.id, 0) for post in test_posts[1:]]
+
+    # Nothing to fix anymore
+    assert await reconcile_likes_count(db=async_session) == 0
+
+
+@pytest.mark.anyio
+async def test_recalculate_trending_scores(session: Session, async_session: AsyncSession, user_obj: models.User, test_posts: list[models.Post]):
+    await like_posts(post_ids=[test_posts[0].id], user_id=user_obj.id, db=async_session)
+    await async_session.commit()
+    session.refresh(test_posts[0])
+    score = test_posts[0].trending_score
+
+    # Half as long half-life doubles age term of score
+    with patch.object(settings, 'TRENDING_HALF_LIFE_HOURS', settings.TRENDING_HALF_LIFE_HOURS / 2):
+        assert await recalculate_trending_scores(db=async_session) == 1  # Posts without likes skipped
+    session.refresh(test_posts[0])
+    assert test_posts[0].trending_score == pytest.approx(score * 2)
+
+
+@pytest.mark.anyio
+async def test_fan_out_posts(
+    session: Session,
+    async_session: AsyncSession,
+    user_obj: models.User,
+    extra_user_obj: models.User,
+    test_posts: list[models.Post]
+):
+    session.add(models.UserFollow(follower_id=extra_user_obj.id, followee_id=user_obj.id))
+    user_obj.followers_count = 1
+    session.commit()
+    post_ids = [post.id for post in test_posts[:2]]
+
+    assert await fan_out_posts(post_ids=post_ids, db=async_session) == 2
+    await async_session.commit()
+    assert sorted(item.post_id for item in session.query(models.FeedItem).filter_by(user_id=extra_user_obj.id)) == post_ids
+    # Already fanned out
+    assert await fan_out_posts(post_ids=post_ids, db=async_session) == 0
+
+    # Popular authors are merged on read
+    with patch.object(settings, 'FEED_FANOUT_MAX_FOLLOWERS', 0):
+        assert await fan_out_posts(post_ids=[test_posts[2].id], db=async_session) == 0
+
+
+@pytest.mark.anyio
+async def test_rebuild_feeds(
+    session: Session,
+    async_session: AsyncSession,
+    user_obj: models.User,
+    extra_user_obj: models.User,
+    test_posts: list[models.Post]
+):
+    # Follow without fan-out and with drifted counter
+    session.add(models.UserFollow(follower_id=extra_user_obj.id, followee_id=user_obj.id))
+    extra_user_obj.followers_count = 3
+    session.commit()
+
+    with patch.object(settings, 'FEED_BACKFILL_POSTS', 4):
+        assert await rebuild_feeds(db=async_session) == 4
+    session.refresh(user_obj)
+    session.refresh(extra_user_obj)
+    assert (user_obj.followers_count, extra_user_obj.followers_count) == (1, 0)
+    feed = session.query(models.FeedItem).filter_by(user_id=extra_user_obj.id).order_by(models.FeedItem.published_at.desc())
+    assert [item.post_id for item in feed] == [post.id for post in sorted(test_posts, key=lambda post: (post.published_at, post.id), reverse=True)][:4]
+
+    # Nothing to add anymore
+    with patch.object(settings, 'FEED_BACKFILL_POSTS', 4):
+        assert await rebuild_feeds(db=async_session) == 0
+
+
+@pytest.mark.anyio
+async def test_migrate_user_images(session: Session, async_session: AsyncSession, user_obj: models.User, extra_user_obj: models.User):
+    user_images_dir = os.path.join(settings.MEDIA_DIR, settings.USER_IMAGES_FOLDER)
+    for user, file_name in ((user_obj, 'first.jpg'), (extra_user_obj, 'second.jpg')):
+        shutil.copy(os.path.join(settings.STATIC_DIR, 'image.jpg'), os.path.join(user_images_dir, file_name))
+        user.profile_picture = file_name
+    session.commit()
+
+    assert await migrate_user_images(db=async_session) == 2
+    local_storage.shutdown(wait=True)
+    session.refresh(user_obj)
+    session.refresh(extra_user_obj)
+    assert user_obj.profile_picture == extra_user_obj.profile_picture  # Deduplicated
+    assert local_storage.is_content_file_name(user_obj.profile_picture)
+    assert not {'first.jpg', 'second.jpg'} & set(os.listdir(user_images_dir))  # Old files deleted
+    with open(os.path.join(user_images_dir, f'{user_obj.profile_picture}.refs')) as refs_file:
+        assert refs_file.read() == '2'
+
+    # Already migrated
+    assert await migrate_user_images(db=async_session) == 0
@@ -1,14 +1,21 @@
+import hashlib
 import os
 import uuid
+import pytest
 
 from unittest.mock import patch
+from PIL import Image
 from datetime import datetime, timedelta
+from typing import Callable
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from app import schemas
 from app import models
-from app.auth import get_current_user
+from app.auth import get_current_user, user_cache, token_cache
 from app.config import settings
+from app.storages import local_storage
+from app.utils import hashing_pool
 
 from .conftest import TestClient
 
@@ -41,12 +48,13 @@ class TestRegister:
 
 
 class TestLogin:
-    def test_login_success(self, client: TestClient, session: Session, user_obj: models.User):
+    @pytest.mark.anyio
+    async def test_login_success(self, client: TestClient, async_session: AsyncSession, user_obj: models.User):
         response = client.post('users/login/', data={'username': user_obj.email, 'password': user_obj.plain_password})
         assert response.status_code == 200
         data = schemas.Token(**response.json())
         assert data.type == 'bearer'
-        assert get_current_user(token=data.access_token, db=session) == user_obj  # Validate token
+        assert (await get_current_user(token=data.access_token, db=async_session)).id == user_obj.id  # Validate token
 
     def test_login_fail(self, client: TestClient, session: Session, user_obj: models.User):
         # Invalid payload
@@ -60,8 +68,16 @@ class TestLogin:
         assert response.status_code == 403
         assert response.json() == {'detail': 'Invalid credentials'}
 
+        # Password hashing queue is full
+        with patch('app.utils.hashing_pool.pending', hashing_pool.max_pending):
+            response = client.post('users/login/', data={'username': user_obj.email, 'password': user_obj.plain_password})
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+        assert response.json() == {'detail': 'Server is busy, try again later'}
+
         # Unexisting user email
         session.query(models.User).filter(models.User.id == user_obj.id).delete()
+        session.commit()
         response = client.post('users/login/', data={'username': user_obj.email, 'password': user_obj.plain_password})
         assert response.status_code == 403
         assert response.json() == {'detail': 'Invalid credentials'}
@@ -86,6 +102,82 @@ class TestGetUser:
         assert response.json() == {'detail': 'User not found'}
 
 
+class TestGetUserConditional:
+    def test_success(self, authorized_client: TestClient, user_obj: models.User):
+        response = authorized_client.get(url=f'users/{user_obj.id}')
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+
+        response = authorized_client.get(url=f'users/{user_obj.id}', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == etag
+        response = authorized_client.get(url=f'users/{user_obj.id}', headers={'If-Modified-Since': last_modified})
+        assert response.status_code == 304
+        assert response.headers['Last-Modified'] == last_modified
+
+        # Stale validators
+        response = authorized_client.get(url=f'users/{user_obj.id}', headers={'If-None-Match': '"other"'})
+        assert response.status_code == 200
+        response = authorized_client.get(url=f'users/{user_obj.id}', headers={'If-Modified-Since': 'Sat, 01 Jan 2000 00:00:00 GMT'})
+        assert response.status_code == 200
+        # "If-None-Match" takes precedence
+        response = authorized_client.get(
+            url=f'users/{user_obj.id}',
+            headers={'If-None-Match': '"other"', 'If-Modified-Since': last_modified}
+        )
+        assert response.status_code == 200
+
+        # User updated
+        authorized_client.patch(url='users/', json={'first_name': 'new name'})
+        response = authorized_client.get(url=f'users/{user_obj.id}', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.json()['first_name'] == 'new name'
+
+    def test_fail(self, authorized_client: TestClient, user_obj: models.User):
+        # Malformed date
+        response = authorized_client.get(url=f'users/{user_obj.id}', headers={'If-Modified-Since': 'yesterday'})
+        assert response.status_code == 200
+
+        # User not found
+        response = authorized_client.get(url=f'users/{user_obj.id+100}', headers={'If-None-Match': '*'})
+        assert response.status_code == 404
+
+
+class TestCurrentUserCache:
+    def test_success(self, authorized_client: TestClient, session: Session, user_obj: models.User):
+        user_stats, token_stats = user_cache.stats(), token_cache.stats()
+        response = authorized_client.get(url=f'users/{user_obj.id}')
+        assert response.status_code == 200
+        assert user_cache.misses - user_stats['misses'] == 1
+        assert token_cache.misses - token_stats['misses'] == 1
+
+        # Served from cache
+        response = authorized_client.get(url=f'users/{user_obj.id}')
+        assert response.status_code == 200
+        assert user_cache.hits - user_stats['hits'] == 1
+        assert token_cache.hits - token_stats['hits'] == 1
+        assert user_cache.misses - user_stats['misses'] == 1
+
+        # Reported on metrics
+        response = authorized_client.get('metrics')
+        assert f'cache_hits{{cache="user"}} {user_cache.hits}' in response.text
+        assert f'cache_misses{{cache="token"}} {token_cache.misses}' in response.text
+        assert 'cache_hit_ratio{cache="token"}' in response.text
+
+        # Profile update invalidates cached user
+        response = authorized_client.patch(url='users/', json={'first_name': 'new name'})
+        assert response.status_code == 200
+        assert len(user_cache) == 0
+        response = authorized_client.patch(url='users/', json={})
+        assert response.json()['first_name'] == 'new name'
+
+    def test_fail(self, authorized_client: TestClient, session: Session, user_obj: models.User):
+        # Invalid token is not cached
+        response = authorized_client.get(url=f'users/{user_obj.id}', headers={'Authorization': 'Bearer invalid'})
+        assert response.status_code == 401
+        assert len(token_cache) == 0
+        assert len(user_cache) == 0
+
+
 class TestUpdateUser:
     def test_success(self, authorized_client: TestClient, user_obj: models.User):
         response = authorized_client.patch(url='users/', json={})
@@ -137,7 +229,8 @@ class TestUploadPicture:
         assert response.json() == {'status': True}
 
         # Image saved to appropriate directory
-        user_images = os.listdir(user_images_dir)
+        local_storage.shutdown(wait=True)  # Wait for derivatives
+        user_images = [name for name in os.listdir(user_images_dir) if not name.endswith('.webp')]
         assert len(user_images) == 1
 
         # Check if extension in jpg and file name is valid UUID object
@@ -159,7 +252,8 @@ class TestUploadPicture:
         assert response.json() == {'status': True}
 
         # Image saved to appropriate directory
-        user_images = os.listdir(user_images_dir)
+        local_storage.shutdown(wait=True)  # Wait for derivatives
+        user_images = [name for name in os.listdir(user_images_dir) if not name.endswith('.webp')]
         assert len(user_images) == 1
 
         # Check if extension in jpg and file name is valid UUID object and is different from previous picture
@@ -173,6 +267,145 @@ class TestUploadPicture:
         session.refresh(user_obj)
         assert user_obj.profile_picture == f'{new_image_uuid_str}.{image_extension}'
 
+    def test_derivatives(self, authorized_client: TestClient, session: Session, user_obj: models.User):
+        with open(os.path.join(settings.STATIC_DIR, 'image.jpg'), 'rb') as image_file:
+            response = authorized_client.post('users/picture', files={
+                'file': ('image.jpg', image_file, 'image/jpeg')
+            })
+        assert response.status_code == 200
+        local_storage.shutdown(wait=True)  # Wait for derivatives
+
+        session.refresh(user_obj)
+        image_name = user_obj.profile_picture
+        image_uuid_str = image_name.split('.')[0]
+        user_images_dir = os.path.join(settings.MEDIA_DIR, settings.USER_IMAGES_FOLDER)
+        assert sorted(os.listdir(user_images_dir)) == sorted(
+            [image_name] + [f'{image_uuid_str}_{size}.webp' for size in settings.AVATAR_SIZES]
+        )
+        for size in settings.AVATAR_SIZES:
+            with Image.open(os.path.join(user_images_dir, f'{image_uuid_str}_{size}.webp')) as image:
+                assert (image.format, image.size) == ('WEBP', (size, size))
+
+        response = authorized_client.get(f'users/{user_obj.id}')
+        assert response.json()['profile_picture'] == f'{settings.HOSTNAME}/media/images/{image_name}'
+        assert response.json()['profile_picture_sizes'] == {
+            str(size): f'{settings.HOSTNAME}/media/images/{image_uuid_str}_{size}.webp' for size in settings.AVATAR_SIZES
+        }
+
+        # Generated sizes are not looked up on disk again
+        with patch('app.storages.os.path.exists') as exists:
+            response = authorized_client.get(f'users/{user_obj.id}')
+        assert response.status_code == 200
+        exists.assert_not_called()
+
+        # Derivatives deleted along with original
+        response = authorized_client.delete('users/picture')
+        assert response.status_code == 204
+        assert os.listdir(user_images_dir) == []
+
+    def test_derivatives_of_replaced_image(self):
+        # Original replaced by another upload before its derivatives job ran
+        with patch('app.storages.logging.error') as log_error:
+            local_storage.schedule_user_image_derivatives(file_name=f'{uuid.uuid4()}.jpg').result()
+        log_error.assert_not_called()
+        assert os.listdir(os.path.join(settings.MEDIA_DIR, settings.USER_IMAGES_FOLDER)) == []
+
+    def test_content_addressed(
+        self,
+        authorized_client: TestClient,
+        session: Session,
+        user_obj: models.User,
+        extra_user_obj: models.User,
+        auth_headers: Callable[[models.User], dict[str, str]]
+    ):
+        def upload_picture(user: models.User):
+            with open(os.path.join(settings.STATIC_DIR, 'image.jpg'), 'rb') as image_file:
+                response = authorized_client.post('users/picture', files={
+                    'file': ('avatar.JPG', image_file, 'image/jpeg')
+                }, headers=auth_headers(user))
+            assert response.status_code == 200
+            local_storage.shutdown(wait=True)  # Wait for derivatives
+
+        with open(os.path.join(settings.STATIC_DIR, 'image.jpg'), 'rb') as image_file:
+            digest = hashlib.sha256(image_file.read()).hexdigest()
+        image_name = f'{digest[:2]}/{digest[2:4]}/{digest}.jpeg'
+        image_path = os.path.join(settings.MEDIA_DIR, settings.USER_IMAGES_FOLDER, image_name)
+
+        with patch.object(settings, 'USER_IMAGES_CONTENT_ADDRESSED', True):
+            # Same content shared by users
+            upload_picture(user_obj)
+            upload_picture(extra_user_obj)
+            for user in (user_obj, extra_user_obj):
+                session.refresh(user)
+                assert user.profile_picture == image_name
+            with open(f'{image_path}.refs') as refs_file:
+                assert refs_file.read() == '2'
+            assert sorted(os.listdir(os.path.dirname(image_path))) == sorted(
+                ['.lock', f'{digest}.jpeg', f'{digest}.jpeg.refs'] + [f'{digest}_{size}.webp' for size in settings.AVATAR_SIZES]
+            )
+
+            # Kept while referenced
+            response = authorized_client.delete('users/picture')
+            assert response.status_code == 204
+            assert os.path.exists(image_path)
+
+            # Re-uploading same picture replaces reference to itself
+            upload_picture(extra_user_obj)
+            with open(f'{image_path}.refs') as refs_file:
+                assert refs_file.read() == '1'
+
+            # Last reference gone
+            response = authorized_client.delete(
+                'users/picture', headers=auth_headers(extra_user_obj)
+            )
+            assert response.status_code == 204
+            assert os.listdir(os.path.dirname(image_path)) == ['.lock']
+
+    def test_fail_not_an_image(self, authorized_client: TestClient, session: Session, user_obj: models.User):
+        response = authorized_client.post('users/picture', files={
+            'file': ('image.jpg', b'not an image' * 100, 'image/jpeg')
+        })
+        assert response.status_code == 400
+        assert response.json() == {'detail': 'Error uploading picture.'}
+        assert os.listdir(os.path.join(settings.MEDIA_DIR, settings.USER_IMAGES_FOLDER)) == []  # No temp files left
+        session.refresh(user_obj)
+        assert user_obj.profile_picture == None
+
+    def test_fail_too_large(self, authorized_client: TestClient, session: Session, user_obj: models.User):
+        with open(os.path.join(settings.STATIC_DIR, 'image.jpg'), 'rb') as image_file:
+            image = image_file.read()
+        boundary = 'boundary'
+        body = (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="image.jpg"\r\n'
+            f'Content-Type: image/jpeg\r\n\r\n'
+        ).encode() + image + f'\r\n--{boundary}--\r\n'.encode()
+        headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        with \
+            patch.object(settings, 'UPLOAD_CHUNK_SIZE', 256), \
+            patch.object(settings, 'MAX_UPLOAD_SIZE', 1024), \
+            patch.object(local_storage, 'upload_user_image', wraps=local_storage.upload_user_image) as upload_user_image:
+            # Rejected by declared size before body is parsed
+            response = authorized_client.post('users/picture', content=body, headers=headers)
+            assert response.status_code == 413
+            assert response.json() == {'detail': 'Picture size exceeds 1024 bytes.'}
+
+            # Rejected while body is received when size is not declared
+            response = authorized_client.post('users/picture', content=iter([body[:8192], body[8192:]]), headers=headers)
+            assert response.status_code == 413
+            assert response.json() == {'detail': 'Picture size exceeds 1024 bytes.'}
+            assert not upload_user_image.called
+
+            # Body within multipart allowance, file size is checked while saving
+            response = authorized_client.post('users/picture', files={
+                'file': ('image.jpg', image[:4096], 'image/jpeg')
+            })
+            assert response.status_code == 413
+            assert response.json() == {'detail': 'Picture size exceeds 1024 bytes.'}
+            assert upload_user_image.called
+        assert os.listdir(os.path.join(settings.MEDIA_DIR, settings.USER_IMAGES_FOLDER)) == []  # No temp files left
+        session.refresh(user_obj)
+        assert user_obj.profile_picture == None
+
     def test_error_uploading_image(
         self,
         authorized_client: TestClient,
@@ -218,3 +451,64 @@ class TestDeletePicture:
         assert os.listdir(user_images_dir) == []  # Deleted
         session.refresh(user_obj)
         assert user_obj.profile_picture == None  # DB updated
+
+
+class TestFollowUser:
+    def test_success(self, authorized_client: TestClient, session: Session, user_obj: models.User, extra_user_obj: models.User):
+        session.add_all([models.Post(user_id=extra_user_obj.id, title=f'Title{n}', content=f'Content{n}') for n in range(3)])
+        session.commit()
+        response = authorized_client.post(f'users/{extra_user_obj.id}/follow')
+        assert response.status_code == 201
+        session.refresh(extra_user_obj)
+        assert extra_user_obj.followers_count == 1
+        assert session.get(models.UserFollow, (user_obj.id, extra_user_obj.id)) is not None
+        # Recent posts of followed user are added to feed
+        assert session.query(models.FeedItem).filter_by(user_id=user_obj.id, author_id=extra_user_obj.id).count() == 3
+
+    def test_fail(self, authorized_client: TestClient, session: Session, user_obj: models.User, extra_user_obj: models.User):
+        # Self
+        response = authorized_client.post(f'users/{user_obj.id}/follow')
+        assert response.status_code == 400
+        assert response.json() == {'detail': 'Cannot follow yourself'}
+
+        # Not found
+        response = authorized_client.post('users/0/follow')
+        assert response.status_code == 404
+        assert response.json() == {'detail': 'User not found'}
+
+        # Already followed
+        authorized_client.post(f'users/{extra_user_obj.id}/follow')
+        response = authorized_client.post(f'users/{extra_user_obj.id}/follow')
+        assert response.status_code == 409
+        assert response.json() == {'detail': 'Follow already exists'}
+        session.refresh(extra_user_obj)
+        assert extra_user_obj.followers_count == 1
+
+        # Not authenticated
+        response = authorized_client.post(f'users/{extra_user_obj.id}/follow', headers={'Authorization': ''})
+        assert response.status_code == 401
+        assert response.json() == {'detail': 'Not authenticated'}
+
+
+class TestUnfollowUser:
+    def test_success(self, authorized_client: TestClient, session: Session, user_obj: models.User, extra_user_obj: models.User):
+        session.add(models.Post(user_id=extra_user_obj.id, title='Title', content='Content'))
+        session.commit()
+        authorized_client.post(f'users/{extra_user_obj.id}/follow')
+        response = authorized_client.post(f'users/{extra_user_obj.id}/unfollow')
+        assert response.status_code == 204
+        session.refresh(extra_user_obj)
+        assert extra_user_obj.followers_count == 0
+        assert session.query(models.UserFollow).count() == 0
+        assert session.query(models.FeedItem).count() == 0
+
+    def test_fail(self, authorized_client: TestClient, extra_user_obj: models.User):
+        # Not followed
+        response = authorized_client.post(f'users/{extra_user_obj.id}/unfollow')
+        assert response.status_code == 404
+        assert response.json() == {'detail': 'Follow not found'}
+
+        # Not authenticated
+        response = authorized_client.post(f'users/{extra_user_obj.id}/unfollow', headers={'Authorization': ''})
+        assert response.status_code == 401
+        assert response.json() == {'detail': 'Not authenticated'}